@@ -0,0 +1,122 @@
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils.helpers import BASE_PATH
+
+TEST_FILE = os.path.join(BASE_PATH, 'tests/testdata/Pica pica_30s.wav')
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+
+def cold_start(code, repeat):
+    # time a snippet in a fresh interpreter, so the import and first call costs are included
+    return timeit(lambda: subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(__file__)), repeat)
+
+
+def report(name, times):
+    print(f'{name:<40} min {times[0] * 1000:8.1f} ms   median {times[1] * 1000:8.1f} ms')
+
+
+def bench_decode(args):
+    import librosa
+    from utils.analysis import decodeAudio
+
+    print(f'Decoding {args.file} at {args.rate} Hz, {args.repeat} runs')
+    report('librosa.load', timeit(lambda: librosa.load(args.file, sr=args.rate, mono=True, res_type='kaiser_fast'), args.repeat))
+    report('decodeAudio', timeit(lambda: decodeAudio(args.file, args.rate), args.repeat))
+    # both include importing utils.analysis (and with it the tflite runtime)
+    report('cold start librosa.load', cold_start(f'import utils.analysis, librosa; librosa.load({args.file!r}, sr={args.rate}, res_type="kaiser_fast")',
+                                                 args.repeat))
+    report('cold start decodeAudio', cold_start(f'from utils.analysis import decodeAudio; decodeAudio({args.file!r}, {args.rate})', args.repeat))
+
+
+def bench_resample(args):
+    import librosa
+    import soundfile
+    from utils.analysis import resample
+
+    sig, rate = soundfile.read(args.file, dtype='float32')
+    print(f'Resampling {args.file} from {rate} Hz to {args.rate} Hz, {args.repeat} runs')
+    for res_type in ['soxr_hq', 'polyphase']:
+        report(f'librosa.resample {res_type}', timeit(lambda: librosa.resample(sig, orig_sr=rate, target_sr=args.rate, res_type=res_type), args.repeat))
+    report('resample (cached polyphase filter)', timeit(lambda: resample(sig, rate, args.rate), args.repeat))
+
+
+def sox_spectrogram(in_file, out_file, title, comment, font_path, raw):
+    # what reporting.spectrogram did before the in-process renderer
+    from PIL import Image, ImageDraw, ImageFont
+
+    args = ['sox', '-V1', in_file, '-n', 'remix', '1', 'rate', '24k', 'spectrogram', '-t', '', '-c', '', '-o', out_file]
+    subprocess.run(args + (['-r'] if raw else []), check=True, capture_output=True)
+    img = Image.open(out_file)
+    draw = ImageDraw.Draw(img)
+    title_font = ImageFont.truetype(font_path, 13)
+    _, _, w, _ = draw.textbbox((0, 0), title, font=title_font)
+    draw.text(((img.size[0] - w) / 2, 6), title, fill="white", font=title_font)
+    comment_font = ImageFont.truetype(font_path, 11)
+    _, _, _, h = draw.textbbox((0, 0), comment, font=comment_font)
+    draw.text((1, img.size[1] - (h + 1)), comment, fill="white", font=comment_font)
+    img.save(out_file)
+
+
+def bench_spectrogram(args):
+    import soundfile
+    from utils.helpers import FONT_DIR
+    from utils.spectrogram import annotate, render, save_png
+
+    font_path = os.path.join(FONT_DIR, 'RobotoFlex-Regular.ttf')
+    samples, rate = soundfile.read(args.file, dtype='int16', always_2d=True)
+    clip = samples[:round(args.length * rate)]
+    tmp_dir = tempfile.mkdtemp()
+    clip_file = os.path.join(tmp_dir, 'clip.wav')
+    soundfile.write(clip_file, clip, rate)
+    print(f'Spectrogram of a {args.length} s clip of {args.file}, {args.repeat} runs')
+    for raw in [False, True]:
+        name = 'raw' if raw else 'axes'
+        if shutil.which('sox'):
+            report(f'sox + PIL ({name})', timeit(lambda: sox_spectrogram(clip_file, os.path.join(tmp_dir, 'sox.png'), 'Eurasian Magpie',
+                                                                         clip_file, font_path, raw), args.repeat))
+        else:
+            print('sox not found, skipping the sox path')
+        report(f'render from samples ({name})', timeit(lambda: save_png(annotate(render(clip, rate, raw, font_path), 'Eurasian Magpie', clip_file, font_path),
+                                                                        os.path.join(tmp_dir, 'numpy.png')), args.repeat))
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the analysis building blocks.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    decode_parser = subparsers.add_parser('decode', help='WAV decoding: fast path vs librosa')
+    decode_parser.add_argument('--file', default=TEST_FILE, help='Recording to decode.')
+    decode_parser.add_argument('--rate', type=int, default=48000, help='Target sample rate. Defaults to 48000.')
+    decode_parser.add_argument('--repeat', type=int, default=10, help='Number of runs. Defaults to 10.')
+    decode_parser.set_defaults(func=bench_decode)
+
+    resample_parser = subparsers.add_parser('resample', help='Resampling: cached polyphase filter vs librosa')
+    resample_parser.add_argument('--file', default=TEST_FILE, help='Recording to resample.')
+    resample_parser.add_argument('--rate', type=int, default=32000, help='Target sample rate. Defaults to 32000.')
+    resample_parser.add_argument('--repeat', type=int, default=10, help='Number of runs. Defaults to 10.')
+    resample_parser.set_defaults(func=bench_resample)
+
+    spectrogram_parser = subparsers.add_parser('spectrogram', help='Clip spectrograms: in-process renderer vs sox')
+    spectrogram_parser.add_argument('--file', default=TEST_FILE, help='Recording to take the clip from.')
+    spectrogram_parser.add_argument('--length', type=float, default=6, help='Length of the clip in seconds. Defaults to 6.')
+    spectrogram_parser.add_argument('--repeat', type=int, default=10, help='Number of runs. Defaults to 10.')
+    spectrogram_parser.set_defaults(func=bench_spectrogram)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,20 +1,27 @@
+import datetime
 import logging
+import multiprocessing
 import os
 import os.path
 import re
 import signal
 import sys
 import threading
-from queue import Queue
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Full, Queue
 from subprocess import CalledProcessError
 
 import inotify.adapters
 from inotify.constants import IN_CLOSE_WRITE
 
-from utils.analysis import load_global_model, run_analysis
+from utils.analysis import load_audio, load_global_model, run_analysis
+from utils.birdweather import BirdWeatherUploader, get_outbox
+from utils.models import get_model
 from utils.helpers import get_settings, get_wav_files, ANALYZING_NOW
 from utils.classes import ParseFileName
-from utils.reporting import extract_detection, summary, write_to_file, write_to_db, apprise, bird_weather, heartbeat, \
+from utils.reporting import Recording, extract_detection, summary, write_to_file, write_to_db, apprise, bird_weather, heartbeat, \
     update_json_file
 
 shutdown = False
@@ -29,29 +36,49 @@ def sig_handler(sig_num, curr_stack_frame):
 
 
 def main():
-    load_global_model()
+    model = load_global_model()
     conf = get_settings()
     i = inotify.adapters.Inotify()
     i.add_watch(os.path.join(conf['RECS_DIR'], 'StreamData'), mask=IN_CLOSE_WRITE)
 
     backlog = get_wav_files()
 
-    report_queue = Queue()
-    thread = threading.Thread(target=handle_reporting_queue, args=(report_queue, ))
+    # analysis runs ahead of the reporting, until one of the queues is full
+    queue_depth = max(1, conf.getint('REPORTING_QUEUE_DEPTH', fallback=4))
+    report_queue = Queue(maxsize=queue_depth)
+    network_queue = Queue(maxsize=queue_depth)
+    thread = threading.Thread(target=handle_reporting_queue, args=(report_queue, network_queue))
     thread.start()
+    network_thread = threading.Thread(target=handle_network_queue, args=(network_queue, ))
+    network_thread.start()
+    uploader = start_uploader()
+
+    scheduler = StreamScheduler(conf.getint('RECORDING_LENGTH'))
+    workers = start_workers(model, scheduler, report_queue)
 
     log.info('backlog is %d', len(backlog))
-    for file_name in backlog:
-        process_file(file_name, report_queue)
-        if shutdown:
-            break
-    log.info('backlog done')
+    drain = None
+    backlog_workers = conf.getint('BACKLOG_WORKERS', fallback=1)
+    if backlog_workers > 1 and len(backlog) > 1:
+        # the pool works through the backlog, while new recordings are analysed as they come in
+        drain = BacklogDrain(backlog, backlog_workers)
+    else:
+        for file_name in backlog:
+            scheduler.put(file_name, backlog=True)
 
     empty_count = 0
     for event in i.event_gen():
         if shutdown:
             break
 
+        scheduler.log_lag()
+        if drain is not None:
+            drain.report_ready(report_queue)
+            if drain.done():
+                drain.close()
+                drain = None
+                log.info('backlog done')
+
         if event is None:
             if empty_count > (conf.getint('RECORDING_LENGTH') * 2 + 30):
                 log.error('no more notifications: restarting...')
@@ -71,36 +98,302 @@ def main():
             backlog = []
             continue
 
-        process_file(file_path, report_queue)
+        scheduler.put(file_path)
         empty_count = 0
 
+    if drain is not None:
+        if shutdown:
+            drain.close()
+        else:
+            drain.finish(report_queue)
+
+    scheduler.close()
+    for worker, prefetcher in workers:
+        worker.join()
+        prefetcher.close()
+
     # we're all done
     report_queue.put(None)
     thread.join()
     report_queue.join()
+    network_queue.put(None)
+    network_thread.join()
+    network_queue.join()
+    uploader.close()
+
+
+def start_uploader():
+    # the soundscapes are sent from the outbox, a slow BirdWeather does not hold up the reporting
+    conf = get_settings()
+    uploader = BirdWeatherUploader(get_outbox(), conf['BIRDWEATHER_ID'])
+    if conf['BIRDWEATHER_ID'] != "":
+        uploader.start()
+    return uploader
 
 
-def process_file(file_name, report_queue):
+def start_workers(model, scheduler, report_queue):
+    # every analysis thread gets its own interpreter, and decodes its next recording while it analyses the current one
+    conf = get_settings()
+    models = [model] + [get_model() for _ in range(conf.getint('ANALYSIS_WORKERS', fallback=1) - 1)]
+    depth = max(1, conf.getint('PREFETCH_FILES', fallback=1))
+    workers = []
+    for model in models:
+        prefetcher = Prefetcher(scheduler, model, depth)
+        worker = threading.Thread(target=analysis_worker, args=(prefetcher, scheduler, report_queue, model))
+        worker.start()
+        workers.append((worker, prefetcher))
+    return workers
+
+
+def analysis_worker(prefetcher, scheduler, report_queue, model):
+    while not shutdown:
+        prefetched = prefetcher.get()
+        if prefetched is None:
+            break
+        file, audio = prefetched
+        process_file(file.file_name, report_queue, model, audio)
+        scheduler.done(file)
+
+
+def process_file(file_name, report_queue, model=None, audio=None):
     try:
         if os.path.getsize(file_name) == 0:
             os.remove(file_name)
             return
-        log.info('Analyzing %s', file_name)
-        with open(ANALYZING_NOW, 'w') as analyzing:
-            analyzing.write(file_name)
+        set_analyzing_now(file_name)
         file = ParseFileName(file_name)
-        detections = run_analysis(file)
-        # we join() to make sure te reporting queue does not get behind
-        if not report_queue.empty():
-            log.warning('reporting queue not yet empty')
-        report_queue.join()
-        report_queue.put((file, detections))
+        audio_data = audio.result() if audio is not None else None
+        detections = run_analysis(file, model, audio_data)
+        queue_report(report_queue, file, detections)
     except BaseException as e:
         stderr = e.stderr.decode('utf-8') if isinstance(e, CalledProcessError) else ""
         log.exception(f'Unexpected error: {stderr}', exc_info=e)
 
 
-def handle_reporting_queue(queue):
+def set_analyzing_now(file_name):
+    log.info('Analyzing %s', file_name)
+    # shown by the web interface, with several workers the one that started last
+    with open(ANALYZING_NOW, 'w') as analyzing:
+        analyzing.write(file_name)
+
+
+def queue_report(report_queue, file, detections):
+    # blocks when the reporting queue is full, so the analysis cannot get too far ahead
+    if report_queue.full():
+        log.warning('reporting queue full')
+    report_queue.put((file, detections))
+
+
+def init_worker():
+    # the main process handles the signals and shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup_logging()
+    # the backlog gets the CPU left over by the live recordings
+    try:
+        os.nice(10)
+    except OSError as e:
+        log.warning('Cannot lower the priority of the backlog worker: %s', e)
+    load_global_model()
+
+
+def analyze_file(file_name):
+    set_analyzing_now(file_name)
+    file = ParseFileName(file_name)
+    return file, run_analysis(file)
+
+
+class StreamScheduler:
+    """Hands out recordings to the analysis threads.
+
+    Live recordings are served round-robin over the streams (ParseFileName.RTSP_id), so one busy stream
+    cannot starve the others, and before any recording from the backlog.
+    """
+
+    def __init__(self, recording_length):
+        self._recording_length = recording_length
+        self._cond = threading.Condition()
+        self._live = OrderedDict()
+        self._backlog = deque()
+        self._backlog_left = set()
+        self._closed = False
+        self._lag = {}
+        self._last_lag_report = time.monotonic()
+
+    def put(self, file_name, backlog=False):
+        try:
+            file = ParseFileName(file_name)
+        except BaseException as e:
+            log.exception(f'Cannot schedule {file_name}', exc_info=e)
+            return
+        with self._cond:
+            if backlog:
+                self._backlog.append(file)
+                self._backlog_left.add(file_name)
+            else:
+                self._live.setdefault(file.RTSP_id, deque()).append(file)
+            self._cond.notify()
+
+    def get(self):
+        # blocks until there is a recording to analyse, returns None once closed and empty
+        with self._cond:
+            while True:
+                for stream, files in self._live.items():
+                    if files:
+                        self._live.move_to_end(stream)
+                        return files.popleft()
+                if self._backlog:
+                    return self._backlog.popleft()
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+    def done(self, file):
+        with self._cond:
+            if file.file_name in self._backlog_left:
+                self._backlog_left.remove(file.file_name)
+                if not self._backlog_left:
+                    log.info('backlog done')
+                return
+            # seconds between the end of the recording and the end of its analysis
+            lag = (datetime.datetime.now() - file.file_date).total_seconds() - self._recording_length
+            self._lag[file.RTSP_id] = lag
+            waiting = len(self._live[file.RTSP_id])
+        if lag > 3 * self._recording_length:
+            log.warning('%s is falling behind: %.0fs lag, %d recordings waiting', self._stream_name(file.RTSP_id), lag, waiting)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def log_lag(self, interval=60):
+        # per stream: the lag of the last analysed recording and the number of recordings waiting
+        if time.monotonic() - self._last_lag_report < interval:
+            return
+        self._last_lag_report = time.monotonic()
+        with self._cond:
+            for stream, lag in self._lag.items():
+                waiting = len(self._live.get(stream, ()))
+                log.info('%s: %.1fs lag, %d recordings waiting', self._stream_name(stream), lag, waiting)
+            if self._backlog:
+                log.info('backlog: %d recordings waiting', len(self._backlog))
+
+    @staticmethod
+    def _stream_name(stream):
+        return stream.rstrip('-') if stream else 'local'
+
+
+class Prefetcher:
+    """Decodes the next recordings of an analysis thread on a background thread, while it analyses the current one.
+
+    Each analysis thread has one, so the recordings are decoded in parallel like they are analysed. At most
+    `depth` recordings are taken from the scheduler ahead of the one being analysed: a live recording that
+    comes in later waits behind at most `depth` prefetched recordings per thread.
+    """
+
+    def __init__(self, scheduler, model, depth=1):
+        self._scheduler = scheduler
+        self._model = model
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._next = deque(self._executor.submit(self._fetch) for _ in range(depth))
+
+    def _fetch(self):
+        file = self._scheduler.get()
+        if file is None:
+            return None
+        return file, self._decode(file.file_name)
+
+    def _decode(self, file_name):
+        # decoding errors are raised in the analysis thread, when it asks for the result
+        audio = Future()
+        try:
+            # empty recordings are removed by process_file
+            audio.set_result(load_audio(file_name, self._model) if os.path.getsize(file_name) > 0 else None)
+        except BaseException as e:
+            audio.set_exception(e)
+        return audio
+
+    def get(self):
+        # returns (file, Future of its chunks), or None when there are no more recordings
+        prefetched = self._next[0].result()
+        if prefetched is not None:
+            self._next.popleft()
+            self._next.append(self._executor.submit(self._fetch))
+        return prefetched
+
+    def close(self):
+        # the scheduler is closed first, a recording being decoded is left for the next start
+        self._executor.shutdown(wait=True)
+
+
+class BacklogDrain:
+    """Analyses the backlog on a pool of worker processes, each with its own interpreter.
+
+    Results are handed to the reporting queue in timestamp order.
+    """
+
+    def __init__(self, backlog, workers):
+        backlog = [file_name for file_name in backlog if not self._remove_if_empty(file_name)]
+        backlog.sort(key=lambda file_name: ParseFileName(file_name).file_date)
+        log.info('draining backlog with %d workers', workers)
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker)
+        self._pending = deque((file_name, self._pool.submit(analyze_file, file_name)) for file_name in backlog)
+
+    @staticmethod
+    def _remove_if_empty(file_name):
+        try:
+            if os.path.getsize(file_name) == 0:
+                os.remove(file_name)
+                return True
+        except OSError as e:
+            log.warning('Cannot access %s: %s', file_name, e)
+            return True
+        return False
+
+    def _report_next(self, report_queue, block=True):
+        # False when the reporting queue has no room for it, it stays at the head of the queue
+        file_name, future = self._pending[0]
+        try:
+            file, detections = future.result()
+        except BaseException as e:
+            self._pending.popleft()
+            stderr = e.stderr.decode('utf-8') if isinstance(e, CalledProcessError) else ""
+            log.exception(f'Unexpected error analyzing {file_name}: {stderr}', exc_info=e)
+            return True
+        if block:
+            queue_report(report_queue, file, detections)
+        else:
+            # the last free slot is left to the live recordings
+            if report_queue.maxsize > 1 and report_queue.qsize() >= report_queue.maxsize - 1:
+                return False
+            try:
+                report_queue.put_nowait((file, detections))
+            except Full:
+                return False
+        self._pending.popleft()
+        return True
+
+    def report_ready(self, report_queue):
+        # only report from the head of the queue to keep the timestamp order. Called from the event loop, it
+        # never blocks: what the reporting queue has no room for is reported on a later call.
+        while self._pending and self._pending[0][1].done():
+            if not self._report_next(report_queue, block=False):
+                break
+
+    def finish(self, report_queue):
+        while self._pending and not shutdown:
+            self._report_next(report_queue)
+        self.close()
+
+    def done(self):
+        return not self._pending
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def handle_reporting_queue(queue, network_queue):
     while True:
         msg = queue.get()
         # check for signal that we are done
@@ -110,13 +403,39 @@ def handle_reporting_queue(queue):
         file, detections = msg
         try:
             update_json_file(file, detections)
+            recording = Recording(file.file_name)
             for detection in detections:
-                detection.file_name_extr = extract_detection(file, detection)
+                detection.file_name_extr = extract_detection(file, detection, recording)
                 log.info('%s;%s', summary(file, detection), os.path.basename(detection.file_name_extr))
                 write_to_file(file, detection)
-                write_to_db(file, detection)
+            # raises when the detections cannot be written: the recording is not removed by the network thread
+            write_to_db(file, detections)
+            bird_weather(file, detections, recording)
+            # notifications and uploads are network bound, they run on their own thread
+            if network_queue.full():
+                log.warning('network queue full')
+            network_queue.put(msg)
+        except BaseException as e:
+            stderr = e.stderr.decode('utf-8') if isinstance(e, CalledProcessError) else ""
+            log.exception(f'Unexpected error: {stderr}', exc_info=e)
+
+        queue.task_done()
+
+    # mark the 'None' signal as processed
+    queue.task_done()
+    log.info('handle_reporting_queue done')
+
+
+def handle_network_queue(queue):
+    while True:
+        msg = queue.get()
+        # check for signal that we are done
+        if msg is None:
+            break
+
+        file, detections = msg
+        try:
             apprise(file, detections)
-            bird_weather(file, detections)
             heartbeat()
             os.remove(file.file_name)
         except BaseException as e:
@@ -127,7 +446,7 @@ def handle_reporting_queue(queue):
 
     # mark the 'None' signal as processed
     queue.task_done()
-    log.info('handle_reporting_queue done')
+    log.info('handle_network_queue done')
 
 
 def setup_logging():
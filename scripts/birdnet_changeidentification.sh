@@ -70,6 +70,13 @@ fi
 # Get the line where the column "File_Name" matches exactly $OLDNAME
 IFS='|' read -r OLDNAME_sciname OLDNAME_comname OLDNAME_date < <(sqlite3 "$DB_FILE" "SELECT Sci_Name, Com_Name, Date FROM $DETECTIONS_TABLE WHERE File_Name = '$OLDNAME' LIMIT 1;")
 
+# The archives are not changed, their detections are counted in the aggregate tables of $DB_FILE
+ARCHIVE_FILE="$(dirname "$DB_FILE")/archive/birds-$(grep -oE '[0-9]{4}-[0-9]{2}-[0-9]{2}' <<< "$OLDNAME" | head -n1 | cut -d- -f1).db"
+if [[ -z "$OLDNAME_sciname" && -f "$ARCHIVE_FILE" ]] && [[ -n "$(sqlite3 "file:$ARCHIVE_FILE?mode=ro" "SELECT 1 FROM detection_data WHERE File_Name = '$OLDNAME' LIMIT 1;")" ]]; then
+    echo "Error: $OLDNAME is in the archive $ARCHIVE_FILE, it cannot be changed"
+    exit 1
+fi
+
 if [[ -z "$OLDNAME_sciname" ]]; then
     echo "Error: No line matching $OLDNAME in $DB_FILE"
     exit 1
@@ -101,7 +108,8 @@ if [[ -f $FILE_PATH ]]; then
     
     # Move and rename the file
     mv "$FILE_PATH" "$NEW_DIR/$NEWNAME_filename"
-    mv "$FILE_PATH".png "$NEW_DIR/$NEWNAME_filename".png
+    # not there yet with LAZY_SPECTROGRAMS
+    [[ -f "$FILE_PATH".png ]] && mv "$FILE_PATH".png "$NEW_DIR/$NEWNAME_filename".png
     
     [[ "$OUTPUT_TYPE" == "debug" ]] && echo "Files moved!"
 else
@@ -113,7 +121,10 @@ fi
 ###################################
 
 # Update the database
-sqlite3 "$DB_FILE" "UPDATE $DETECTIONS_TABLE SET Sci_Name = '$NEWNAME_sciname', Com_Name = '$NEWNAME_comname', Confidence = '0', File_Name = '$NEWNAME_filename' WHERE File_Name = '$OLDNAME';"
+# through the database writer, so it does not compete with the analysis for the lock
+"$HOME/BirdNET-Pi/birdnet/bin/python3" "$HOME/BirdNET-Pi/scripts/db_writer.py" exec \
+  "UPDATE $DETECTIONS_TABLE SET Sci_Name = ?, Com_Name = ?, Confidence = 0, File_Name = ? WHERE File_Name = ?;" \
+  "$NEWNAME_sciname" "$NEWNAME_comname" "$NEWNAME_filename" "$OLDNAME" >/dev/null
 
 [[ "$OUTPUT_TYPE" == "debug" ]] && echo "Database entry removed"
 
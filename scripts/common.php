@@ -128,17 +128,79 @@ function get_db() {
   return $_db;
 }
 
+// The detections older than ARCHIVE_AFTER_DAYS are moved to one database per year, in scripts/archive.
+// The aggregate tables keep counting them.
+function get_archive_files() {
+  $archives = [];
+  foreach (glob(__DIR__ . '/archive/birds-*.db') as $path) {
+    if (preg_match('/^birds-(\d{4})\.db$/', basename($path), $matches)) {
+      $archives[(int)$matches[1]] = $path;
+    }
+  }
+  ksort($archives);
+  return $archives;
+}
+
+// the year of the archive that holds a detection, null when it is not archived
+function get_archive_year($file_name) {
+  $archives = get_archive_files();
+  if (!preg_match('/(\d{4})-\d{2}-\d{2}/', $file_name, $matches) || !isset($archives[(int)$matches[1]])) {
+    return null;
+  }
+  $archive = new SQLite3($archives[(int)$matches[1]], SQLITE3_OPEN_READONLY);
+  $archive->busyTimeout(1000);
+  $statement = $archive->prepare('SELECT 1 FROM detection_data WHERE File_Name = :file_name');
+  ensure_db_ok($statement);
+  $statement->bindValue(':file_name', $file_name);
+  $archived = $statement->execute()->fetchArray() !== false;
+  $archive->close();
+  return $archived ? (int)$matches[1] : null;
+}
+
+/* A connection with the detections matching $where from $start to $end (dates as YYYY-MM-DD, null for no
+   bound) in the temporary table detections_all, those of the archives included. Like archive_batches() in
+   utils/schema.py: SQLite attaches at most 10 databases, the archives are read a batch at a time, and not at
+   all when $start is after the oldest detection left in birds.db. */
+function get_detections_all($where, $start=null, $end=null) {
+  $db = get_db();
+  $db->exec('DROP TABLE IF EXISTS temp.detections_all');
+  $db->exec("CREATE TEMP TABLE detections_all AS SELECT * FROM main.detections WHERE $where");
+  $oldest = isset($start) ? $db->querySingle('SELECT MIN(Date) FROM detection_data') : null;
+  if (isset($oldest) && $start >= $oldest) {
+    return $db;
+  }
+  $archives = array_filter(get_archive_files(), function($year) use ($start, $end) {
+    return (!isset($start) || $year >= (int)substr($start, 0, 4)) && (!isset($end) || $year <= (int)substr($end, 0, 4));
+  }, ARRAY_FILTER_USE_KEY);
+  foreach (array_chunk($archives, 10, true) as $batch) {
+    foreach ($batch as $year => $path) {
+      $db->exec("ATTACH DATABASE '" . SQLite3::escapeString($path) . "' AS archive_$year");
+    }
+    foreach ($batch as $year => $path) {
+      $db->exec("INSERT INTO temp.detections_all SELECT * FROM (
+        SELECT d.Date, d.Time, s.Sci_Name, s.Com_Name, d.Confidence, r.Lat, r.Lon, r.Cutoff, d.Week, r.Sens, r.Overlap, d.File_Name
+        FROM archive_$year.detection_data d JOIN archive_$year.species s ON s.id = d.Species JOIN archive_$year.run_settings r ON r.id = d.Settings
+      ) WHERE $where");
+    }
+    foreach ($batch as $year => $path) {
+      $db->exec("DETACH DATABASE archive_$year");
+    }
+  }
+  return $db;
+}
+
 function fetch_species_array($sort_by, $date=null) {
   $db = get_db();
   $where = (isset($date)) ? "WHERE Date == \"$date\"" : "";
+  $select = "SELECT Date, Time, File_Name, Com_Name, Sci_Name, SUM(Count) as Count, MAX(MaxConfidence) as MaxConfidence FROM species_hourly $where GROUP BY Sci_Name";
   if ($sort_by === "occurrences") {
-    $statement = $db->prepare("SELECT Date, Time, File_Name, Com_Name, Sci_Name, COUNT(*) as Count, MAX(Confidence) as MaxConfidence FROM detections $where GROUP BY Sci_Name ORDER BY COUNT(*) DESC");
+    $statement = $db->prepare("$select ORDER BY SUM(Count) DESC");
   } elseif ($sort_by === "confidence") {
-    $statement = $db->prepare("SELECT Date, Time, File_Name, Com_Name, Sci_Name, COUNT(*) as Count, MAX(Confidence) as MaxConfidence FROM detections $where GROUP BY Sci_Name ORDER BY MAX(Confidence) DESC");
+    $statement = $db->prepare("$select ORDER BY MAX(MaxConfidence) DESC");
   } elseif ($sort_by === "date") {
-    $statement = $db->prepare("SELECT Date, Time, File_Name, Com_Name, Sci_Name, COUNT(*) as Count, MAX(Confidence) as MaxConfidence FROM detections $where GROUP BY Sci_Name ORDER BY MIN(Date) DESC, Time DESC");
+    $statement = $db->prepare("$select ORDER BY MIN(Date) DESC, Time DESC");
   } else {
-    $statement = $db->prepare("SELECT Date, Time, File_Name, Com_Name, Sci_Name, COUNT(*) as Count, MAX(Confidence) as MaxConfidence FROM detections $where GROUP BY Sci_Name ORDER BY Com_Name ASC");
+    $statement = $db->prepare("$select ORDER BY Com_Name ASC");
   }
   ensure_db_ok($statement);
   $result = $statement->execute();
@@ -154,15 +216,15 @@ function fetch_best_detection($com_name) {
 }
 
 function fetch_all_detections($sci_name, $sort_by, $date=null) {
-  $db = get_db();
   $filter = (isset($date)) ? "AND Date == \"$date\"" : "";
+  $db = get_detections_all("Sci_Name == \"$sci_name\" $filter", $date, $date);
   if ($sort_by === "occurrences") {
-    $statement = $db->prepare("SELECT * FROM detections WHERE Sci_Name == \"$sci_name\" $filter ORDER BY COUNT(*) DESC");
+    $statement = $db->prepare("SELECT * FROM detections_all ORDER BY COUNT(*) DESC");
   } elseif ($sort_by === "confidence") {
-    $statement = $db->prepare("SELECT * FROM detections WHERE Sci_Name == \"$sci_name\" $filter ORDER BY Confidence DESC");
+    $statement = $db->prepare("SELECT * FROM detections_all ORDER BY Confidence DESC");
   } else {
     $order = (isset($date)) ? "Time DESC" : "Date DESC, Time DESC";
-    $statement = $db->prepare("SELECT * FROM detections where Sci_Name == \"$sci_name\" $filter ORDER BY $order");
+    $statement = $db->prepare("SELECT * FROM detections_all ORDER BY $order");
   }
   ensure_db_ok($statement);
   $result = $statement->execute();
@@ -171,39 +233,16 @@ function fetch_all_detections($sci_name, $sort_by, $date=null) {
 
 function get_summary() {
   $db = get_db();
-  $statement = $db->prepare('SELECT COUNT(*) FROM detections');
+  // the counts come from the aggregate tables, only the last hour is counted in detections
+  $statement = $db->prepare('SELECT
+    (SELECT IFNULL(SUM(Count), 0) FROM species_totals) AS totalcount,
+    (SELECT IFNULL(SUM(Count), 0) FROM species_hourly WHERE Date == DATE(\'now\', \'localtime\')) AS todaycount,
+    (SELECT COUNT(*) FROM detections WHERE Date == Date(\'now\', \'localtime\') AND TIME >= TIME(\'now\', \'localtime\', \'-1 hour\')) AS hourcount,
+    (SELECT COUNT(DISTINCT(Sci_Name)) FROM species_hourly WHERE Date == Date(\'now\',\'localtime\')) AS speciestally,
+    (SELECT COUNT(*) FROM species_totals) AS totalspeciestally');
   ensure_db_ok($statement);
   $result = $statement->execute();
-  $totalcount = $result->fetchArray(SQLITE3_ASSOC);
-
-  $statement2 = $db->prepare('SELECT COUNT(*) FROM detections WHERE Date == DATE(\'now\', \'localtime\')');
-  ensure_db_ok($statement2);
-  $result2 = $statement2->execute();
-  $todaycount = $result2->fetchArray(SQLITE3_ASSOC);
-
-  $statement3 = $db->prepare('SELECT COUNT(*) FROM detections WHERE Date == Date(\'now\', \'localtime\') AND TIME >= TIME(\'now\', \'localtime\', \'-1 hour\')');
-  ensure_db_ok($statement3);
-  $result3 = $statement3->execute();
-  $hourcount = $result3->fetchArray(SQLITE3_ASSOC);
-
-  $statement5 = $db->prepare('SELECT COUNT(DISTINCT(Sci_Name)) FROM detections WHERE Date == Date(\'now\',\'localtime\')');
-  ensure_db_ok($statement5);
-  $result5 = $statement5->execute();
-  $todayspeciestally = $result5->fetchArray(SQLITE3_ASSOC);
-
-  $statement6 = $db->prepare('SELECT COUNT(DISTINCT(Sci_Name)) FROM detections');
-  ensure_db_ok($statement6);
-  $result6 = $statement6->execute();
-  $totalspeciestally = $result6->fetchArray(SQLITE3_ASSOC);
-
-  $ret = [
-    'totalcount' => $totalcount['COUNT(*)'],
-    'todaycount' => $todaycount['COUNT(*)'],
-    'hourcount' => $hourcount['COUNT(*)'],
-    'speciestally' => $todayspeciestally['COUNT(DISTINCT(Sci_Name))'],
-    'totalspeciestally' => $totalspeciestally['COUNT(DISTINCT(Sci_Name))']
-  ];
-  return $ret;
+  return $result->fetchArray(SQLITE3_ASSOC);
 }
 
 class ImageProvider {
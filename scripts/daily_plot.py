@@ -1,6 +1,5 @@
 import argparse
 import os
-import sqlite3
 import textwrap
 from datetime import datetime
 from time import sleep
@@ -13,16 +12,22 @@ import seaborn as sns
 from matplotlib import rcParams
 from matplotlib.colors import LogNorm
 
-from utils.helpers import DB_PATH, FONT_DIR, get_settings, get_font
+from utils.db import DetectionRecord, get_detections
+from utils.helpers import FONT_DIR, get_settings, get_font
+from utils.snapshot import export_snapshot, read_snapshot
 
 
 def get_data(now=None):
-    uri = f"file:{DB_PATH}?mode=ro"
-    conn = sqlite3.connect(uri, uri=True)
     if now is None:
         now = datetime.now()
-    df = pd.read_sql_query(f"SELECT * from detections WHERE Date = DATE('{now.strftime('%Y-%m-%d')}')",
-                           conn)
+    # the snapshot is brought up to date on each run, and the charts of the other pages read it too
+    export_snapshot()
+    day = now.strftime('%Y-%m-%d')
+    columns = ['Date', 'Time', 'Sci_Name', 'Com_Name', 'Confidence']
+    df = read_snapshot(columns, start=day, end=day)
+    if df is None:
+        # the snapshot is being written again by another export
+        df = pd.DataFrame(get_detections(day, day), columns=DetectionRecord._fields)[columns]
 
     # Convert Date and Time Fields to Panda's format
     df['Date'] = pd.to_datetime(df['Date'])
@@ -0,0 +1,112 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from datetime import date, timedelta
+
+from utils.helpers import DB_PATH, get_settings
+from utils.schema import archive_detections, check_aggregates, create_db, migrate_db, rebuild_aggregates, seal_archive
+from utils.snapshot import export_snapshot
+
+
+def create(args):
+    create_db(args.db)
+    print(f'Created {args.db}')
+
+
+def migrate(args):
+    size = os.path.getsize(args.db)
+    start = time.perf_counter()
+    if not migrate_db(args.db):
+        print('The database already has the current layout')
+        return
+    print(f'Moved the detections to the new tables in {time.perf_counter() - start:.1f} s, compacting...')
+    con = sqlite3.connect(args.db, isolation_level=None)
+    try:
+        con.execute('VACUUM')
+        con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        con.close()
+    print(f'{args.db}: {size / 1e6:.1f} MB -> {os.path.getsize(args.db) / 1e6:.1f} MB')
+
+
+def rebuild(args):
+    start = time.perf_counter()
+    rebuild_aggregates(args.db)
+    print(f'Rebuilt the aggregate tables in {time.perf_counter() - start:.1f} s')
+
+
+def check(args):
+    differences = check_aggregates(args.db)
+    if not differences:
+        print('The aggregate tables match the detections')
+        return
+    for table, (missing, unexpected) in differences.items():
+        print(f'{table}: {len(missing)} expected rows not found, {len(unexpected)} stored rows not expected')
+        for row in missing[:args.show]:
+            print(f'  expected {row}')
+        for row in unexpected[:args.show]:
+            print(f'  stored   {row}')
+    print('Run "db_tool.py rebuild-aggregates" to fix them')
+    sys.exit(1)
+
+
+def archive(args):
+    days = args.days if args.days is not None else get_settings().get('ARCHIVE_AFTER_DAYS', fallback='')
+    if days == '':
+        print('ARCHIVE_AFTER_DAYS is not set, nothing to archive')
+        return
+    before = (date.today() - timedelta(days=int(days))).isoformat()
+    moved = archive_detections(before, args.db)
+    for year, count in moved.items():
+        print(f'{year}: moved {count} detections to the archive')
+    if not moved:
+        print(f'No detections to archive before {before}')
+
+
+def seal(args):
+    path = seal_archive(args.year, args.db)
+    print(f'Sealed {path}: {os.path.getsize(path) / 1e6:.1f} MB, read-only')
+
+
+def snapshot(args):
+    start = time.perf_counter()
+    appended, rewritten = export_snapshot(args.db, args.rebuild)
+    print(f'Appended {appended} detections to the snapshot in {time.perf_counter() - start:.1f} s')
+    if rewritten:
+        print(f'Wrote again the months that changed: {", ".join(rewritten)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintenance of birds.db.')
+    parser.add_argument('--db', default=DB_PATH, help='Database file. Defaults to birds.db.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    create_parser = subparsers.add_parser('create', help='Create an empty database, deleting the detections that are there')
+    create_parser.set_defaults(func=create)
+
+    migrate_parser = subparsers.add_parser('migrate', help='Move the detections of an older database to the current layout')
+    migrate_parser.set_defaults(func=migrate)
+
+    rebuild_parser = subparsers.add_parser('rebuild-aggregates', help='Recompute the per-species summary tables and their triggers')
+    rebuild_parser.set_defaults(func=rebuild)
+
+    check_parser = subparsers.add_parser('check-aggregates', help='Compare the per-species summary tables with the detections')
+    check_parser.add_argument('--show', type=int, default=10, help='Number of differing rows to print per table. Defaults to 10.')
+    check_parser.set_defaults(func=check)
+
+    archive_parser = subparsers.add_parser('archive', help='Move the old detections to the archive of their year')
+    archive_parser.add_argument('--days', type=int, help='Age in days of the detections to move. Defaults to ARCHIVE_AFTER_DAYS.')
+    archive_parser.set_defaults(func=archive)
+
+    seal_parser = subparsers.add_parser('seal-archive', help='Compact the archive of a year and make it read-only')
+    seal_parser.add_argument('year', type=int, help='Year of the archive.')
+    seal_parser.set_defaults(func=seal)
+
+    snapshot_parser = subparsers.add_parser('export-snapshot', help='Update the Parquet snapshot of the detections read by the charts')
+    snapshot_parser.add_argument('--rebuild', action='store_true', help='Write all the months again.')
+    snapshot_parser.set_defaults(func=snapshot)
+
+    args = parser.parse_args()
+    args.func(args)
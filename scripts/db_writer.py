@@ -0,0 +1,55 @@
+import argparse
+import logging
+import signal
+import sqlite3
+import sys
+import threading
+
+from utils.db import WriterClient, WriterServer
+
+log = logging.getLogger(__name__)
+
+
+def serve(args):
+    server = WriterServer()
+    # shutdown() waits for serve_forever() to return, so it is called from another thread
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda sig_num, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda sig_num, frame: stop.set())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    log.info('Listening on %s', server.server_address)
+    stop.wait()
+    log.info('Shutting down')
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def execute(args):
+    client = WriterClient()
+    try:
+        rowcount = client.execute(args.sql, [args.params])
+    except sqlite3.Error as e:
+        print(f'Error: {e}', file=sys.stderr)
+        sys.exit(1)
+    finally:
+        client.close()
+    print(f'{rowcount} rows changed')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='The database writer: owns the only write connection to birds.db.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Run the writer')
+    serve_parser.set_defaults(func=serve)
+
+    exec_parser = subparsers.add_parser('exec', help='Run a write statement through the writer (or directly when it is not running)')
+    exec_parser.add_argument('sql', help='INSERT, UPDATE or DELETE statement, with ? placeholders.')
+    exec_parser.add_argument('params', nargs='*', help='Values for the placeholders.')
+    exec_parser.set_defaults(func=execute)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='[%(name)s][%(levelname)s] %(message)s')
+    args = parser.parse_args()
+    args.func(args)
@@ -21,7 +21,7 @@ $chart2 = "Combo2-$theDate.png";
 $db = new SQLite3('./scripts/birds.db', SQLITE3_OPEN_READONLY);
 $db->busyTimeout(1000);
 
-$statement1 = $db->prepare("SELECT COUNT(*) FROM detections WHERE Date == \"$theDate\"");
+$statement1 = $db->prepare("SELECT IFNULL(SUM(Count), 0) AS Count FROM species_hourly WHERE Date == \"$theDate\"");
 ensure_db_ok($statement1);
 $result1 = $statement1->execute();
 $totalcount = $result1->fetchArray(SQLITE3_ASSOC);
@@ -34,13 +34,14 @@ if(isset($_GET['blocation']) ) {
 	header("Expires: 0");
 
 	$list = array ();
+	$db_all = get_detections_all("Date == \"$theDate\"", $theDate, $theDate);
 
 	//$hrsinday = intval(($sunset-$sunrise)/60/60);
 	$hrsinday = 24;
 	for($i=0;$i<$hrsinday;$i++) {
 		$starttime = strtotime("12 AM") + (3600*$i);
 
-		$statement1 = $db->prepare("SELECT DISTINCT(Com_Name), COUNT(*) FROM detections WHERE Date == \"$theDate\" AND Time > '".date("H:i", $starttime)."' AND Time < '".date("H:i",$starttime + 3600)."' AND Confidence > 0.75 GROUP By Com_Name ORDER BY COUNT(*) DESC");
+		$statement1 = $db_all->prepare("SELECT DISTINCT(Com_Name), COUNT(*) FROM detections_all WHERE Date == \"$theDate\" AND Time > '".date("H:i", $starttime)."' AND Time < '".date("H:i",$starttime + 3600)."' AND Confidence > 0.75 GROUP By Com_Name ORDER BY COUNT(*) DESC");
 		ensure_db_ok($statement1);
 		$result1 = $statement1->execute();
 
@@ -138,7 +139,7 @@ function submitID() {
 <table class="overview">
   <tr>
     <th>Total Detections For The Day</th>
-    <td><?php echo $totalcount['COUNT(*)']; ?></td>
+    <td><?php echo $totalcount['Count']; ?></td>
     <td style="padding:unset"><img src="images/spinner.gif" id="SwipeSpinner" hidden style="height:30px;"></td>
   </tr>
 </table>
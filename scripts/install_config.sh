@@ -47,12 +47,71 @@ MODEL=BirdNET_GLOBAL_6K_V2.4_Model_FP16
 SF_THRESH=0.03
 DATA_MODEL_VERSION=1
 
+## MAX_BATCH_SIZE is the maximum number of audio chunks that are sent to the
+## model in a single inference call.
+
+MAX_BATCH_SIZE=8
+
+## RESAMPLER is used for recordings that are not at the sample rate of the
+## model (e.g. Perch at 32 kHz). polyphase is a cached in-process resampler,
+## any other value is passed to librosa as res_type (e.g. kaiser_fast).
+
+RESAMPLER=polyphase
+
+## BACKLOG_WORKERS is the number of processes that analyze the recordings that
+## piled up while the analysis service was not running. Each process loads its
+## own copy of the model, so only raise this on systems with enough memory.
+
+BACKLOG_WORKERS=1
+
+## ANALYSIS_WORKERS is the number of threads that analyze new recordings, each
+## with its own copy of the model. With several RTSP streams, set this up to
+## the number of cores so that the streams are analyzed in parallel.
+
+ANALYSIS_WORKERS=1
+
+## REPORTING_QUEUE_DEPTH is the number of analyzed recordings that can wait for
+## their extractions, database writes, notifications and uploads before the
+## analysis pauses.
+
+REPORTING_QUEUE_DEPTH=4
+
+## PREFETCH_FILES is the number of recordings each analysis worker decodes ahead,
+## while the current one is analysed. Each one takes RECORDING_LENGTH seconds of
+## audio in memory, and a live recording waits behind them.
+
+PREFETCH_FILES=1
+
+## ACTIVITY_THRESHOLD skips the analysis of (near-)silent chunks, to save CPU.
+## A chunk is only analysed when its sound level in the 1-10 kHz bird band is
+## above this level, in dBFS (e.g. -80). Leave empty to analyse every chunk.
+
+ACTIVITY_THRESHOLD=
+
+## SPECIES_GRID is a species occurrence grid built with scripts/species_grid.py,
+## for stations that move around. Locations within the grid are looked up in it
+## instead of running the occurrence model. Leave empty to not use a grid.
+
+SPECIES_GRID=
+
+## ARCHIVE_AFTER_DAYS moves the detections older than this many days out of birds.db,
+## into one database per year in scripts/archive. The charts, counts and recordings still include
+## them, but they can no longer be deleted or changed. Leave empty to keep all the detections
+## in birds.db.
+
+ARCHIVE_AFTER_DAYS=
+
 #---------------------  BirdWeather Station Information -----------------------#
 #_____________The variable below can be set to have your BirdNET-Pi____________#
 #__________________also act as a BirdWeather listening station_________________#
 
 BIRDWEATHER_ID=
 
+## BIRDWEATHER_OUTBOX_MB caps the recordings kept while BirdWeather cannot be
+## reached, in megabytes. The oldest are dropped first.
+
+BIRDWEATHER_OUTBOX_MB=200
+
 #-----------------------  Web Interface User Password  ------------------------#
 #____________________The variable below sets the 'birdnet'_____________________#
 #___________________user password for the Live Audio Stream,___________________#
@@ -246,7 +305,8 @@ EXTRACTION_LENGTH=
 ## mp2 mp3 nist ogg paf prc pvf raw s1 s16 s2 s24 s3 s32 s4 s8 sb sd2 sds sf sl
 ## sln smp snd sndfile sndr sndt sou sox sph sw txw u1 u16 u2 u24 u3 u32 u4 u8
 ## ub ul uw vms voc vorbis vox w64 wav wavpcm wv wve xa xi
-## Note: Most have not been tested.
+## Note: Most have not been tested. wav, flac, ogg, vorbis, mp3, aif, aiff, au,
+## caf and w64 are written by BirdNET-Pi itself, the others by sox.
 
 AUDIOFMT=mp3
 
@@ -276,6 +336,13 @@ AUTOMATIC_UPDATE=0
 
 RAW_SPECTROGRAM=0
 
+## LAZY_SPECTROGRAMS=1 renders the spectrogram of a detection when it is first
+## viewed instead of when its clip is extracted. They are kept in a cache of
+## SPECTROGRAM_CACHE_MB megabytes, the least recently viewed are removed first.
+
+LAZY_SPECTROGRAMS=0
+SPECTROGRAM_CACHE_MB=500
+
 ## CUSTOM_IMAGE and CUSTOM_IMAGE_TITLE allow you to show a custom image on the
 ## Overview page of your BirdNET-Pi. This can be used to show a dynamically 
 ## updating picture of your garden, for example.
@@ -62,6 +62,41 @@ EOF
   ln -sf $HOME/BirdNET-Pi/templates/$TMP_MOUNT /usr/lib/systemd/system
 }
 
+install_db_writer_service() {
+  cat << EOF > $HOME/BirdNET-Pi/templates/birdnet_db_writer.service
+[Unit]
+Description=BirdNET Database Writer
+Before=birdnet_analysis.service
+[Service]
+Restart=always
+Type=simple
+RestartSec=2
+User=${USER}
+ExecStart=$HOME/BirdNET-Pi/birdnet/bin/python3 /usr/local/bin/db_writer.py serve
+[Install]
+WantedBy=multi-user.target
+EOF
+  ln -sf $HOME/BirdNET-Pi/templates/birdnet_db_writer.service /usr/lib/systemd/system
+  systemctl enable birdnet_db_writer.service
+}
+
+install_spectrogram_renderer_service() {
+  cat << EOF > $HOME/BirdNET-Pi/templates/spectrogram_renderer.service
+[Unit]
+Description=BirdNET-Pi Spectrogram Renderer
+[Service]
+Restart=always
+Type=simple
+RestartSec=3
+User=${USER}
+ExecStart=$HOME/BirdNET-Pi/birdnet/bin/python3 /usr/local/bin/spectrogram_renderer.py
+[Install]
+WantedBy=multi-user.target
+EOF
+  ln -sf $HOME/BirdNET-Pi/templates/spectrogram_renderer.service /usr/lib/systemd/system
+  systemctl enable spectrogram_renderer.service
+}
+
 install_tmp_mount() {
   STATE=$(systemctl is-enabled tmp.mount 2>&1 | grep -E '(enabled|disabled|static)')
   ! [ -f /usr/share/systemd/tmp.mount ] && echo "Warning: no /usr/share/systemd/tmp.mount found"
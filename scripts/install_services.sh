@@ -161,6 +161,12 @@ http:// ${BIRDNETPI_URL} {
   root * ${EXTRACTED}
   file_server browse
   handle /By_Date/* {
+    # the spectrograms that are not rendered yet
+    @spectrogram {
+      path *.png
+      not file
+    }
+    reverse_proxy @spectrogram localhost:8090
     file_server browse
   }
   handle /Charts/* {
@@ -197,6 +203,12 @@ http:// ${BIRDNETPI_URL} {
   root * ${EXTRACTED}
   file_server browse
   handle /By_Date/* {
+    # the spectrograms that are not rendered yet
+    @spectrogram {
+      path *.png
+      not file
+    }
+    reverse_proxy @spectrogram localhost:8090
     file_server browse
   }
   handle /Charts/* {
@@ -265,7 +277,7 @@ Restart=always
 RestartSec=10
 Type=simple
 User=${USER}
-ExecStart=/usr/local/bin/spectrogram.sh
+ExecStart=$PYTHON_VIRTUAL_ENV /usr/local/bin/spectrogram_viewer.py
 [Install]
 WantedBy=multi-user.target
 EOF
@@ -412,11 +424,13 @@ install_services() {
   install_scripts
   install_Caddyfile
   install_avahi_aliases
+  install_db_writer_service
   install_birdnet_analysis
   install_birdnet_stats_service
   install_recording_service
   install_custom_recording_service # But does not enable
   install_spectrogram_service
+  install_spectrogram_renderer_service
   install_chart_viewer_service
   install_gotty_logs
   install_phpsysinfo
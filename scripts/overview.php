@@ -66,7 +66,9 @@ if(isset($_GET['ajax_detections']) && $_GET['ajax_detections'] == "true" && isse
     $filename = "By_Date/".$mostrecent['Date']."/".$comname."/".$mostrecent['File_Name'];
 
     // check to make sure the image actually exists, sometimes it takes a minute to be created\
-    if(file_exists($home."/BirdSongs/Extracted/".$filename.".png")){
+    // with LAZY_SPECTROGRAMS, it is rendered when it is requested
+    $lazy = isset($config['LAZY_SPECTROGRAMS']) && $config['LAZY_SPECTROGRAMS'] == 1;
+    if(file_exists($home."/BirdSongs/Extracted/".$filename.".png") || ($lazy && file_exists($home."/BirdSongs/Extracted/".$filename))){
       if($_GET['previous_detection_identifier'] == $filename) { die(); }
       if($_GET['only_name'] == "true") { echo $comname.",".$filename;die(); }
 
@@ -138,11 +140,11 @@ if(isset($_GET['ajax_detections']) && $_GET['ajax_detections'] == "true" && isse
       }
   }
   if($iterations == 0) {
-    $statement2 = $db->prepare('SELECT COUNT(*) FROM detections WHERE Date == DATE(\'now\', \'localtime\')');
+    $statement2 = $db->prepare('SELECT IFNULL(SUM(Count), 0) AS todaycount FROM species_hourly WHERE Date == DATE(\'now\', \'localtime\')');
     ensure_db_ok($statement2);
     $result2 = $statement2->execute();
     $todaycount = $result2->fetchArray(SQLITE3_ASSOC);
-    if($todaycount['COUNT(*)'] > 0) {
+    if($todaycount['todaycount'] > 0) {
       echo "<h3>Your system is currently processing a backlog of audio. This can take several hours before normal functionality of your BirdNET-Pi resumes.</h3>";
     } else {
       echo "<h3>No Detections For Today.</h3>";
@@ -290,7 +292,7 @@ $statement = $db->prepare("
 SELECT d_today.Com_Name, d_today.Sci_Name, d_today.Date, d_today.Time, d_today.Confidence, d_today.File_Name, 
        MAX(d_today.Confidence) as MaxConfidence,
        (SELECT MAX(Date) FROM detections d_prev WHERE d_prev.Sci_Name = d_today.Sci_Name AND d_prev.Date < DATE('now', 'localtime')) as LastSeenDate,
-       (SELECT COUNT(*) FROM detections d_occ WHERE d_occ.Sci_Name = d_today.Sci_Name AND d_occ.Date = DATE('now', 'localtime')) as OccurrenceCount
+       (SELECT SUM(Count) FROM species_hourly h WHERE h.Sci_Name = d_today.Sci_Name AND h.Date = DATE('now', 'localtime')) as OccurrenceCount
 FROM detections d_today
 WHERE d_today.Date = DATE('now', 'localtime')
 GROUP BY d_today.Sci_Name
@@ -20,13 +20,20 @@ if(isset($_GET['deletefile'])) {
     echo "Error";
     die();
   }
+  // the archives are not changed, their detections are counted in the aggregate tables of birds.db
+  $archive_year = get_archive_year(explode("/", $_GET['deletefile'])[2]);
+  if (isset($archive_year)) {
+    echo "Error - the detection is in the archive of $archive_year, it cannot be deleted";
+    die();
+  }
   $db_writable = new SQLite3('./scripts/birds.db', SQLITE3_OPEN_READWRITE);
   $db->busyTimeout(1000);
-  $statement1 = $db_writable->prepare('DELETE FROM detections WHERE File_Name = :file_name LIMIT 1');
+  // from the table: the changes made through the detections view are not counted
+  $statement1 = $db_writable->prepare('DELETE FROM detection_data WHERE File_Name = :file_name LIMIT 1');
   ensure_db_ok($statement1);
   $statement1->bindValue(':file_name', explode("/", $_GET['deletefile'])[2]);
   $file_pointer = $home."/BirdSongs/Extracted/By_Date/".$_GET['deletefile'];
-  if (!exec("sudo rm $file_pointer 2>&1 && sudo rm $file_pointer.png 2>&1", $output)) {
+  if (!exec("sudo rm $file_pointer 2>&1 && sudo rm -f $file_pointer.png 2>&1", $output)) {
     echo "OK";
   } else {
     echo "Error - file deletion failed : " . implode(", ", $output) . "<br>";
@@ -126,7 +133,8 @@ if(isset($_GET['shiftfile'])) {
 }
 
 if(isset($_GET['bydate'])){
-  $statement = $db->prepare('SELECT DISTINCT(Date) FROM detections GROUP BY Date ORDER BY Date DESC');
+  // the aggregates, they count the archived detections too
+  $statement = $db->prepare('SELECT DISTINCT(Date) FROM species_hourly ORDER BY Date DESC');
   ensure_db_ok($statement);
   $result = $statement->execute();
   $view = "bydate";
@@ -636,7 +644,8 @@ echo "<table>
 
   if(isset($_GET['filename'])){
     $name = $_GET['filename'];
-    $statement2 = $db->prepare("SELECT * FROM detections where File_name == \"$name\" ORDER BY Date DESC, Time DESC");
+    $file_date = preg_match('/\d{4}-\d{2}-\d{2}/', $name, $matches) ? $matches[0] : null;
+    $statement2 = get_detections_all("File_Name == \"$name\"", $file_date, $file_date)->prepare("SELECT * FROM detections_all ORDER BY Date DESC, Time DESC");
     ensure_db_ok($statement2);
     $result2 = $statement2->execute();
     $results = $result2->fetchArray(SQLITE3_ASSOC);
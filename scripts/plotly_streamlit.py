@@ -10,10 +10,14 @@ from datetime import datetime, timedelta
 from dateutil import tz
 import sqlite3
 from sqlite3 import Connection
+from urllib.parse import quote
+from urllib.request import urlopen
 import plotly.express as px
 from sklearn.preprocessing import normalize
 from suntime import Sun
-from utils.helpers import get_settings
+from utils.helpers import SPECTROGRAM_RENDERER_PORT, get_settings
+from utils.schema import archive_batches
+from utils.snapshot import read_snapshot
 
 profile = False
 debug = False
@@ -67,13 +71,17 @@ def get_connection(path: str):
 
 def get_todays_count(conn):
     today = datetime.now().strftime("%Y-%m-%d")
-    return pd.read_sql(f"SELECT COUNT(*) FROM detections WHERE Date = DATE('{today}')", con=conn)
+    return pd.read_sql(f"SELECT IFNULL(SUM(Count), 0) FROM species_hourly WHERE Date = DATE('{today}')", con=conn)
 
 
 @st.cache_data(ttl=300)
 def get_data(_conn: Connection, flush_cache):
     print_now('** get_data **')
-    df1 = pd.read_sql("SELECT Date, Time, Sci_Name, Com_Name, Confidence, File_Name FROM detections", con=_conn)
+    df1 = read_snapshot(['Date', 'Time', 'Sci_Name', 'Com_Name', 'Confidence', 'File_Name'], db_path=URI_SQLITE_DB)
+    if df1 is None:
+        # the chart viewer has not exported the snapshot yet, or is writing it again
+        df1 = pd.concat([pd.read_sql("SELECT Date, Time, Sci_Name, Com_Name, Confidence, File_Name FROM detections_all", con=_conn)
+                         for _ in archive_batches(_conn)], ignore_index=True)
     return df1
 
 
@@ -116,6 +124,15 @@ else:
                                              help='Select start and end date, if same date get a clockplot for a single day')
 
 
+def spectrogram_image(clip):
+    # not there with LAZY_SPECTROGRAMS until it is viewed, the spectrogram_renderer makes it
+    png_file = userDir + '/BirdSongs/Extracted/By_Date/' + clip + '.png'
+    if os.path.isfile(png_file):
+        return png_file
+    with urlopen(f'http://localhost:{SPECTROGRAM_RENDERER_PORT}/By_Date/{quote(clip)}.png', timeout=30) as response:
+        return response.read()
+
+
 @st.cache_data()
 def date_filter(df, start_date, end_date):
     print_now('** date_filter **')
@@ -392,7 +409,7 @@ if daily is False:
                     date_specie = df2.loc[df2['File_Name'] == recording, ['Date', 'Com_Name', 'Directory']]
                     date_dir = date_specie['Date'].values[0]
                     specie_dir = date_specie['Directory'].values[0].replace(" ", "_").replace("'", "")
-                    st.image(userDir + '/BirdSongs/Extracted/By_Date/' + date_dir + '/' + specie_dir + '/' + recording + '.png')
+                    st.image(spectrogram_image(date_dir + '/' + specie_dir + '/' + recording))
                     st.audio(userDir + '/BirdSongs/Extracted/By_Date/' + date_dir + '/' + specie_dir + '/' + recording)
                 except Exception:
                     st.info('Recording not available')
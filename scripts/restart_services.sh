@@ -9,8 +9,10 @@ sudo systemctl stop birdnet_recording.service
 
 services=(chart_viewer.service
   spectrogram_viewer.service
+  spectrogram_renderer.service
   icecast2.service
   birdnet_recording.service
+  birdnet_db_writer.service
   birdnet_analysis.service
   birdnet_log.service
   birdnet_stats.service)
@@ -5,7 +5,7 @@ import sys
 
 from utils import notifications
 from utils.helpers import get_settings
-from utils.db import get_latest
+from utils.db import DetectionRecord, get_latest
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -33,10 +33,10 @@ if __name__ == "__main__":
     d = get_latest()
     if not d:
         now = datetime.datetime.now()
-        d = {'Sci_Name': 'Aptenodytes patagonicus', 'Com_Name': 'King Penguin', 'Confidence': 0.84, 'File_Name': 'this_is_not_a_file.mp3',
-             'Date': now.strftime('%Y-%m-%d'), 'Time': now.strftime("%H:%M:%S"), 'Week': now.isocalendar()[1],
-             'Lat': conf.getfloat('LATITUDE'), 'Lon': conf.getfloat('LONGITUDE'), 'Cutoff': conf.getfloat('CONFIDENCE'),
-             'Sens': conf.getfloat('SENSITIVITY'), 'Overlap': conf.getfloat('OVERLAP')}
+        d = DetectionRecord(Date=now.strftime('%Y-%m-%d'), Time=now.strftime("%H:%M:%S"), Sci_Name='Aptenodytes patagonicus',
+                            Com_Name='King Penguin', Confidence=0.84, Lat=conf.getfloat('LATITUDE'), Lon=conf.getfloat('LONGITUDE'),
+                            Cutoff=conf.getfloat('CONFIDENCE'), Week=now.isocalendar()[1], Sens=conf.getfloat('SENSITIVITY'),
+                            Overlap=conf.getfloat('OVERLAP'), File_Name='this_is_not_a_file.mp3')
 
-    notifications.sendAppriseNotifications(d['Sci_Name'], d['Com_Name'], d['Confidence'], round(d['Confidence'] * 100), d['File_Name'], d['Date'], d['Time'],
-                                           d['Week'], d['Lat'], d['Lon'], d['Cutoff'], d['Sens'], d['Overlap'])
+    notifications.sendAppriseNotifications(d.Sci_Name, d.Com_Name, d.Confidence, round(d.Confidence * 100), d.File_Name, d.Date, d.Time,
+                                           d.Week, d.Lat, d.Lon, d.Cutoff, d.Sens, d.Overlap)
@@ -88,6 +88,13 @@ function service_status($name) {
     <button type="submit" name="submit" value="sudo systemctl restart spectrogram_viewer.service">Restart</button>
     <button type="submit" name="submit" value="sudo systemctl disable --now spectrogram_viewer.service">Disable</button>
     <button type="submit" name="submit" value="sudo systemctl enable --now spectrogram_viewer.service">Enable</button>
+  </div>
+    <h3>Spectrogram Renderer <?php echo service_status("spectrogram_renderer.service");?></h3>
+  <div role="group" class="btn-group-center">
+    <button type="submit" name="submit" value="sudo systemctl stop spectrogram_renderer.service">Stop</button>
+    <button type="submit" name="submit" value="sudo systemctl restart spectrogram_renderer.service">Restart</button>
+    <button type="submit" name="submit" value="sudo systemctl disable --now spectrogram_renderer.service">Disable</button>
+    <button type="submit" name="submit" value="sudo systemctl enable --now spectrogram_renderer.service">Enable</button>
   </div>
     <h3>Ram drive (!experimental!) <?php echo service_status(get_service_mount_name());?></h3>
   <div role="group" class="btn-group-center">
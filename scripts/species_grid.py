@@ -0,0 +1,84 @@
+import argparse
+import os
+import statistics
+import time
+
+import numpy as np
+
+from utils.helpers import get_settings
+from utils.models import OCCURRENCE_PATH, MDataModel1, MDataModel2, SpeciesGrid
+
+
+def get_mdata_model(conf):
+    return MDataModel1(conf.getfloat('SF_THRESH')) if conf.getint('DATA_MODEL_VERSION') == 1 else MDataModel2(conf.getfloat('SF_THRESH'))
+
+
+def build(args, conf):
+    model = get_mdata_model(conf)
+    file_name = args.output or os.path.join(OCCURRENCE_PATH, f'{model.model_name}_grid.npy')
+    os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+    print(f'Computing {model.model_name} over {args.lat_min}..{args.lat_max} / {args.lon_min}..{args.lon_max}, '
+          f'step {args.step}...', flush=True)
+    model.build_grid(file_name, args.lat_min, args.lat_max, args.lon_min, args.lon_max, args.step)
+    print(f'Written to {file_name} ({os.path.getsize(file_name) / 1e6:.1f} MB)')
+    print(f'To use it, set SPECIES_GRID={os.path.abspath(file_name)} in /etc/birdnet/birdnet.conf')
+
+
+def report(args, conf):
+    grid = SpeciesGrid(args.grid)
+    model = get_mdata_model(conf)
+    if grid.model_name != model.model_name:
+        print(f'Warning: the grid is for {grid.model_name}, comparing with {model.model_name}')
+    n_lat, n_lon = grid.scores.shape[:2]
+    sf_thresh = conf.getfloat('SF_THRESH')
+    rng = np.random.default_rng(args.seed)
+
+    results = {'nearest': [], 'interpolated': []}
+    lookup_times = {'nearest': [], 'interpolated': []}
+    for _ in range(args.points):
+        lat = grid.lat_min + rng.random() * (n_lat - 1) * grid.step
+        lon = grid.lon_min + rng.random() * (n_lon - 1) * grid.step
+        week = int(rng.integers(1, model.weeks + 1))
+        direct = model.predict(lat, lon, week)
+        for name, interpolate in [('nearest', False), ('interpolated', True)]:
+            start = time.perf_counter()
+            scores = grid.lookup(lat, lon, week, interpolate)
+            lookup_times[name].append(time.perf_counter() - start)
+            error = np.abs(scores - direct)
+            expected, got = direct >= sf_thresh, scores >= sf_thresh
+            results[name].append((error.mean(), error.max(), (expected & ~got).sum(), (got & ~expected).sum()))
+
+    print(f'{args.points} random points, species list at SF_THRESH={sf_thresh}')
+    print(f'{"lookup":<14}{"mean abs err":>14}{"max abs err":>14}{"missed/point":>14}{"extra/point":>14}{"exact lists":>14}{"time":>12}')
+    for name, rows in results.items():
+        mean_err, max_err, missed, extra = zip(*rows)
+        exact = sum(1 for m, e in zip(missed, extra) if m == 0 and e == 0) / len(rows)
+        print(f'{name:<14}{statistics.mean(mean_err):>14.5f}{max(max_err):>14.4f}{statistics.mean(missed):>14.2f}'
+              f'{statistics.mean(extra):>14.2f}{exact:>14.0%}{statistics.median(lookup_times[name]) * 1e6:>9.0f} us')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute the species occurrence model over a lat/lon grid, for stations that move around.'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Compute the grid for all weeks')
+    build_parser.add_argument('--lat-min', type=float, required=True, help='Southern edge of the grid.')
+    build_parser.add_argument('--lat-max', type=float, required=True, help='Northern edge of the grid.')
+    build_parser.add_argument('--lon-min', type=float, required=True, help='Western edge of the grid.')
+    build_parser.add_argument('--lon-max', type=float, required=True, help='Eastern edge of the grid.')
+    build_parser.add_argument('--step', type=float, default=0.5, help='Grid step in degrees. Defaults to 0.5.')
+    build_parser.add_argument('--output', help='Grid file. Defaults to the model name in model/occurrence.')
+    build_parser.set_defaults(func=build)
+
+    report_parser = subparsers.add_parser('report', help='Compare grid lookups with direct inference at random points')
+    report_parser.add_argument('grid', help='Grid file.')
+    report_parser.add_argument('--points', type=int, default=100, help='Number of random points. Defaults to 100.')
+    report_parser.add_argument('--seed', type=int, default=0, help='Random seed. Defaults to 0.')
+    report_parser.set_defaults(func=report)
+
+    args = parser.parse_args()
+    if args.command == 'build' and (args.step <= 0 or args.lat_min > args.lat_max or args.lon_min > args.lon_max):
+        build_parser.error('the step must be positive and the minimums at most the maximums')
+    args.func(args, get_settings())
@@ -82,7 +82,13 @@ function collect_species_targets(SQLite3 $db, string $species, string $home, $ba
       }
     }
   }
-  return ['count'=>$count, 'files'=>array_keys($files), 'dirs'=>array_values(array_unique($dirs)), 'sci'=>$sci];
+  // the archived detections are counted in species_totals, not in detections
+  $stmt = $db->prepare('SELECT Count FROM species_totals WHERE Sci_Name = :name');
+  ensure_db_ok($stmt);
+  $stmt->bindValue(':name', $species, SQLITE3_TEXT);
+  $total = $stmt->execute()->fetchArray(SQLITE3_ASSOC);
+  $archived = $total ? max(0, $total['Count'] - $count) : 0;
+  return ['count'=>$count, 'archived'=>$archived, 'files'=>array_keys($files), 'dirs'=>array_values(array_unique($dirs)), 'sci'=>$sci];
 }
 
 /* ---------- toggle exclude/whitelist/confirmed ---------- */
@@ -111,7 +117,7 @@ if (isset($_GET['getcounts'])) {
   if ($base === false) { http_response_code(500); exit(json_encode(['error' => 'Base directory not found'])); }
   $species = htmlspecialchars_decode($_GET['getcounts'], ENT_QUOTES);
   $info = collect_species_targets($db, $species, $home, $base);
-  echo json_encode(['count' => $info['count'], 'files' => count($info['files'])]); exit;
+  echo json_encode(['count' => $info['count'], 'archived' => $info['archived'], 'files' => count($info['files'])]); exit;
 }
 
 /* ---------- delete ---------- */
@@ -120,6 +126,8 @@ if (isset($_GET['delete'])) {
   if ($base === false) { http_response_code(500); exit(json_encode(['error' => 'Base directory not found'])); }
   $species = htmlspecialchars_decode($_GET['delete'], ENT_QUOTES);
   $info = collect_species_targets($db, $species, $home, $base);
+  // the archives are not changed, nothing is deleted rather than a part of the species
+  if ($info['archived'] > 0) { http_response_code(409); exit(json_encode(['error' => $info['archived'] . ' detections are archived, the species cannot be deleted'])); }
   $deleted = count($info['files']);
   foreach ($info['dirs'] as $dir) {
     if (exec("sudo rm -r $dir 2>&1", $output)) {
@@ -127,7 +135,7 @@ if (isset($_GET['delete'])) {
 	  exit;
     }
   }
-  $del = $db->prepare('DELETE FROM detections WHERE Sci_Name = :name');
+  $del = $db->prepare('DELETE FROM detection_data WHERE Species IN (SELECT id FROM species WHERE Sci_Name = :name)');
   ensure_db_ok($del);
   $del->bindValue(':name', $species, SQLITE3_TEXT);
   $del->execute();
@@ -144,9 +152,8 @@ if (isset($_GET['delete'])) {
 
 /* ---------- query species aggregates ---------- */
 $sql = <<<SQL
-SELECT Com_Name, Sci_Name, COUNT(*) AS Count, MAX(Confidence) AS MaxConfidence, MAX(Date) AS LastSeen
-FROM detections
-GROUP BY Sci_Name;
+SELECT Com_Name, Sci_Name, Count, MaxConfidence, LastDate AS LastSeen
+FROM species_totals;
 SQL;
 $result = $db->query($sql);
 ?>
@@ -338,9 +345,10 @@ function deleteSpecies(species) {
   let parts = species.split(' + '); let sci_species = parts[0]; let com_species = parts[1];
   get(scriptsBase + 'species_tools.php?getcounts=' + encodeURIComponent(sci_species)).then(t => {
     let info; try { info = JSON.parse(t); } catch { alert('Could not parse count response'); return; }
+    if (info.archived > 0) { alert(info.archived + ' detections of ' + com_species + ' are archived, the species cannot be deleted'); return; }
     if (!confirm('Delete ' + info.count + ' detections and local audio and png files for ' + com_species + '?')) return;
     get(scriptsBase + 'species_tools.php?delete=' + encodeURIComponent(sci_species)).then(t2 => {
-      try { const res = JSON.parse(t2); alert('Deleted ' + res.lines + ' detections and ' + res.files + ' files for ' + com_species); }
+      try { const res = JSON.parse(t2); if (res.error) { alert(res.error); return; } alert('Deleted ' + res.lines + ' detections and ' + res.files + ' files for ' + com_species); }
       catch { alert('Deletion complete'); }
       location.reload();
     });
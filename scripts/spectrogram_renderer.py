@@ -0,0 +1,37 @@
+import logging
+import os
+import signal
+import sys
+import threading
+
+from utils.helpers import get_settings
+from utils.spectrogram_cache import RendererServer, SpectrogramCache
+
+log = logging.getLogger('spectrogram_renderer')
+
+
+def main():
+    conf = get_settings()
+    cache_dir = os.path.join(conf['RECS_DIR'], 'SpectrogramCache')
+    cache_mb = conf.getint('SPECTROGRAM_CACHE_MB', fallback=500)
+    cache = SpectrogramCache(cache_dir, cache_mb * 1024 * 1024)
+    log.info('%d spectrograms, %.0f MB in %s', len(cache), cache.size / 1024 / 1024, cache_dir)
+
+    server = RendererServer(conf['EXTRACTED'], cache, raw=conf['RAW_SPECTROGRAM'])
+    # shutdown() waits for serve_forever() to return, so it is called from another thread
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda sig_num, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda sig_num, frame: stop.set())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    log.info('Listening on %s:%d', *server.server_address[:2])
+    stop.wait()
+    log.info('Shutting down')
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='[%(name)s][%(levelname)s] %(message)s')
+    main()
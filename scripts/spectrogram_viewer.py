@@ -0,0 +1,54 @@
+import logging
+import os
+import sys
+import time
+
+import inotify.adapters
+import soundfile
+from inotify.constants import IN_CLOSE_WRITE
+
+from utils.helpers import ANALYZING_NOW, get_font, get_settings
+from utils.spectrogram import annotate, render, save_png
+
+log = logging.getLogger('spectrogram_viewer')
+
+
+def render_live(file_name, out_file, raw):
+    samples, rate = soundfile.read(file_name, dtype='float32', always_2d=True)
+    img = render(samples, rate, raw=raw, font_path=get_font()['path'])
+    save_png(annotate(img, '', file_name.replace(os.path.expanduser('~/'), ''), get_font()['path']), out_file)
+
+
+def main():
+    conf = get_settings()
+    out_file = os.path.join(conf['EXTRACTED'], 'spectrogram.png')
+    raw = conf['RAW_SPECTROGRAM'] == '1'
+    # the spectrogram of the recording being analysed, at most every 2/3 of a recording
+    loop_time = conf.getint('RECORDING_LENGTH') * 2 / 3
+    if not os.path.exists(ANALYZING_NOW):
+        open(ANALYZING_NOW, 'a').close()
+    i = inotify.adapters.Inotify()
+    i.add_watch(ANALYZING_NOW, mask=IN_CLOSE_WRITE)
+    next_time = 0
+    for event in i.event_gen(yield_nones=False):
+        now = time.monotonic()
+        if now <= next_time:
+            continue
+        with open(ANALYZING_NOW) as f:
+            file_name = f.read().strip()
+        if file_name and os.path.isfile(file_name):
+            start = time.perf_counter()
+            try:
+                render_live(file_name, out_file, raw)
+                log.debug('%s in %.0f ms', file_name, (time.perf_counter() - start) * 1000)
+            except (OSError, RuntimeError) as e:
+                # the recording can be removed while it is read
+                log.warning('Cannot render %s: %s', file_name, e)
+        next_time = now + loop_time
+
+
+if __name__ == '__main__':
+    level = get_settings().get('LogLevel_SpectrogramViewerService', fallback='error')
+    logging.basicConfig(stream=sys.stdout, level=getattr(logging, level.strip('"').upper(), logging.ERROR),
+                        format='[%(name)s][%(levelname)s] %(message)s')
+    main()
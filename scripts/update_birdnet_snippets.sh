@@ -78,6 +78,54 @@ if ! grep -E '^DATA_MODEL_VERSION=' /etc/birdnet/birdnet.conf &>/dev/null;then
     echo "DATA_MODEL_VERSION=1" >> /etc/birdnet/birdnet.conf
 fi
 
+if ! grep -E '^MAX_BATCH_SIZE=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "MAX_BATCH_SIZE=8" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^RESAMPLER=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "RESAMPLER=polyphase" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^BACKLOG_WORKERS=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "BACKLOG_WORKERS=1" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^ANALYSIS_WORKERS=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "ANALYSIS_WORKERS=1" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^REPORTING_QUEUE_DEPTH=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "REPORTING_QUEUE_DEPTH=4" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^PREFETCH_FILES=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "PREFETCH_FILES=1" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^ACTIVITY_THRESHOLD=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "ACTIVITY_THRESHOLD=" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^SPECIES_GRID=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "SPECIES_GRID=" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^ARCHIVE_AFTER_DAYS=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "ARCHIVE_AFTER_DAYS=" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^LAZY_SPECTROGRAMS=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "LAZY_SPECTROGRAMS=0" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^SPECTROGRAM_CACHE_MB=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "SPECTROGRAM_CACHE_MB=500" >> /etc/birdnet/birdnet.conf
+fi
+
+if ! grep -E '^BIRDWEATHER_OUTBOX_MB=' /etc/birdnet/birdnet.conf &>/dev/null;then
+  echo "BIRDWEATHER_OUTBOX_MB=200" >> /etc/birdnet/birdnet.conf
+fi
+
 if ! grep -E '^BIRDNET_USER=' /etc/birdnet/birdnet.conf &>/dev/null;then
   echo "## BIRDNET_USER is for scripts to easily find where BirdNET-Pi is installed" >> /etc/birdnet/birdnet.conf
   echo "## DO NOT EDIT!" >> /etc/birdnet/birdnet.conf
@@ -196,6 +244,30 @@ if ! [ -f "$HOME/BirdNET-Pi/templates/$TMP_MOUNT" ]; then
    chown $USER:$USER "$HOME/BirdNET-Pi/templates/$TMP_MOUNT"
 fi
 
+if ! [ -f "$HOME/BirdNET-Pi/templates/birdnet_db_writer.service" ]; then
+  ln -sf $my_dir/db_writer.py /usr/local/bin/
+  install_db_writer_service
+  systemctl daemon-reload && systemctl start birdnet_db_writer.service
+fi
+
+if grep -q 'spectrogram.sh' "$HOME/BirdNET-Pi/templates/spectrogram_viewer.service" &>/dev/null; then
+  ln -sf $my_dir/spectrogram_viewer.py /usr/local/bin/
+  sed -i "s|ExecStart=.*|ExecStart=$HOME/BirdNET-Pi/birdnet/bin/python3 /usr/local/bin/spectrogram_viewer.py|" "$HOME/BirdNET-Pi/templates/spectrogram_viewer.service"
+  systemctl daemon-reload && systemctl restart spectrogram_viewer.service
+fi
+if [ -L /usr/local/bin/spectrogram.sh ];then
+  rm -f /usr/local/bin/spectrogram.sh
+fi
+
+if ! [ -f "$HOME/BirdNET-Pi/templates/spectrogram_renderer.service" ]; then
+  ln -sf $my_dir/spectrogram_renderer.py /usr/local/bin/
+  install_spectrogram_renderer_service
+  systemctl daemon-reload && systemctl start spectrogram_renderer.service
+fi
+if ! grep -q 'localhost:8090' /etc/caddy/Caddyfile &>/dev/null; then
+  sudo /usr/local/bin/update_caddyfile.sh > /dev/null 2>&1
+fi
+
 if grep -q -e '-P log' $HOME/BirdNET-Pi/templates/birdnet_log.service ; then
   sed -i "s/-P log/--path log/" ~/BirdNET-Pi/templates/birdnet_log.service
   systemctl daemon-reload && restart_services.sh
@@ -246,7 +318,7 @@ if [ -L /usr/local/bin/birdnet_analysis.sh ];then
 fi
 
 # Clean state and update cron if all scripts are not installed
-if [ "$(grep -o "#birdnet" /etc/crontab | wc -l)" -lt 6 ]; then
+if [ "$(grep -o "#birdnet" /etc/crontab | wc -l)" -lt 7 ]; then
   sudo sed -i '/birdnet/,+1d' /etc/crontab
   sed "s/\$USER/$USER/g" "$HOME"/BirdNET-Pi/templates/cleanup.cron >> /etc/crontab
   sed "s/\$USER/$USER/g" "$HOME"/BirdNET-Pi/templates/weekly_report.cron >> /etc/crontab
@@ -265,9 +337,11 @@ if [ -L $HOME/BirdNET-Pi/model/labels.txt ]; then
   sudo_with_user install_language_label.sh
 fi
 
-sqlite3 $HOME/BirdNET-Pi/scripts/birds.db << EOF
-CREATE INDEX IF NOT EXISTS "detections_Sci_Name" ON "detections" ("Sci_Name");
-EOF
+if [ "$(sqlite3 $HOME/BirdNET-Pi/scripts/birds.db "SELECT type FROM sqlite_master WHERE name = 'detections'")" == "table" ]; then
+  # the services are restarted below
+  systemctl stop birdnet_analysis.service birdnet_db_writer.service
+  sudo_with_user $HOME/BirdNET-Pi/birdnet/bin/python3 $HOME/BirdNET-Pi/scripts/db_tool.py migrate
+fi
 
 # update snippets above
 
@@ -13,6 +13,12 @@ http:// ${BIRDNETPI_URL} {
   root * ${EXTRACTED}
   file_server browse
   handle /By_Date/* {
+    # the spectrograms that are not rendered yet
+    @spectrogram {
+      path *.png
+      not file
+    }
+    reverse_proxy @spectrogram localhost:8090
     file_server browse
   }
   handle /Charts/* {
@@ -49,6 +55,12 @@ http:// ${BIRDNETPI_URL} {
   root * ${EXTRACTED}
   file_server browse
   handle /By_Date/* {
+    # the spectrograms that are not rendered yet
+    @spectrogram {
+      path *.png
+      not file
+    }
+    reverse_proxy @spectrogram localhost:8090
     file_server browse
   }
   handle /Charts/* {
@@ -1,17 +1,26 @@
+import functools
 import logging
+import math
 import os
+import threading
 import time
 
-import librosa
 import numpy as np
+import soundfile
+from numpy.lib.stride_tricks import sliding_window_view
 
 from .classes import Detection, ParseFileName
-from .helpers import get_settings, get_language
+from .helpers import get_settings, get_language, MODEL_PATH
 from .models import get_model
 
 log = logging.getLogger(__name__)
 
 MODEL = None
+SPECIES_FILTERS = {}
+
+# chunks seen and skipped by the activity gate, since start-up
+GATE_COUNTS = {'chunks': 0, 'skipped': 0}
+_gate_lock = threading.Lock()
 
 
 def loadCustomSpeciesList(path):
@@ -23,32 +32,129 @@ def loadCustomSpeciesList(path):
     return species_list
 
 
+class SpeciesFilter:
+    """The include, exclude and whitelist species lists as masks over the labels of a model, and the common names.
+
+    The files are only read again when their mtime changes.
+    """
+    INCLUDE, EXCLUDE, OCCURRENCE = 1, 2, 3
+    REASONS = {
+        INCLUDE: "Excluded as INCLUDE_LIST is active but this species is not in it: %s %s",
+        EXCLUDE: "Excluded as species in EXCLUDE_LIST: %s %s",
+        OCCURRENCE: "Excluded as below Species Occurrence Frequency Threshold: %s %s",
+    }
+
+    def __init__(self, labels):
+        self.labels = labels
+        self._label_index = {label: i for i, label in enumerate(labels)}
+        self._files = {}
+
+    def _load(self, path, loader):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        cached = self._files.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = self._files[path] = (mtime, loader(path))
+        return cached[1]
+
+    def _species_mask(self, path):
+        # None for an empty list
+        species = loadCustomSpeciesList(path)
+        if not species:
+            return None
+        mask = np.zeros(len(self.labels), dtype=bool)
+        mask[[self._label_index[name] for name in species if name in self._label_index]] = True
+        return mask
+
+    def species_mask(self, name):
+        return self._load(os.path.expanduser(f'~/BirdNET-Pi/{name}_species_list.txt'), self._species_mask)
+
+    def names(self, language):
+        return self._load(os.path.join(MODEL_PATH, f'l18n/labels_{language}.json'), lambda path: get_language(language))
+
+    def exclusions(self, predicted=None):
+        # Per label, 0 or the reason it is excluded. predicted is the mask of the expected species, None when not filtering
+        include, exclude, whitelist = (self.species_mask(name) for name in ('include', 'exclude', 'whitelist'))
+        reasons = np.zeros(len(self.labels), dtype='int8')
+        # in reverse order of precedence
+        if predicted is not None:
+            reasons[~(predicted if whitelist is None else predicted | whitelist)] = self.OCCURRENCE
+        if exclude is not None:
+            reasons[exclude] = self.EXCLUDE
+        if include is not None:
+            reasons[~include] = self.INCLUDE
+        return reasons
+
+
+def get_species_filter(model):
+    if model.model_name not in SPECIES_FILTERS:
+        SPECIES_FILTERS[model.model_name] = SpeciesFilter(model.labels)
+    return SPECIES_FILTERS[model.model_name]
+
+
 def splitSignal(sig, rate, overlap, seconds=3.0, minlen=1.5):
-    # Split signal with overlap
-    sig_splits = []
-    for i in range(0, len(sig), int((seconds - overlap) * rate)):
-        split = sig[i:i + int(seconds * rate)]
+    # Split signal with overlap into a (n_chunks, samples) float32 matrix
+    size = int(seconds * rate)
+    step = int((seconds - overlap) * rate)
+
+    # Chunks shorter than minlen at the end of the signal are dropped
+    starts = np.arange(0, len(sig), step)
+    starts = starts[len(sig) - starts >= int(minlen * rate)]
+
+    chunks = np.zeros((len(starts), size), dtype='float32')
+    n_full = np.count_nonzero(starts + size <= len(sig))
+    if n_full:
+        chunks[:n_full] = sliding_window_view(sig, size)[::step][:n_full]
 
-        # End of signal?
-        if len(split) < int(minlen * rate):
-            break
+    # Signal chunk too short? Fill with zeros.
+    for i in range(n_full, len(starts)):
+        split = sig[starts[i]:]
+        chunks[i, :len(split)] = split
 
-        # Signal chunk too short? Fill with zeros.
-        if len(split) < int(rate * seconds):
-            temp = np.zeros((int(rate * seconds)))
-            temp[:len(split)] = split
-            split = temp
+    return chunks
+
+
+@functools.lru_cache(maxsize=None)
+def polyphaseFilter(up, down):
+    # Low-pass FIR for resampling by up/down, designed once per ratio and reused across files
+    from scipy.signal import firwin
+    max_rate = max(up, down)
+    return firwin(2 * 16 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 8.6))
 
-        sig_splits.append(split)
 
-    return sig_splits
+def resample(sig, rate, sample_rate):
+    from scipy.signal import resample_poly
+    gcd = math.gcd(rate, sample_rate)
+    up, down = sample_rate // gcd, rate // gcd
+    return resample_poly(sig, up, down, window=polyphaseFilter(up, down)).astype('float32', copy=False)
 
 
-def readAudioData(path, overlap, sample_rate, chunk_duration):
+def decodeAudio(path, sample_rate, resampler='polyphase'):
+    # Fast path: read the PCM directly and resample it in-process if needed
+    try:
+        with soundfile.SoundFile(path) as sf:
+            if sf.samplerate == sample_rate or resampler == 'polyphase':
+                sig = sf.read(dtype='float32')
+                if sig.ndim > 1:
+                    sig = sig.mean(axis=1, dtype='float32')
+                if sf.samplerate != sample_rate:
+                    sig = resample(sig, sf.samplerate, sample_rate)
+                return sig, sample_rate
+    except RuntimeError as e:
+        log.debug('Cannot read %s with soundfile: %s', path, e)
+
+    # Open file with librosa (uses ffmpeg or libav), imported here as it is slow to import
+    import librosa
+    res_type = 'kaiser_fast' if resampler == 'polyphase' else resampler
+    return librosa.load(path, sr=sample_rate, mono=True, res_type=res_type)
+
+
+def readAudioData(path, overlap, sample_rate, chunk_duration, resampler='polyphase'):
     log.info('READING AUDIO DATA...')
 
-    # Open file with librosa (uses ffmpeg or libav)
-    sig, rate = librosa.load(path, sr=sample_rate, mono=True, res_type='kaiser_fast')
+    sig, rate = decodeAudio(path, sample_rate, resampler)
 
     # Split audio into chunks
     chunks = splitSignal(sig, rate, overlap, seconds=chunk_duration)
@@ -58,36 +164,71 @@ def readAudioData(path, overlap, sample_rate, chunk_duration):
     return chunks
 
 
-def analyzeAudioData(chunks, overlap, lat, lon, week):
-    detections = []
-    model = load_global_model()
+def to_dbfs(rms):
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def chunkActivity(chunks, rate, threshold, band=(1000, 10000)):
+    # Mask of the chunks with a RMS in the bird band above threshold (dBFS)
+    # The band energy cannot exceed the total energy, so the FFT is only needed for chunks loud enough overall
+    rms = np.sqrt(np.mean(np.square(chunks, dtype='float64'), axis=-1))
+    active = to_dbfs(rms) > threshold
+    if active.any():
+        spectrum = np.fft.rfft(chunks[active], axis=-1)
+        freqs = np.fft.rfftfreq(chunks.shape[-1], 1 / rate)
+        in_band = (freqs >= band[0]) & (freqs <= band[1])
+        # Parseval: the RMS of the band-limited signal
+        band_rms = np.sqrt(2 * np.sum(np.abs(spectrum[:, in_band]) ** 2, axis=-1)) / chunks.shape[-1]
+        active[active] = to_dbfs(band_rms) > threshold
+    return active
+
+
+def analyzeAudioData(chunks, overlap, lat, lon, week, model=None):
+    if model is None:
+        model = load_global_model()
 
     start = time.time()
     log.info('ANALYZING AUDIO...')
 
     model.set_meta_data(lat, lon, week)
-    predicted_species_list = model.get_species_list()
-
-    # Parse every chunk
-    for chunk in chunks:
-        p = model.predict(chunk)
-        log.debug("PPPPP: %s", p)
-        detections.append(p)
+    predicted_species = model.get_species_mask()
+
+    # Skip (near-)silent chunks, they are recorded without predictions
+    threshold = get_settings().get('ACTIVITY_THRESHOLD')
+    active = np.ones(len(chunks), dtype=bool)
+    if threshold:
+        active = chunkActivity(chunks, model.sample_rate, float(threshold))
+        with _gate_lock:
+            GATE_COUNTS['chunks'] += len(chunks)
+            GATE_COUNTS['skipped'] += len(chunks) - active.sum()
+            log.info('SKIPPED %d OF %d CHUNKS (%d OF %d SINCE START)', len(chunks) - active.sum(), len(chunks),
+                     GATE_COUNTS['skipped'], GATE_COUNTS['chunks'])
+
+    # Parse all active chunks, batched
+    scores = np.zeros((len(chunks), len(model.labels)), dtype='float32')
+    scores[active] = model.predict_batch(chunks if active.all() else chunks[active])
+    log.debug("PPPPP: %s", scores)
+
+    # the chunks with humans and the skipped ones have no predictions, rather than labels at random with a score of 0
+    keep = filter_humans(scores, model.human_indices, active) & active
+    indices, scores = model.label(scores)
 
     labeled = {}
     pred_start = 0.0
-    for p in filter_humans(detections):
+    for p, kept in zip(zip(indices, scores), keep):
         # Save timestamp and result
         pred_end = pred_start + model.chunk_duration
-        labeled[str(pred_start) + ';' + str(pred_end)] = p
+        if kept:
+            labeled[str(pred_start) + ';' + str(pred_end)] = p
 
         pred_start = pred_end - overlap
 
     log.info('DONE! Time %.2f SECONDS', time.time() - start)
-    return labeled, predicted_species_list
+    return labeled, predicted_species
 
 
-def filter_humans(predictions):
+def filter_humans(scores, human_indices, active=None):
+    # the mask of the chunks that are kept: the others have a human among their best labels, or next to them
     conf = get_settings()
     priv_thresh = conf.getfloat('PRIVACY_THRESHOLD')
     human_cutoff = max(10, int(6000 * priv_thresh / 100.0))
@@ -99,32 +240,25 @@ def filter_humans(predictions):
     except ValueError:
         pass
 
-    # mask for humans
-    human_mask = [False] * len(predictions)
-    for i, prediction in enumerate(predictions):
-        for p in prediction[:human_cutoff]:
-            if 'Human' in p[0]:
-                human_mask[i] = True
-                break
-
-    # mask for predictions that have a human neighbour
-    human_neighbour_mask = [False] * len(predictions)
-    for i, _ in enumerate(human_mask):
-        if i != 0 and human_mask[i - 1]:
-            human_neighbour_mask[i] = True
-        if i != len(human_mask) - 1 and human_mask[i + 1]:
-            human_neighbour_mask[i] = True
-
-    clean_detections = []
-    for prediction, human, has_human_neighbour in zip(predictions, human_mask, human_neighbour_mask):
-        if human or has_human_neighbour:
-            log.debug('Overwriting prediction %s', prediction[0])
-            prediction = [('Human_Human', 0.0)]
-        else:
-            prediction = prediction[:10]
-        clean_detections.append(prediction)
-
-    return clean_detections
+    if len(human_indices) == 0:
+        return np.ones(len(scores), dtype=bool)
+
+    # mask for humans: the best human class of a chunk ranks within the cutoff,
+    # its rank being the number of labels that score higher
+    human_scores = scores[:, human_indices].max(axis=-1)
+    human_mask = (scores > human_scores[:, np.newaxis]).sum(axis=-1) < human_cutoff
+    if active is not None:
+        # skipped chunks are not human: their all-zero scores would rank the labels arbitrarily
+        human_mask &= active
+
+    # add the predictions that have a human neighbour
+    mask = human_mask.copy()
+    mask[1:] |= human_mask[:-1]
+    mask[:-1] |= human_mask[1:]
+
+    if mask.any():
+        log.debug('Dropping predictions of chunks %s', np.flatnonzero(mask))
+    return ~mask
 
 
 def load_global_model():
@@ -137,48 +271,55 @@ def load_global_model():
     return MODEL
 
 
-def run_analysis(file):
-    include_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/include_species_list.txt"))
-    exclude_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/exclude_species_list.txt"))
-    whitelist_list = loadCustomSpeciesList(os.path.expanduser("~/BirdNET-Pi/whitelist_species_list.txt"))
+def load_audio(file_name, model=None):
+    # decode and chunk a recording for the model, without analysing it yet
+    conf = get_settings()
+    if model is None:
+        model = load_global_model()
+    return readAudioData(file_name, conf.getfloat('OVERLAP'), model.sample_rate, model.chunk_duration,
+                         conf.get('RESAMPLER') or 'polyphase')
+
 
+def run_analysis(file, model=None, audio_data=None):
     conf = get_settings()
-    model = load_global_model()
-    names = get_language(conf['DATABASE_LANG'])
+    if model is None:
+        model = load_global_model()
+    species_filter = get_species_filter(model)
+    names = species_filter.names(conf['DATABASE_LANG'])
 
-    # Read audio data & handle errors
+    # Read audio data & handle errors, unless it was already decoded
     try:
-        audio_data = readAudioData(file.file_name, conf.getfloat('OVERLAP'), model.sample_rate, model.chunk_duration)
+        if audio_data is None:
+            audio_data = load_audio(file.file_name, model)
     except (NameError, TypeError) as e:
         log.error("Error with the following info: %s", e)
         return []
 
     # Process audio data and get detections
-    raw_detections, predicted_species_list = analyzeAudioData(audio_data, conf.getfloat('OVERLAP'), conf.getfloat('LATITUDE'),
-                                                              conf.getfloat('LONGITUDE'), file.week)
+    raw_detections, predicted_species = analyzeAudioData(audio_data, conf.getfloat('OVERLAP'), conf.getfloat('LATITUDE'),
+                                                         conf.getfloat('LONGITUDE'), file.week, model)
+    reasons = species_filter.exclusions(predicted_species)
+    confidence = conf.getfloat('CONFIDENCE')
     confident_detections = []
-    for time_slot, entries in raw_detections.items():
-        sci_name, confidence = entries[0]
-        log.info('%s-(%s_%s, %s)', time_slot, sci_name, names.get(sci_name, sci_name), confidence)
-        for sci_name, confidence in entries:
-            if confidence >= conf.getfloat('CONFIDENCE'):
-                com_name = names.get(sci_name, sci_name)
-                if sci_name not in include_list and len(include_list) != 0:
-                    log.warning("Excluded as INCLUDE_LIST is active but this species is not in it: %s %s", sci_name, com_name)
-                elif sci_name in exclude_list and len(exclude_list) != 0:
-                    log.warning("Excluded as species in EXCLUDE_LIST: %s %s", sci_name, com_name)
-                elif sci_name not in predicted_species_list and len(predicted_species_list) != 0 and sci_name not in whitelist_list:
-                    log.warning("Excluded as below Species Occurrence Frequency Threshold: %s %s", sci_name, com_name)
-                else:
-                    d = Detection(
-                        file.file_date,
-                        time_slot.split(';')[0],
-                        time_slot.split(';')[1],
-                        sci_name,
-                        com_name,
-                        confidence,
-                    )
-                    confident_detections.append(d)
+    for time_slot, (indices, scores) in raw_detections.items():
+        sci_name = model.labels[indices[0]]
+        log.info('%s-(%s_%s, %s)', time_slot, sci_name, names.get(sci_name, sci_name), scores[0])
+        confident = scores >= confidence
+        for index, score, reason in zip(indices[confident], scores[confident], reasons[indices[confident]]):
+            sci_name = model.labels[index]
+            com_name = names.get(sci_name, sci_name)
+            if reason:
+                log.warning(SpeciesFilter.REASONS[reason], sci_name, com_name)
+            else:
+                d = Detection(
+                    file.file_date,
+                    time_slot.split(';')[0],
+                    time_slot.split(';')[1],
+                    sci_name,
+                    com_name,
+                    score,
+                )
+                confident_detections.append(d)
     return confident_detections
 
 
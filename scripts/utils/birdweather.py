@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .helpers import get_settings
+
+log = logging.getLogger(__name__)
+
+BIRDWEATHER_URL = 'https://app.birdweather.com/api/v1'
+# statuses worth sending again later, the others will not get better
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+# a few hours of 15 s recordings with detections, about 1 MB each
+OUTBOX_MB = 200
+MAX_ATTEMPTS = 10
+BACKOFF = 30
+MAX_BACKOFF = 3600
+
+_OUTBOX = None
+
+
+class UploadError(Exception):
+    """BirdWeather refused the upload, it is not sent again"""
+
+
+class RetryError(UploadError):
+    """BirdWeather could not be reached or is busy, the upload is sent again later"""
+
+
+class Outbox:
+    """The soundscapes waiting to be uploaded, in a directory so that they survive a restart.
+
+    Each upload is a FLAC file and a JSON file with its detections. The JSON file is written last: a FLAC file
+    without one is from an interrupted put() and is removed when the outbox is opened.
+    """
+
+    def __init__(self, outbox_dir, max_bytes=OUTBOX_MB * 1024 * 1024):
+        self.outbox_dir = outbox_dir
+        self.max_bytes = max_bytes
+        # set when there is something new to send
+        self.changed = threading.Event()
+        self._lock = threading.Lock()
+        self._last = 0
+        os.makedirs(outbox_dir, exist_ok=True)
+        names = set(self.names())
+        for file_name in os.listdir(outbox_dir):
+            name, ext = os.path.splitext(file_name)
+            if ext != '.json' and name not in names:
+                os.remove(os.path.join(outbox_dir, file_name))
+
+    def _path(self, name, ext):
+        return os.path.join(self.outbox_dir, f'{name}{ext}')
+
+    def _write(self, name, ext, data):
+        tmp_file = self._path(name, f'{ext}.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file, self._path(name, ext))
+
+    def __len__(self):
+        return len(self.names())
+
+    def names(self):
+        """The uploads, the oldest first"""
+        return sorted(file_name[:-len('.json')] for file_name in os.listdir(self.outbox_dir) if file_name.endswith('.json'))
+
+    def put(self, timestamp, flac_data, detections):
+        with self._lock:
+            # increasing, so that the names sort in the order of the puts
+            self._last = max(self._last + 1, time.time_ns())
+            name = f'{self._last:020d}'
+        self._write(name, '.flac', flac_data)
+        self.update(name, {'timestamp': timestamp, 'detections': detections, 'soundscape_id': None, 'sent': 0, 'attempts': 0})
+
+        self._drop_oldest()
+        self.changed.set()
+        return name
+
+    def size(self, name):
+        size = 0
+        for ext in ['.json', '.flac']:
+            try:
+                size += os.path.getsize(self._path(name, ext))
+            except FileNotFoundError:
+                pass
+        return size
+
+    def _drop_oldest(self):
+        # the newest is kept even when it alone is over the limit
+        names = self.names()
+        sizes = [self.size(name) for name in names]
+        total = sum(sizes)
+        for old_name, size in zip(names[:-1], sizes):
+            if total <= self.max_bytes:
+                break
+            log.warning('BirdWeather outbox full, dropping %s', old_name)
+            self.remove(old_name)
+            total -= size
+
+    def load(self, name):
+        with open(self._path(name, '.json')) as f:
+            return json.load(f)
+
+    def flac(self, name):
+        with open(self._path(name, '.flac'), 'rb') as f:
+            return f.read()
+
+    def update(self, name, upload):
+        self._write(name, '.json', json.dumps(upload).encode('utf-8'))
+
+    def remove(self, name):
+        # the JSON first, the FLAC file alone is removed by the next Outbox
+        for ext in ['.json', '.flac']:
+            try:
+                os.remove(self._path(name, ext))
+            except FileNotFoundError:
+                pass
+
+
+def get_outbox():
+    global _OUTBOX
+    if _OUTBOX is None:
+        conf = get_settings()
+        _OUTBOX = Outbox(os.path.join(conf['RECS_DIR'], 'BirdWeather'), conf.getint('BIRDWEATHER_OUTBOX_MB', fallback=OUTBOX_MB) * 1024 * 1024)
+    return _OUTBOX
+
+
+class BirdWeatherUploader:
+    """Sends the uploads of the outbox in order, on a thread of its own and over one kept-alive connection.
+
+    When BirdWeather cannot be reached, the uploads stay in the outbox and are sent again after a delay
+    that doubles with each failure. An upload that fails max_attempts times is dropped.
+    """
+
+    def __init__(self, outbox, station_id, base_url=BIRDWEATHER_URL, timeout=(10, 30), max_attempts=MAX_ATTEMPTS,
+                 backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.outbox = outbox
+        self.station_url = f'{base_url}/stations/{station_id}'
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self._failures = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='birdweather_uploader')
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        # the upload being sent is finished, the others are sent after the restart
+        self._stop.set()
+        self.outbox.changed.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.session.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.outbox.changed.clear()
+            delay = self.send_pending()
+            if delay is None:
+                self.outbox.changed.wait()
+            else:
+                # the new uploads do not cut the wait short, BirdWeather is not reachable
+                self._stop.wait(delay)
+
+    def send_pending(self):
+        """Sends the outbox, returns the seconds to wait after a failure or None when it is empty"""
+        for name in self.outbox.names():
+            if self._stop.is_set():
+                return None
+            try:
+                upload = self.outbox.load(name)
+            except (OSError, ValueError) as e:
+                log.error('Cannot read BirdWeather upload %s: %s', name, e)
+                self.outbox.remove(name)
+                continue
+            if not self.send(name, upload):
+                return min(self.backoff * 2 ** (self._failures - 1), self.max_backoff)
+        return None
+
+    def send(self, name, upload):
+        """Sends one upload, False when it is to be sent again later"""
+        try:
+            if upload['soundscape_id'] is None:
+                upload['soundscape_id'] = self.post_soundscape(upload['timestamp'], self.outbox.flac(name))
+                # not sent again when a detection fails
+                self.outbox.update(name, upload)
+            for detection in upload['detections'][upload['sent']:]:
+                try:
+                    self.post_detection(dict(detection, soundscapeId=upload['soundscape_id']))
+                except RetryError:
+                    raise
+                except UploadError as e:
+                    # the other detections of the recording are sent all the same
+                    log.error('BirdWeather refused a detection of %s: %s', upload['timestamp'], e)
+                upload['sent'] += 1
+        except RetryError as e:
+            self._failures += 1
+            upload['attempts'] += 1
+            if upload['attempts'] >= self.max_attempts:
+                log.error('Cannot upload %s to BirdWeather after %d attempts, dropping it: %s', upload['timestamp'], upload['attempts'], e)
+                self.outbox.remove(name)
+            else:
+                log.warning('Cannot upload %s to BirdWeather, will try again: %s', upload['timestamp'], e)
+                self.outbox.update(name, upload)
+            return False
+        except UploadError as e:
+            log.error('BirdWeather refused %s: %s', upload['timestamp'], e)
+        except OSError as e:
+            log.error('Cannot read BirdWeather upload %s: %s', name, e)
+        self._failures = 0
+        self.outbox.remove(name)
+        return True
+
+    def _post(self, url, **kwargs):
+        try:
+            response = self.session.post(url, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise RetryError(e) from e
+        if response.status_code in RETRY_STATUS:
+            raise RetryError(f'{response.status_code} {response.reason}')
+        if response.status_code >= 400:
+            raise UploadError(f'{response.status_code} {response.reason}: {response.text[:200]}')
+        return response
+
+    def post_soundscape(self, timestamp, flac_data):
+        response = self._post(f'{self.station_url}/soundscapes?timestamp={timestamp}', data=flac_data,
+                              headers={'Content-Type': 'audio/flac'})
+        log.info("Soundscape POST Response Status - %d", response.status_code)
+        try:
+            sdata = response.json()
+        except ValueError as e:
+            raise RetryError(f'not JSON: {response.text[:200]}') from e
+        if not sdata.get('success'):
+            raise UploadError(sdata.get('message'))
+        return sdata['soundscape']['id']
+
+    def post_detection(self, data):
+        log.debug(data)
+        response = self._post(f'{self.station_url}/detections', json=data)
+        log.info("Detection POST Response Status - %d", response.status_code)
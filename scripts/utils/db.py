@@ -1,10 +1,23 @@
+import json
+import logging
+import os
+import socket
+import socketserver
 import sqlite3
+import threading
 import time as timeim
+from concurrent.futures import Future
 from datetime import datetime
+from queue import Queue
+from typing import NamedTuple
 
-from .helpers import DB_PATH
+from .helpers import DB_PATH, DB_WRITER_SOCKET
+from .schema import archive_batches, create_detections_all
+
+log = logging.getLogger(__name__)
 
 _DB = None
+_WRITER = None
 
 
 def get_db():
@@ -12,14 +25,330 @@ def get_db():
     if _DB is None:
         con = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
         con.row_factory = sqlite3.Row
+        create_detections_all(con)
         _DB = con
     return _DB
 
 
-def get_records(select_sql):
+class DetectionWriter:
+    """A long-lived connection that writes batches of statements, each batch in one transaction.
+
+    The database is switched to WAL, so the web interface reading it does not block the writer and vice versa.
+    When the database stays locked for longer than timeout seconds, the write fails.
+    """
+    insert_sql = "INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, db_path=DB_PATH, timeout=10.0):
+        self._db_path = db_path
+        self._timeout = timeout
+        self._con = None
+
+    def _connect(self):
+        # sqlite3 caches the prepared statements for as long as the connection lives
+        con = sqlite3.connect(self._db_path, timeout=self._timeout, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode only checkpoints need a fsync, not every commit
+        con.execute("PRAGMA synchronous=NORMAL")
+        return con
+
+    def execute(self, statements):
+        # statements: [(sql, params_seq)], returns the rowcount or the sqlite3.Error of each one
+        # A failing statement is rolled back on its own, the others are committed
+        if self._con is None:
+            self._con = self._connect()
+        results = []
+        try:
+            self._con.execute("BEGIN IMMEDIATE")
+            for sql, params in statements:
+                self._con.execute("SAVEPOINT statement")
+                try:
+                    results.append(self._con.executemany(sql, params).rowcount)
+                    self._con.execute("RELEASE statement")
+                except sqlite3.Error as e:
+                    self._con.execute("ROLLBACK TO statement")
+                    self._con.execute("RELEASE statement")
+                    results.append(e)
+            self._con.execute("COMMIT")
+        except sqlite3.Error:
+            # start over with a new connection next time
+            self.close()
+            raise
+        return results
+
+    def insert(self, rows):
+        result = self.execute([(self.insert_sql, rows)])[0]
+        if isinstance(result, sqlite3.Error):
+            raise result
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+
+class WriterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Owns the only write connection to the database, and writes for all clients that connect to its Unix socket.
+
+    A request is a JSON line {"sql": ..., "params": [[...], ...]}, answered by {"rowcount": n} or {"error": ...}.
+    The requests that queue up while a transaction is written are committed together in the next one.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path=DB_WRITER_SOCKET, db_path=DB_PATH, timeout=10.0):
+        if os.path.exists(socket_path):
+            # left behind by a writer that did not shut down
+            os.remove(socket_path)
+        super().__init__(socket_path, WriterRequestHandler)
+        os.chmod(socket_path, 0o660)
+        self._writer = DetectionWriter(db_path, timeout)
+        self._requests = Queue()
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.start()
+
+    def submit(self, sql, params):
+        future = Future()
+        self._requests.put((sql, params, future))
+        return future
+
+    def _write_loop(self):
+        while True:
+            batch = [self._requests.get()]
+            while not self._requests.empty():
+                batch.append(self._requests.get())
+            stop = None in batch
+            batch = [request for request in batch if request is not None]
+            if batch:
+                try:
+                    results = self._writer.execute([(sql, params) for sql, params, _ in batch])
+                except sqlite3.Error as e:
+                    results = [e] * len(batch)
+                for (_, _, future), result in zip(batch, results):
+                    if isinstance(result, sqlite3.Error):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            if stop:
+                break
+        self._writer.close()
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self._requests.put(None)
+        self._thread.join()
+        # the clients find the connection closed and connect to the next server, as when the process exits
+        with self._connections_lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def track(self, connection, open=True):
+        with self._connections_lock:
+            if open:
+                self._connections.add(connection)
+            else:
+                self._connections.discard(connection)
+
+
+class WriterRequestHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.server.track(self.connection)
+
+    def finish(self):
+        self.server.track(self.connection, open=False)
+        super().finish()
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                params = [tuple(row) for row in request.get('params', [[]])]
+                response = {'rowcount': self.server.submit(request['sql'], params).result()}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'error': f'bad request: {e!r}'}
+            except sqlite3.Error as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class WriterClient:
+    """Sends writes to the WriterServer, or writes to the database itself when the server is not running."""
+
+    def __init__(self, socket_path=DB_WRITER_SOCKET, db_path=DB_PATH, timeout=30.0):
+        self._socket_path = socket_path
+        self._db_path = db_path
+        self._timeout = timeout
+        self._sock = None
+        self._file = None
+        self._direct = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self._socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._file = sock.makefile('rwb')
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+            except OSError:
+                # what is left to flush, on a broken connection
+                pass
+            self._sock.close()
+            self._sock = None
+            self._file = None
+
+    def _execute_direct(self, sql, params):
+        if self._direct is None:
+            self._direct = DetectionWriter(self._db_path)
+        result = self._direct.execute([(sql, params)])[0]
+        if isinstance(result, sqlite3.Error):
+            raise result
+        return result
+
+    def _send(self, sql, params):
+        self._file.write(json.dumps({'sql': sql, 'params': [list(row) for row in params]}).encode('utf-8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('connection closed by the database writer')
+        return line
+
+    def execute(self, sql, params=((),)):
+        # returns the rowcount, raises sqlite3.Error when the write failed. A connection broken by a restart of
+        # the server is opened again once, and the database is written directly when the server is gone.
+        for attempt in range(2):
+            if self._sock is None:
+                try:
+                    self._connect()
+                except (FileNotFoundError, ConnectionRefusedError):
+                    return self._execute_direct(sql, params)
+                except OSError as e:
+                    raise sqlite3.OperationalError(f'database writer: {e}')
+            try:
+                line = self._send(sql, params)
+                break
+            except OSError as e:
+                self._disconnect()
+                if attempt > 0:
+                    raise sqlite3.OperationalError(f'database writer: {e}')
+                log.warning('Connection to the database writer lost, connecting again: %s', e)
+        response = json.loads(line)
+        if 'error' in response:
+            raise sqlite3.OperationalError(response['error'])
+        return response['rowcount']
+
+    def insert(self, rows):
+        self.execute(DetectionWriter.insert_sql, rows)
+
+    def close(self):
+        self._disconnect()
+        if self._direct is not None:
+            self._direct.close()
+            self._direct = None
+
+
+def get_writer():
+    global _WRITER
+    if _WRITER is None:
+        _WRITER = WriterClient()
+    return _WRITER
+
+
+# The reads, by name. Values are bound as parameters, so that the statement text stays the same
+# and sqlite3 reuses the prepared statement from the cache of the connection instead of parsing it again.
+QUERIES = {
+    'latest': "SELECT * FROM detections ORDER BY Date DESC, Time DESC LIMIT 1",
+    'count_for_day': "SELECT COUNT(*) FROM detections WHERE Date = DATE(:today) AND Sci_Name = :sci_name",
+    'count_for_week': "SELECT COUNT(*) FROM detections WHERE Date >= DATE(:today, '-7 day') AND Sci_Name = :sci_name",
+    # the last hour is not in the aggregates, it is a short range of the Date_Time index
+    'summary': "SELECT (SELECT IFNULL(SUM(Count), 0) FROM species_totals) as total_count, "
+               "(SELECT IFNULL(SUM(Count), 0) FROM species_hourly WHERE Date == DATE('now', 'localtime')) as todays_count, "
+               "(SELECT COUNT(*) FROM detection_data "
+               " WHERE Date == Date('now', 'localtime') AND TIME >= TIME('now', 'localtime', '-1 hour')) as hour_count, "
+               "(SELECT COUNT(DISTINCT(Sci_Name)) FROM species_hourly WHERE Date == Date('now','localtime')) as todays_species_tally, "
+               "(SELECT COUNT(*) FROM species_totals) as species_tally",
+    # includes the archives that archive_batches() attached for the range
+    'detections_between': "SELECT * FROM detections_all WHERE Date BETWEEN IFNULL(DATE(:start), '') AND DATE(:end) ORDER BY Date, Time",
+    # the common name of a By_Date directory, where the spaces are underscores and the apostrophes removed
+    'com_name_for_dir': "SELECT Com_Name FROM species WHERE REPLACE(REPLACE(Com_Name, '''', ''), ' ', '_') = :dir_name LIMIT 1",
+}
+
+SPECIES_ORDER = {
+    'occurrences': "SUM(Count) DESC",
+    'confidence': "MAX(MaxConfidence) DESC",
+    'date': "MIN(Date) DESC, Time DESC",
+    'name': "Com_Name ASC",
+}
+for _sort_by, _order in SPECIES_ORDER.items():
+    for _name, _where in [(f'species_by_{_sort_by}', ""), (f'species_on_date_by_{_sort_by}', "WHERE Date == :date ")]:
+        QUERIES[_name] = ("SELECT Date, Time, File_Name, Com_Name, Sci_Name, SUM(Count) as Count, MAX(MaxConfidence) as MaxConfidence "
+                          f"FROM species_hourly {_where}GROUP BY Sci_Name ORDER BY {_order}")
+
+
+class DetectionRecord(NamedTuple):
+    # a row of the detections view
+    Date: str
+    Time: str
+    Sci_Name: str
+    Com_Name: str
+    Confidence: float
+    Lat: float
+    Lon: float
+    Cutoff: float
+    Week: int
+    Sens: float
+    Overlap: float
+    File_Name: str
+
+
+class Summary(NamedTuple):
+    total_count: int
+    todays_count: int
+    hour_count: int
+    todays_species_tally: int
+    species_tally: int
+
+
+class SpeciesRecord(NamedTuple):
+    # a species with its latest detection, from the aggregates
+    Date: str
+    Time: str
+    File_Name: str
+    Com_Name: str
+    Sci_Name: str
+    Count: int
+    MaxConfidence: float
+
+
+# the rows of a named query, the others are sqlite3.Row
+RECORDS = {
+    'latest': DetectionRecord,
+    'summary': Summary,
+    'detections_between': DetectionRecord,
+}
+for _name in QUERIES:
+    if _name.startswith('species_'):
+        RECORDS[_name] = SpeciesRecord
+
+
+def get_records(select_sql, params=()):
     con = get_db()
     try:
-        cur = con.execute(select_sql)
+        cur = con.execute(select_sql, params)
         records = cur.fetchall()
     except sqlite3.Error as e:
         print(e)
@@ -28,55 +357,56 @@ def get_records(select_sql):
     return records
 
 
-def get_record(select_sql):
-    records = get_records(select_sql)
+def get_record(select_sql, params=()):
+    records = get_records(select_sql, params)
     return dict(records[0]) if records else None
 
 
+def query(name, **params):
+    # all rows, as the record of the query
+    records = get_records(QUERIES[name], params)
+    return [RECORDS[name](*row) for row in records] if name in RECORDS else records
+
+
+def query_one(name, **params):
+    # the first row, or None
+    records = query(name, **params)
+    return records[0] if records else None
+
+
+def query_value(name, default=0, **params):
+    # the first column of the first row, for counts
+    records = query(name, **params)
+    return records[0][0] if records else default
+
+
 def get_latest():
-    select_sql = "SELECT * FROM detections ORDER BY Date DESC, Time DESC LIMIT 1"
-    return get_record(select_sql)
+    return query_one('latest')
 
 
 def get_todays_count_for(sci_name):
-    today = datetime.now().strftime("%Y-%m-%d")
-    select_sql = f"SELECT COUNT(*) FROM detections WHERE Date = DATE('{today}') AND Sci_Name = '{sci_name}'"
-    records = get_records(select_sql)
-    return records[0][0] if records else 0
+    return query_value('count_for_day', today=datetime.now().strftime("%Y-%m-%d"), sci_name=sci_name)
 
 
 def get_this_weeks_count_for(sci_name):
-    today = datetime.now().strftime("%Y-%m-%d")
-    select_sql = f"SELECT COUNT(*) FROM detections WHERE Date >= DATE('{today}', '-7 day') AND Sci_Name = '{sci_name}'"
-    records = get_records(select_sql)
-    return records[0][0] if records else 0
+    return query_value('count_for_week', today=datetime.now().strftime("%Y-%m-%d"), sci_name=sci_name)
 
 
 def get_summary():
-    total_count = get_record("SELECT COUNT(*) as total_count FROM detections")
-    todays_count = get_record("SELECT COUNT(*) as todays_count FROM detections WHERE Date == DATE('now', 'localtime')")
-    hour_count = get_record("SELECT COUNT(*) as hour_count FROM detections "
-                            "WHERE Date == Date('now', 'localtime') AND TIME >= TIME('now', 'localtime', '-1 hour')")
-    todays_species_tally = get_record("SELECT COUNT(DISTINCT(Sci_Name)) as todays_species_tally FROM detections WHERE Date == Date('now','localtime')")
-    species_tally = get_record("SELECT COUNT(DISTINCT(Sci_Name)) as species_tally FROM detections")
-
-    summary = {**total_count, **todays_count, **hour_count, **todays_species_tally, **species_tally}
-    return summary
+    return query_one('summary')
 
 
 def get_species_by(sort_by=None, date=None):
-    where = "" if date is None else f'WHERE Date == "{date}"'
-    if sort_by == "occurrences":
-        select_sql = (f"SELECT Date, Time, File_Name, Com_Name, Sci_Name, COUNT(*) as Count, MAX(Confidence) as MaxConfidence "
-                      f"FROM detections {where} GROUP BY Sci_Name ORDER BY COUNT(*) DESC;")
-    elif sort_by == "confidence":
-        select_sql = (f"SELECT Date, Time, File_Name, Com_Name, Sci_Name, COUNT(*) as Count, MAX(Confidence) as MaxConfidence "
-                      f"FROM detections {where} GROUP BY Sci_Name ORDER BY MAX(Confidence) DESC;")
-    elif sort_by == "date":
-        select_sql = (f"SELECT Date, Time, File_Name, Com_Name, Sci_Name, COUNT(*) as Count, MAX(Confidence) as MaxConfidence "
-                      f"FROM detections {where} GROUP BY Sci_Name ORDER BY MIN(Date) DESC, Time DESC;")
-    else:
-        select_sql = (f"SELECT Date, Time, File_Name, Com_Name, Sci_Name, COUNT(*) as Count, MAX(Confidence) as MaxConfidence "
-                      f"FROM detections {where} GROUP BY Sci_Name ORDER BY Com_Name ASC;")
-    records = get_records(select_sql)
-    return records
+    sort_by = sort_by if sort_by in SPECIES_ORDER else 'name'
+    if date is None:
+        return query(f'species_by_{sort_by}')
+    return query(f'species_on_date_by_{sort_by}', date=date)
+
+
+def get_detections(start, end=None):
+    end = end if end is not None else datetime.now().strftime("%Y-%m-%d")
+    records = []
+    for _ in archive_batches(get_db(), start, end):
+        records += query('detections_between', start=start, end=end)
+    # the days of a sealed archive can be in the database too, in another batch
+    return sorted(records, key=lambda record: (record.Date, record.Time))
@@ -11,6 +11,8 @@ _settings = None
 
 BASE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 DB_PATH = os.path.join(BASE_PATH, 'scripts/birds.db')
+DB_WRITER_SOCKET = os.path.join(BASE_PATH, 'db_writer.sock')
+SPECTROGRAM_RENDERER_PORT = 8090
 MODEL_PATH = os.path.join(BASE_PATH, 'model')
 FONT_DIR = os.path.join(BASE_PATH, 'homepage/static')
 ANALYZING_NOW = os.path.expanduser('~/BirdSongs/StreamData/analyzing_now.txt')
@@ -32,9 +34,10 @@ def get_font():
 
 
 class PHPConfigParser(ConfigParser):
-    def get(self, section, option, *, raw=False, vars=None, fallback=None):
-        value = super().get(section, option, raw=raw, vars=vars, fallback=fallback)
-        if raw:
+    def get(self, section, option, *, raw=False, vars=None, **kwargs):
+        # fallback only when the caller gave one, without it a missing option raises
+        value = super().get(section, option, raw=raw, vars=vars, **kwargs)
+        if raw or value is None:
             return value
         else:
             return value.strip('"')
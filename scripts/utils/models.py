@@ -1,7 +1,8 @@
+import json
 import logging
 import math
-import operator
 import os
+import re
 
 import numpy as np
 
@@ -18,20 +19,26 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+OCCURRENCE_PATH = os.path.join(MODEL_PATH, 'occurrence')
+# the tables of the last locations, for a station going back and forth; the older ones are removed
+MAX_OCCURRENCE_TABLES = 4
+
 
 def get_model(model=None):
     conf = get_settings()
     if model is None:
         model = conf['MODEL']
 
+    max_batch_size = conf.getint('MAX_BATCH_SIZE', fallback=8)
+
     if model == 'BirdNET_6K_GLOBAL_MODEL':
-        return BirdNetV1(conf.getfloat('SENSITIVITY'))
+        return BirdNetV1(conf.getfloat('SENSITIVITY'), max_batch_size)
     elif model == 'BirdNET_GLOBAL_6K_V2.4_Model_FP16':
-        return BirdNetV2_4(conf.getfloat('SENSITIVITY'))
+        return BirdNetV2_4(conf.getfloat('SENSITIVITY'), max_batch_size)
     elif model == 'Perch_v2':
-        return Perch()
+        return Perch(max_batch_size)
     elif model == 'BirdNET-Go_classifier_20250916':
-        return BirdNETGo20250916(conf.getfloat('SENSITIVITY'))
+        return BirdNETGo20250916(conf.getfloat('SENSITIVITY'), max_batch_size)
 
 
 def get_meta_model(model=None, version=None):
@@ -44,10 +51,25 @@ def get_meta_model(model=None, version=None):
     if model not in ['BirdNET_GLOBAL_6K_V2.4_Model_FP16', 'BirdNET-Go_classifier_20250916']:
         return None
 
+    grid_file = conf.get('SPECIES_GRID') or None
     if version == 1:
-        return MDataModel1(conf.getfloat('SF_THRESH'))
+        return MDataModel1(conf.getfloat('SF_THRESH'), grid_file)
     elif version == 2:
-        return MDataModel2(conf.getfloat('SF_THRESH'))
+        return MDataModel2(conf.getfloat('SF_THRESH'), grid_file)
+
+
+def top_k(scores, k):
+    # Indices and scores of the k best labels for every row, best first
+    k = min(k, scores.shape[-1])
+    indices = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    top_scores = np.take_along_axis(scores, indices, axis=-1)
+    order = np.argsort(-top_scores, axis=-1, kind='stable')
+    return np.take_along_axis(indices, order, axis=-1), np.take_along_axis(top_scores, order, axis=-1)
+
+
+def human_label_indices(labels):
+    # Indices of the human classes, for the privacy filter
+    return np.array([i for i, label in enumerate(labels) if 'Human' in label], dtype=int)
 
 
 class Basemodel:
@@ -57,7 +79,7 @@ class Basemodel:
     _input_layer = 0
     _output_layer = 0
 
-    def __init__(self):
+    def __init__(self, max_batch_size=1):
         model_path = os.path.join(MODEL_PATH, f'{self.model_name}.tflite')
         self.interpreter = tflite.Interpreter(model_path)
         self.interpreter.allocate_tensors()
@@ -66,29 +88,76 @@ class Basemodel:
 
         self._input_layer_idx = input_details[self._input_layer]['index']
         self._output_layer_idx = output_details[self._output_layer]['index']
+        self._input_shape = list(input_details[self._input_layer]['shape'])
+        self._batch_size = self._input_shape[0]
+        self.max_batch_size = max(1, max_batch_size)
 
         self.labels = get_model_labels(self.model_name)
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+        self.human_indices = human_label_indices(self.labels)
 
-    def label(self, logits):
-        p_labels = dict(zip(self.labels, logits))
-        return sorted(p_labels.items(), key=operator.itemgetter(1), reverse=True)
+    def label(self, scores, k=10):
+        return top_k(scores, k)
 
-    def predict(self, chunk):
+    def _resize(self, batch_size):
+        if batch_size != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input_layer_idx, [batch_size] + self._input_shape[1:])
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch_size
+
+    def _invoke(self, batch):
+        self.interpreter.set_tensor(self._input_layer_idx, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output_layer_idx)
+
+    def _scores(self, logits):
         raise NotImplementedError
 
+    def predict(self, chunk):
+        return self.predict_batch([chunk])[0]
+
+    def predict_batch(self, chunks):
+        # Run the chunks through the interpreter max_batch_size at a time, returns a (n_chunks, n_labels) score matrix
+        chunks = np.asarray(chunks, dtype='float32')
+        predictions = []
+        start = 0
+        while start < len(chunks):
+            batch = chunks[start:start + self.max_batch_size]
+            try:
+                self._resize(len(batch))
+            except (ValueError, RuntimeError) as e:
+                if len(batch) == 1:
+                    raise
+                log.warning('%s does not support batched inference, falling back to single chunks: %s', self.model_name, e)
+                self.max_batch_size = 1
+                # the tensors can be left at the size that failed, they are all set back to one chunk
+                self._batch_size = None
+                self._resize(1)
+                continue
+            predictions.append(self._scores(self._invoke(batch)))
+            start += len(batch)
+
+        if not predictions:
+            return np.empty((0, len(self.labels)), dtype='float32')
+        return np.concatenate(predictions)
+
     def set_meta_data(self, lat, lon, week):
         pass
 
     def get_species_list(self):
         return []
 
+    def get_species_mask(self):
+        # mask over the labels of the species expected at this location and week, None when not filtering
+        return None
+
 
 class BirdNet(Basemodel):
     chunk_duration = 3
     sample_rate = 48000
 
-    def __init__(self, sens):
-        super().__init__()
+    def __init__(self, sens, max_batch_size=1):
+        super().__init__(max_batch_size)
 
         self._mdata_model = self._set_meta_model()
 
@@ -97,6 +166,9 @@ class BirdNet(Basemodel):
     def scale(self, logits):
         return 1 / (1.0 + np.exp(-self._sensitivity * logits))
 
+    def _scores(self, logits):
+        return self.scale(logits)
+
     def _set_meta_model(self):
         return None
 
@@ -104,8 +176,8 @@ class BirdNet(Basemodel):
 class BirdNetV1(BirdNet):
     model_name = 'BirdNET_6K_GLOBAL_MODEL'
 
-    def __init__(self, sens):
-        super().__init__(sens)
+    def __init__(self, sens, max_batch_size=1):
+        super().__init__(sens, max_batch_size)
         self._mdata = None
         self._mdata_params = None
 
@@ -113,14 +185,14 @@ class BirdNetV1(BirdNet):
         input_details = self.interpreter.get_input_details()
         return input_details[1]['index']
 
-    def predict(self, chunk):
-        self.interpreter.set_tensor(self._input_layer_idx, np.array(chunk, dtype='float32')[np.newaxis, :])
-        self.interpreter.set_tensor(self._mdata_model, np.array(self._mdata, dtype='float32'))
-
-        self.interpreter.invoke()
-        logits = self.interpreter.get_tensor(self._output_layer_idx)[0]
+    def _resize(self, batch_size):
+        if batch_size != self._batch_size:
+            self.interpreter.resize_tensor_input(self._mdata_model, [batch_size, 6])
+        super()._resize(batch_size)
 
-        return self.label(self.scale(logits))
+    def _invoke(self, batch):
+        self.interpreter.set_tensor(self._mdata_model, np.repeat(np.array(self._mdata, dtype='float32'), len(batch), axis=0))
+        return super()._invoke(batch)
 
     def _convert_metadata(self, m):
         # Convert week to cosine
@@ -152,20 +224,15 @@ class BirdNetV2_4(BirdNet):
     def _set_meta_model(self):
         return get_meta_model()
 
-    def predict(self, chunk):
-        self.interpreter.set_tensor(self._input_layer_idx, np.array(chunk, dtype='float32')[np.newaxis, :])
-
-        self.interpreter.invoke()
-        logits = self.interpreter.get_tensor(self._output_layer_idx)[0]
-
-        return self.label(self.scale(logits))
-
     def set_meta_data(self, lat, lon, week):
         self._mdata_model.set_meta_data(lat, lon, week)
 
     def get_species_list(self):
         return self._mdata_model.get_species_list(self.labels)
 
+    def get_species_mask(self):
+        return self._mdata_model.get_species_mask()
+
 
 class Perch(Basemodel):
     chunk_duration = 5
@@ -173,14 +240,9 @@ class Perch(Basemodel):
     model_name = 'Perch_v2'
     _output_layer = 3
 
-    def predict(self, chunk):
-        self.interpreter.set_tensor(self._input_layer_idx, np.array(chunk, dtype='float32')[np.newaxis, :])
-
-        self.interpreter.invoke()
-        logits = self.interpreter.get_tensor(self._output_layer_idx)[0]
-
-        exp_x = np.exp(logits - np.max(logits))  # Stabilizing to prevent overflow
-        return self.label(exp_x / np.sum(exp_x))
+    def _scores(self, logits):
+        exp_x = np.exp(logits - np.max(logits, axis=-1, keepdims=True))  # Stabilizing to prevent overflow
+        return exp_x / np.sum(exp_x, axis=-1, keepdims=True)
 
 
 class BirdNETGo20250916(BirdNetV2_4):
@@ -188,9 +250,35 @@ class BirdNETGo20250916(BirdNetV2_4):
 
 
 class MDataModel:
+    """The species occurrence model.
+
+    Its scores for every week of the year at a location are computed once, and kept on disk in OCCURRENCE_PATH.
+    Locations covered by a SpeciesGrid are looked up in the grid instead.
+    The interpreter is only loaded to compute them.
+    """
     model_name = None
+    weeks = 53  # ISO weeks
+
+    def __init__(self, sf_thresh, grid_file=None):
+        self.interpreter = None
+        self._sf_thresh = sf_thresh
+        self.grid = None
+        if grid_file is not None:
+            try:
+                self.grid = SpeciesGrid(grid_file)
+            except (OSError, ValueError, KeyError) as e:
+                log.warning('Cannot load species grid %s: %s', grid_file, e)
+            else:
+                if self.grid.model_name != self.model_name:
+                    log.warning('Species grid %s is for %s, not %s', grid_file, self.grid.model_name, self.model_name)
+                    self.grid = None
+
+        self._mdata_params = None
+        self._mdata = None
+        self._table_location = None
+        self._table = None
 
-    def __init__(self, sf_thresh):
+    def _load_interpreter(self):
         model_path = os.path.join(MODEL_PATH, f'{self.model_name}.tflite')
         self.interpreter = tflite.Interpreter(model_path)
         self.interpreter.allocate_tensors()
@@ -199,39 +287,112 @@ class MDataModel:
 
         self._input_layer_idx = input_details[0]['index']
         self._output_layer_idx = output_details[0]['index']
-        self._sf_thresh = sf_thresh
-
-        self._mdata_params = None
-        self._mdata = None
 
     def set_meta_data(self, lat, lon, week):
         if self._mdata_params != (lat, lon, week):
             self._mdata = None
         self._mdata_params = (lat, lon, week)
 
-    def get_species_list_details(self, labels):
+    def predict(self, lat, lon, week):
+        # the scores of the model itself, without the occurrence tables nor the grid
+        if self.interpreter is None:
+            self._load_interpreter()
+        sample = np.expand_dims(np.array([lat, lon, week], dtype='float32'), 0)
+
+        # Run inference
+        self.interpreter.set_tensor(self._input_layer_idx, sample)
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self._output_layer_idx)[0]
+
+    def occurrence_file(self, lat, lon):
+        return os.path.join(OCCURRENCE_PATH, f'{self.model_name}_{lat:.4f}_{lon:.4f}.npy')
+
+    def _prune_occurrence_tables(self):
+        # the tables of this model, not its grid nor the tables of the other models
+        table = re.compile(rf'{re.escape(self.model_name)}_-?\d+\.\d+_-?\d+\.\d+\.npy')
+        files = [os.path.join(OCCURRENCE_PATH, name) for name in os.listdir(OCCURRENCE_PATH) if table.fullmatch(name)]
+        files.sort(key=os.path.getmtime, reverse=True)
+        for file_name in files[MAX_OCCURRENCE_TABLES:]:
+            log.info('Removing the species occurrence table %s', os.path.basename(file_name))
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+
+    def get_occurrence_table(self, lat, lon):
+        # (weeks, labels) scores at a location, row 0 is week 1
+        if self._table_location != (lat, lon):
+            file_name = self.occurrence_file(lat, lon)
+            try:
+                self._table = np.load(file_name)
+            except (OSError, ValueError):
+                log.info('Computing the species occurrence table for %s/%s', lat, lon)
+                self._table = np.stack([self.predict(lat, lon, week) for week in range(1, self.weeks + 1)])
+                os.makedirs(OCCURRENCE_PATH, exist_ok=True)
+                # write and rename, so a concurrent reader never sees half a file
+                tmp_file = f'{file_name}.{os.getpid()}.tmp'
+                with open(tmp_file, 'wb') as f:
+                    np.save(f, self._table)
+                os.replace(tmp_file, file_name)
+                self._prune_occurrence_tables()
+            else:
+                # the last used are kept
+                os.utime(file_name)
+            self._table_location = (lat, lon)
+        return self._table
+
+    def build_grid(self, file_name, lat_min, lat_max, lon_min, lon_max, step):
+        # Compute the scores for every week at every point of the grid, see SpeciesGrid
+        if not step > 0:
+            raise ValueError(f'The step must be positive, not {step}')
+        if lat_min > lat_max or lon_min > lon_max:
+            raise ValueError(f'Empty grid: {lat_min}..{lat_max} / {lon_min}..{lon_max}')
+        lats = np.arange(lat_min, lat_max + step / 2, step)
+        lons = np.arange(lon_min, lon_max + step / 2, step)
+        scores = None
+        for i, lat in enumerate(lats):
+            log.info('Computing grid row %d of %d', i + 1, len(lats))
+            for j, lon in enumerate(lons):
+                for week in range(1, self.weeks + 1):
+                    prediction = self.predict(lat, lon, week)
+                    if scores is None:
+                        scores = np.lib.format.open_memmap(file_name, mode='w+', dtype='float16',
+                                                           shape=(len(lats), len(lons), self.weeks, len(prediction)))
+                    scores[i, j, week - 1] = prediction
+        scores.flush()
+        with open(SpeciesGrid.meta_file(file_name), 'w') as f:
+            json.dump({'model_name': self.model_name, 'lat_min': lat_min, 'lon_min': lon_min, 'step': step}, f)
+
+    def _get_scores(self):
         if self._mdata is None:
             lat, lon, week = self._mdata_params
-            sample = np.expand_dims(np.array([lat, lon, week], dtype='float32'), 0)
+            if 1 <= week <= self.weeks and self.grid is not None and self.grid.covers(lat, lon):
+                self._mdata = self.grid.lookup(lat, lon, week)
+            elif 1 <= week <= self.weeks:
+                self._mdata = self.get_occurrence_table(lat, lon)[week - 1]
+            else:
+                self._mdata = self.predict(lat, lon, week)
 
-            # Run inference
-            self.interpreter.set_tensor(self._input_layer_idx, sample)
-            self.interpreter.invoke()
+        return self._mdata
 
-            l_filter = self.interpreter.get_tensor(self._output_layer_idx)[0]
+    def get_species_list_details(self, labels):
+        l_filter = self._get_scores()
 
-            # Apply threshold
-            l_filter = np.where(l_filter >= float(self._sf_thresh), l_filter, 0)
+        # Apply threshold
+        l_filter = np.where(l_filter >= float(self._sf_thresh), l_filter, 0)
 
-            # Zip with labels
-            l_filter = list(zip(l_filter, labels))
+        # Zip with labels
+        l_filter = list(zip(l_filter, labels))
 
-            # Sort by filter value
-            l_filter = sorted(l_filter, key=lambda x: x[0], reverse=True)
+        # Sort by filter value
+        l_filter = sorted(l_filter, key=lambda x: x[0], reverse=True)
 
-            self._mdata = [s for s in l_filter if s[0] >= self._sf_thresh]
+        return [s for s in l_filter if s[0] >= self._sf_thresh]
 
-        return self._mdata
+    def get_species_mask(self):
+        mask = self._get_scores() >= float(self._sf_thresh)
+        return mask if mask.any() else None
 
     def get_species_list(self, labels):
         l_filter = self.get_species_list_details(labels)
@@ -244,3 +405,50 @@ class MDataModel1(MDataModel):
 
 class MDataModel2(MDataModel):
     model_name = 'BirdNET_GLOBAL_6K_V2.4_MData_Model_V2_FP16'
+
+
+class SpeciesGrid:
+    """Occurrence scores on a regular lat/lon grid for every week, memory-mapped from a .npy file.
+
+    The (lat, lon, week, label) float16 array comes with a .json file holding the model name, the
+    south-west corner and the step of the grid. Built with species_grid.py, for stations that move around.
+    """
+
+    def __init__(self, file_name):
+        with open(self.meta_file(file_name)) as f:
+            meta = json.load(f)
+        self.model_name = meta['model_name']
+        self.lat_min = meta['lat_min']
+        self.lon_min = meta['lon_min']
+        self.step = meta['step']
+        self.scores = np.load(file_name, mmap_mode='r')
+        if self.scores.ndim != 4:
+            raise ValueError(f'expected a (lat, lon, week, label) array, got {self.scores.shape}')
+
+    @staticmethod
+    def meta_file(file_name):
+        return os.path.splitext(file_name)[0] + '.json'
+
+    def _position(self, value, start, size):
+        # grid index below value, and the weight of the one above
+        pos = (value - start) / self.step
+        low = min(max(int(math.floor(pos)), 0), size - 1)
+        return low, min(low + 1, size - 1), min(max(pos - low, 0.0), 1.0)
+
+    def covers(self, lat, lon):
+        n_lat, n_lon = self.scores.shape[:2]
+        return (self.lat_min <= lat <= self.lat_min + (n_lat - 1) * self.step and
+                self.lon_min <= lon <= self.lon_min + (n_lon - 1) * self.step)
+
+    def lookup(self, lat, lon, week, interpolate=True):
+        # scores of all labels, bilinear between the 4 surrounding grid points or from the nearest one
+        n_lat, n_lon = self.scores.shape[:2]
+        lat0, lat1, wlat = self._position(lat, self.lat_min, n_lat)
+        lon0, lon1, wlon = self._position(lon, self.lon_min, n_lon)
+        if not interpolate:
+            return self.scores[lat1 if wlat >= 0.5 else lat0, lon1 if wlon >= 0.5 else lon0, week - 1].astype('float32')
+        # only the 4 rows needed are read from the file
+        return ((1 - wlat) * (1 - wlon) * self.scores[lat0, lon0, week - 1].astype('float32') +
+                (1 - wlat) * wlon * self.scores[lat0, lon1, week - 1].astype('float32') +
+                wlat * (1 - wlon) * self.scores[lat1, lon0, week - 1].astype('float32') +
+                wlat * wlon * self.scores[lat1, lon1, week - 1].astype('float32'))
@@ -4,20 +4,66 @@ import logging
 import os
 import sqlite3
 import subprocess
-import tempfile
+import time
 import io
 import soundfile
-from time import sleep
 
 import requests
-from PIL import Image, ImageDraw, ImageFont
 
-from .helpers import get_settings, get_font, DB_PATH
+from .helpers import get_settings, get_font
+from .birdweather import get_outbox
+from .db import get_writer
 from .classes import Detection, ParseFileName
 from .notifications import sendAppriseNotifications
+from .spectrogram import annotate, render, save_png
 
 log = logging.getLogger(__name__)
 
+DB_WRITE_ATTEMPTS = 3
+DB_RETRY_DELAY = 2
+
+
+# AUDIOFMT: (format, subtype, options) of the clips written in-process, the other formats are converted by sox.
+# A subtype of None keeps the one of the recording. The mp3 clips are 128 kbps constant bitrate, like sox makes them.
+CLIP_FORMATS = {
+    'wav': ('WAV', None, {}),
+    'flac': ('FLAC', None, {}),
+    'ogg': ('OGG', 'VORBIS', {}),
+    'vorbis': ('OGG', 'VORBIS', {}),
+    'mp3': ('MP3', 'MPEG_LAYER_III', {'bitrate_mode': 'CONSTANT', 'compression_level': 2 / 3}),
+    'aif': ('AIFF', None, {}),
+    'aiff': ('AIFF', None, {}),
+    'au': ('AU', None, {}),
+    'caf': ('CAF', None, {}),
+    'w64': ('W64', None, {}),
+}
+# formats that the soundfile here could not write, they are left to sox
+_sox_formats = set()
+
+
+class Recording:
+    """The samples of a recording, decoded on the first clip and sliced for all the others"""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._samples = None
+        self.samplerate = None
+        self.subtype = None
+
+    @property
+    def samples(self):
+        if self._samples is None:
+            self.subtype = soundfile.info(self.file_name).subtype
+            # 16 bit samples are copied as they are
+            dtype = 'int16' if self.subtype == 'PCM_16' else 'float64'
+            self._samples, self.samplerate = soundfile.read(self.file_name, dtype=dtype, always_2d=True)
+        return self._samples
+
+    def clip(self, start, stop):
+        samples = self.samples
+        # sox trim rounds the times to the nearest sample
+        return samples[round(start * self.samplerate):round(stop * self.samplerate)]
+
 
 def extract(in_file, out_file, start, stop):
     result = subprocess.run(['sox', '-V1', f'{in_file}', f'{out_file}', 'trim', f'={start}', f'={stop}'],
@@ -29,7 +75,22 @@ def extract(in_file, out_file, start, stop):
     return ret
 
 
-def extract_safe(in_file, out_file, start, stop):
+def extract_clip(recording: Recording, out_file, start, stop):
+    audio_fmt = os.path.splitext(out_file)[1][1:].lower()
+    if audio_fmt in CLIP_FORMATS and audio_fmt not in _sox_formats:
+        file_format, subtype, options = CLIP_FORMATS[audio_fmt]
+        samples = recording.clip(start, stop)
+        try:
+            soundfile.write(out_file, samples, recording.samplerate, format=file_format, subtype=subtype or recording.subtype, **options)
+            return
+        except (RuntimeError, TypeError, ValueError) as e:
+            # an older libsndfile (mp3 needs 1.1) or soundfile (options need 0.13)
+            log.warning('Cannot write %s clips, using sox: %s', audio_fmt, e)
+            _sox_formats.add(audio_fmt)
+    extract(recording.file_name, out_file, start, stop)
+
+
+def extract_safe(recording: Recording, out_file, start, stop):
     conf = get_settings()
     # This section sets the SPACER that will be used to pad the audio clip with
     # context. If EXTRACTION_LENGTH is 10, for instance, 3 seconds are removed
@@ -43,38 +104,22 @@ def extract_safe(in_file, out_file, start, stop):
     safe_start = max(0, start - spacer)
     safe_stop = min(conf.getint('RECORDING_LENGTH'), stop + spacer)
 
-    extract(in_file, out_file, safe_start, safe_stop)
+    extract_clip(recording, out_file, safe_start, safe_stop)
+    return safe_start, safe_stop
 
 
-def spectrogram(in_file, title, comment, raw=0):
-    fd, tmp_file = tempfile.mkstemp(suffix='.png')
-    os.close(fd)
-    args = ['sox', '-V1', f'{in_file}', '-n', 'remix', '1', 'rate', '24k', 'spectrogram',
-            '-t', '', '-c', '', '-o', tmp_file]
-    args += ['-r'] if int(raw) else []
+def spectrogram(in_file, title, comment, raw=0, samples=None, samplerate=None, out_file=None):
+    # rendered from the samples of the clip when they are at hand, instead of decoding it again
+    if samples is None:
+        samples, samplerate = soundfile.read(in_file, dtype='float32', always_2d=True)
+    img = render(samples, samplerate, raw=bool(int(raw)), font_path=get_font()['path'])
+    save_png(annotate(img, title, comment, get_font()['path']), out_file or f'{in_file}.png')
 
-    result = subprocess.run(args, check=True, capture_output=True)
-    ret = result.stdout.decode('utf-8')
-    err = result.stderr.decode('utf-8')
-    if err:
-        raise RuntimeError(f'{ret}:\n {err}')
-    img = Image.open(tmp_file)
-    height = img.size[1]
-    width = img.size[0]
-    draw = ImageDraw.Draw(img)
-    title_font = ImageFont.truetype(get_font()['path'], 13)
-    _, _, w, _ = draw.textbbox((0, 0), title, font=title_font)
-    draw.text(((width-w)/2, 6), title, fill="white", font=title_font)
-
-    comment_font = ImageFont.truetype(get_font()['path'], 11)
-    _, _, _, h = draw.textbbox((0, 0), comment, font=comment_font)
-    draw.text((1, height - (h + 1)), comment, fill="white", font=comment_font)
-    img.save(f'{in_file}.png')
-    os.remove(tmp_file)
-
-
-def extract_detection(file: ParseFileName, detection: Detection):
+
+def extract_detection(file: ParseFileName, detection: Detection, recording: Recording = None):
+    # the detections of a file share its Recording, so that it is decoded once
     conf = get_settings()
+    recording = recording if recording is not None else Recording(file.file_name)
     new_file_name = f'{detection.common_name_safe}-{detection.confidence_pct}-{detection.date}-birdnet-{file.RTSP_id}{detection.time}.{conf["AUDIOFMT"]}'
     new_dir = os.path.join(conf['EXTRACTED'], 'By_Date', f'{detection.date}', f'{detection.common_name_safe}')
     new_file = os.path.join(new_dir, new_file_name)
@@ -82,32 +127,37 @@ def extract_detection(file: ParseFileName, detection: Detection):
         log.warning('Extraction exists. Moving on: %s', new_file)
     else:
         os.makedirs(new_dir, exist_ok=True)
-        extract_safe(file.file_name, new_file, detection.start, detection.stop)
-        spectrogram(new_file, detection.common_name, new_file.replace(os.path.expanduser('~/'), ''), conf['RAW_SPECTROGRAM'])
+        start, stop = extract_safe(recording, new_file, detection.start, detection.stop)
+        # otherwise the spectrogram_renderer makes it when it is first viewed
+        if conf.get('LAZY_SPECTROGRAMS') != '1':
+            spectrogram(new_file, detection.common_name, new_file.replace(os.path.expanduser('~/'), ''), conf['RAW_SPECTROGRAM'],
+                        recording.clip(start, stop), recording.samplerate)
     return new_file
 
 
-def write_to_db(file: ParseFileName, detection: Detection):
+def write_to_db(file: ParseFileName, detections: list[Detection]):
+    # all detections of a recording in one transaction
     conf = get_settings()
-    # Connect to SQLite Database
-    for attempt_number in range(3):
-        try:
-            con = sqlite3.connect(DB_PATH)
-            cur = con.cursor()
-            cur.execute("INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                        (detection.date, detection.time, detection.scientific_name, detection.common_name, detection.confidence,
-                         conf['LATITUDE'], conf['LONGITUDE'], conf['CONFIDENCE'], str(detection.week), conf['SENSITIVITY'],
-                         conf['OVERLAP'], os.path.basename(detection.file_name_extr)))
+    rows = [(detection.date, detection.time, detection.scientific_name, detection.common_name, detection.confidence,
+             conf['LATITUDE'], conf['LONGITUDE'], conf['CONFIDENCE'], str(detection.week), conf['SENSITIVITY'],
+             conf['OVERLAP'], os.path.basename(detection.file_name_extr))
             # (Date, Time, Sci_Name, Com_Name, str(score),
             # Lat, Lon, Cutoff, Week, Sens,
             # Overlap, File_Name))
-
-            con.commit()
-            con.close()
-            break
-        except BaseException as e:
-            log.warning("Database busy: %s", e)
-            sleep(2)
+            for detection in detections]
+    if not rows:
+        return
+    for attempt in range(1, DB_WRITE_ATTEMPTS + 1):
+        try:
+            get_writer().insert(rows)
+            return
+        except sqlite3.Error as e:
+            if attempt == DB_WRITE_ATTEMPTS:
+                # the recording is kept, it is analysed again on the next start
+                log.error("Cannot write %d detections of %s to the database: %s", len(rows), file.file_name, e)
+                raise
+            log.warning("Cannot write to the database, trying again: %s", e)
+            time.sleep(DB_RETRY_DELAY)
 
 
 def summary(file: ParseFileName, detection: Detection):
@@ -167,54 +217,28 @@ def apprise(file: ParseFileName, detections: [Detection]):
             species_apprised_this_run.append(detection.species)
 
 
-def bird_weather(file: ParseFileName, detections: [Detection]):
+def bird_weather(file: ParseFileName, detections: [Detection], recording: Recording = None):
+    # encoded from the samples of the clips and left in the outbox, the BirdWeatherUploader sends it
     conf = get_settings()
     if conf['BIRDWEATHER_ID'] == "":
         return
     if detections:
+        recording = recording if recording is not None else Recording(file.file_name)
         try:
-            data, samplerate = soundfile.read(file.file_name)
             buf = io.BytesIO()
-            soundfile.write(buf, data, samplerate, format='FLAC')
+            soundfile.write(buf, recording.samples, recording.samplerate, format='FLAC', subtype='PCM_16')
             flac_data = buf.getvalue()
         except Exception as e:
             log.error("Error during FLAC conversion: %s", e)
             return
 
-        # POST soundscape to server
-        soundscape_url = (f'https://app.birdweather.com/api/v1/stations/'
-                          f'{conf["BIRDWEATHER_ID"]}/soundscapes?timestamp={file.iso8601}')
-
-        try:
-            response = requests.post(url=soundscape_url, data=flac_data, timeout=30,
-                                     headers={'Content-Type': 'audio/flac'})
-            log.info("Soundscape POST Response Status - %d", response.status_code)
-            sdata = response.json()
-        except BaseException as e:
-            log.error("Cannot POST soundscape: %s", e)
-            return
-        if not sdata.get('success'):
-            log.error(sdata.get('message'))
-            return
-        soundscape_id = sdata['soundscape']['id']
-
-        for detection in detections:
-            # POST detection to server
-            detection_url = f'https://app.birdweather.com/api/v1/stations/{conf["BIRDWEATHER_ID"]}/detections'
-
-            data = {'timestamp': detection.iso8601, 'lat': conf['LATITUDE'], 'lon': conf['LONGITUDE'],
-                    'soundscapeId': soundscape_id,
-                    'soundscapeStartTime': detection.start, 'soundscapeEndTime': detection.stop,
-                    'commonName': detection.common_name, 'scientificName': detection.scientific_name,
-                    'algorithm': '2p4' if conf['MODEL'] == 'BirdNET_GLOBAL_6K_V2.4_Model_FP16' else 'alpha',
-                    'confidence': detection.confidence}
-
-            log.debug(data)
-            try:
-                response = requests.post(detection_url, json=data, timeout=20)
-                log.info("Detection POST Response Status - %d", response.status_code)
-            except BaseException as e:
-                log.error("Cannot POST detection: %s", e)
+        algorithm = '2p4' if conf['MODEL'] == 'BirdNET_GLOBAL_6K_V2.4_Model_FP16' else 'alpha'
+        data = [{'timestamp': detection.iso8601, 'lat': conf['LATITUDE'], 'lon': conf['LONGITUDE'],
+                 'soundscapeStartTime': detection.start, 'soundscapeEndTime': detection.stop,
+                 'commonName': detection.common_name, 'scientificName': detection.scientific_name,
+                 'algorithm': algorithm, 'confidence': detection.confidence}
+                for detection in detections]
+        get_outbox().put(file.iso8601, flac_data, data)
 
 
 def heartbeat():
@@ -0,0 +1,426 @@
+import glob
+import os
+import re
+import sqlite3
+from datetime import date
+
+from .helpers import DB_PATH
+
+# The detections are stored with integer keys into species and run_settings (the location and analysis
+# parameters, which change rarely). The detections view joins them back into the original layout,
+# and its triggers take the writes of the web interface and scripts that still use it.
+# The archives of old detections hold the same tables, {schema} is main or the name of the attached archive.
+TABLES = """
+CREATE TABLE IF NOT EXISTS {schema}.species (
+  id INTEGER PRIMARY KEY,
+  Sci_Name VARCHAR(100) NOT NULL,
+  Com_Name VARCHAR(100) NOT NULL,
+  UNIQUE (Sci_Name, Com_Name));
+CREATE INDEX IF NOT EXISTS {schema}."species_Com_Name" ON "species" ("Com_Name");
+CREATE TABLE IF NOT EXISTS {schema}.run_settings (
+  id INTEGER PRIMARY KEY,
+  Lat FLOAT,
+  Lon FLOAT,
+  Cutoff FLOAT,
+  Sens FLOAT,
+  Overlap FLOAT);
+CREATE INDEX IF NOT EXISTS {schema}."run_settings_values" ON "run_settings" ("Lat", "Lon", "Cutoff", "Sens", "Overlap");
+CREATE TABLE IF NOT EXISTS {schema}.detection_data (
+  Date DATE,
+  Time TIME,
+  Species INT NOT NULL REFERENCES species (id),
+  Confidence FLOAT,
+  Settings INT NOT NULL REFERENCES run_settings (id),
+  Week INT,
+  File_Name VARCHAR(100) NOT NULL);
+CREATE INDEX IF NOT EXISTS {schema}."detection_data_Date_Time" ON "detection_data" ("Date" DESC, "Time" DESC);
+CREATE INDEX IF NOT EXISTS {schema}."detection_data_Species" ON "detection_data" ("Species");
+"""
+_DETECTIONS_SELECT = ("SELECT d.Date, d.Time, s.Sci_Name, s.Com_Name, d.Confidence, r.Lat, r.Lon, r.Cutoff, d.Week, r.Sens, r.Overlap, d.File_Name "
+                      "FROM {schema}detection_data d JOIN {schema}species s ON s.id = d.Species JOIN {schema}run_settings r ON r.id = d.Settings")
+SCHEMA = TABLES.format(schema='main') + f"""
+CREATE VIEW IF NOT EXISTS detections (Date, Time, Sci_Name, Com_Name, Confidence, Lat, Lon, Cutoff, Week, Sens, Overlap, File_Name) AS
+  {_DETECTIONS_SELECT.format(schema='')};
+"""
+
+_SPECIES_ID = "(SELECT id FROM species WHERE Sci_Name = {row}.Sci_Name AND Com_Name = {row}.Com_Name)"
+_SETTINGS_ID = ("(SELECT id FROM run_settings WHERE Lat IS {row}.Lat AND Lon IS {row}.Lon AND Cutoff IS {row}.Cutoff "
+                "AND Sens IS {row}.Sens AND Overlap IS {row}.Overlap)")
+
+# each detection keeps the common name it was stored with, it is in the path of its clip:
+# a language change adds a species row for the new name
+_STORE_KEYS = f"""
+INSERT INTO species (Sci_Name, Com_Name) VALUES (NEW.Sci_Name, NEW.Com_Name) ON CONFLICT (Sci_Name, Com_Name) DO NOTHING;
+INSERT INTO run_settings (Lat, Lon, Cutoff, Sens, Overlap)
+  SELECT NEW.Lat, NEW.Lon, NEW.Cutoff, NEW.Sens, NEW.Overlap WHERE {_SETTINGS_ID.format(row='NEW')} IS NULL;
+"""
+
+# identical rows of the view are told apart by deleting or updating one of them per trigger run
+_MATCH_OLD = (f"(SELECT rowid FROM detection_data WHERE Date IS OLD.Date AND Time IS OLD.Time AND File_Name = OLD.File_Name "
+              f"AND Species = {_SPECIES_ID.format(row='OLD')} LIMIT 1)")
+
+VIEW_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS detections_insert INSTEAD OF INSERT ON detections BEGIN
+{_STORE_KEYS.strip()}
+INSERT INTO detection_data (Date, Time, Species, Confidence, Settings, Week, File_Name)
+  VALUES (NEW.Date, NEW.Time, {_SPECIES_ID.format(row='NEW')}, NEW.Confidence, {_SETTINGS_ID.format(row='NEW')}, NEW.Week, NEW.File_Name);
+END;
+CREATE TRIGGER IF NOT EXISTS detections_delete INSTEAD OF DELETE ON detections BEGIN
+DELETE FROM detection_data WHERE rowid = {_MATCH_OLD};
+END;
+CREATE TRIGGER IF NOT EXISTS detections_update INSTEAD OF UPDATE ON detections BEGIN
+{_STORE_KEYS.strip()}
+UPDATE detection_data SET Date = NEW.Date, Time = NEW.Time, Species = {_SPECIES_ID.format(row='NEW')}, Confidence = NEW.Confidence,
+  Settings = {_SETTINGS_ID.format(row='NEW')}, Week = NEW.Week, File_Name = NEW.File_Name
+  WHERE rowid = {_MATCH_OLD};
+END;
+"""
+
+# Per-species counts, kept up to date by triggers on detection_data so the summaries do not scan all the detections.
+# species_hourly keeps the time and file of the best detection of the hour, like the bare columns of a GROUP BY.
+AGGREGATE_TABLES = """
+CREATE TABLE IF NOT EXISTS species_hourly (
+  Date DATE NOT NULL,
+  Hour INT NOT NULL,
+  Sci_Name VARCHAR(100) NOT NULL,
+  Com_Name VARCHAR(100) NOT NULL,
+  Count INT NOT NULL,
+  MaxConfidence FLOAT,
+  Time TIME,
+  File_Name VARCHAR(100),
+  PRIMARY KEY (Date, Hour, Sci_Name));
+CREATE INDEX IF NOT EXISTS "species_hourly_Sci_Name" ON "species_hourly" ("Sci_Name");
+CREATE TABLE IF NOT EXISTS species_totals (
+  Sci_Name VARCHAR(100) PRIMARY KEY,
+  Com_Name VARCHAR(100) NOT NULL,
+  Count INT NOT NULL,
+  MaxConfidence FLOAT,
+  FirstDate DATE,
+  LastDate DATE);
+"""
+
+_HOUR = "CAST(substr({row}.Time, 1, 2) AS INTEGER)"
+_SCI_NAME = "(SELECT Sci_Name FROM species WHERE id = {row}.Species)"
+_COM_NAME = "(SELECT Com_Name FROM species WHERE id = {row}.Species)"
+
+_ADD_DETECTION = f"""
+INSERT INTO species_hourly (Date, Hour, Sci_Name, Com_Name, Count, MaxConfidence, Time, File_Name)
+  VALUES ({{row}}.Date, {_HOUR}, {_SCI_NAME}, {_COM_NAME}, 1, {{row}}.Confidence, {{row}}.Time, {{row}}.File_Name)
+  ON CONFLICT (Date, Hour, Sci_Name) DO UPDATE SET
+    Count = Count + 1,
+    Com_Name = excluded.Com_Name,
+    Time = CASE WHEN excluded.MaxConfidence > MaxConfidence THEN excluded.Time ELSE Time END,
+    File_Name = CASE WHEN excluded.MaxConfidence > MaxConfidence THEN excluded.File_Name ELSE File_Name END,
+    MaxConfidence = MAX(MaxConfidence, excluded.MaxConfidence);
+INSERT INTO species_totals (Sci_Name, Com_Name, Count, MaxConfidence, FirstDate, LastDate)
+  VALUES ({_SCI_NAME}, {_COM_NAME}, 1, {{row}}.Confidence, {{row}}.Date, {{row}}.Date)
+  ON CONFLICT (Sci_Name) DO UPDATE SET
+    Com_Name = excluded.Com_Name,
+    Count = Count + 1,
+    MaxConfidence = MAX(MaxConfidence, excluded.MaxConfidence),
+    FirstDate = MIN(FirstDate, excluded.FirstDate),
+    LastDate = MAX(LastDate, excluded.LastDate);
+"""
+
+# the row is already gone from detection_data, the maximum is only looked up again when it was the best one
+_REMOVE_DETECTION = f"""
+UPDATE species_hourly SET Count = Count - 1
+  WHERE Date = {{row}}.Date AND Hour = {_HOUR} AND Sci_Name = {_SCI_NAME};
+DELETE FROM species_hourly
+  WHERE Date = {{row}}.Date AND Hour = {_HOUR} AND Sci_Name = {_SCI_NAME} AND Count <= 0;
+UPDATE species_hourly SET (MaxConfidence, Time, File_Name) = (
+    SELECT Confidence, Time, File_Name FROM detection_data
+    WHERE Date = {{row}}.Date AND substr(Time, 1, 2) = substr({{row}}.Time, 1, 2) AND Species IN (SELECT id FROM species WHERE Sci_Name = {_SCI_NAME})
+    ORDER BY Confidence DESC LIMIT 1)
+  WHERE Date = {{row}}.Date AND Hour = {_HOUR} AND Sci_Name = {_SCI_NAME} AND {{row}}.Confidence >= MaxConfidence;
+UPDATE species_totals SET Count = Count - 1 WHERE Sci_Name = {_SCI_NAME};
+DELETE FROM species_totals WHERE Sci_Name = {_SCI_NAME} AND Count <= 0;
+UPDATE species_totals SET (MaxConfidence, FirstDate, LastDate) = (
+    SELECT MAX(MaxConfidence), MIN(Date), MAX(Date) FROM species_hourly WHERE Sci_Name = {_SCI_NAME})
+  WHERE Sci_Name = {_SCI_NAME} AND ({{row}}.Confidence >= MaxConfidence OR {{row}}.Date IN (FirstDate, LastDate));
+"""
+
+# dropped while detections move to an archive, the aggregates keep counting them
+_AGGREGATE_DELETE_TRIGGER = f"""
+CREATE TRIGGER IF NOT EXISTS detection_data_aggregate_delete AFTER DELETE ON detection_data BEGIN
+{_REMOVE_DETECTION.format(row='OLD').strip()}
+END;
+"""
+
+AGGREGATE_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS detection_data_aggregate_insert AFTER INSERT ON detection_data BEGIN
+{_ADD_DETECTION.format(row='NEW').strip()}
+END;
+{_AGGREGATE_DELETE_TRIGGER.strip()}
+CREATE TRIGGER IF NOT EXISTS detection_data_aggregate_update AFTER UPDATE ON detection_data BEGIN
+{_REMOVE_DETECTION.format(row='OLD').strip()}
+{_ADD_DETECTION.format(row='NEW').strip()}
+END;
+"""
+
+# The aggregates of the detections and their archives are counted a batch of archives at a time into
+# temp.hourly, see archive_batches(), then added up: a day can be in the database and in an archive.
+_HOURLY_FROM_DETECTIONS = (f"SELECT d.Date, {_HOUR.format(row='d')} AS Hour, d.Sci_Name, d.Com_Name, "
+                           "COUNT(*) AS Count, MAX(d.Confidence) AS MaxConfidence, d.Time, d.File_Name "
+                           "FROM detections_all d GROUP BY 1, 2, d.Sci_Name")
+_HOURLY = ("SELECT Date, Hour, Sci_Name, Com_Name, SUM(Count) AS Count, MAX(MaxConfidence) AS MaxConfidence, Time, File_Name "
+           "FROM temp.hourly GROUP BY Date, Hour, Sci_Name")
+_TOTALS = "SELECT Sci_Name, SUM(Count), MAX(MaxConfidence), MIN(Date), MAX(Date) FROM temp.hourly GROUP BY Sci_Name"
+
+AGGREGATE_CHECKS = {
+    'species_hourly': ("SELECT Date, Hour, Sci_Name, Count, MaxConfidence FROM species_hourly",
+                       f"SELECT Date, Hour, Sci_Name, Count, MaxConfidence FROM ({_HOURLY})"),
+    'species_totals': ("SELECT Sci_Name, Count, MaxConfidence, FirstDate, LastDate FROM species_totals",
+                       _TOTALS),
+}
+
+
+def _executescript(con, script):
+    # runs the script in one transaction, executescript() would commit each statement on its own
+    try:
+        con.executescript(f"BEGIN IMMEDIATE;\n{script}\nCOMMIT;")
+    except sqlite3.Error:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+
+
+def create_db(db_path=DB_PATH, timeout=60.0):
+    """Creates the tables, views and triggers, dropping any detections that are there"""
+    con = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+    try:
+        existing = con.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'view') AND name IN "
+                               "('detections', 'detection_data', 'species', 'run_settings', 'species_hourly', 'species_totals')")
+        drops = "\n".join(f"DROP {kind.upper()} {name};" for kind, name in existing.fetchall())
+        _executescript(con, f"{drops}\n{SCHEMA}\n{VIEW_TRIGGERS}")
+    finally:
+        con.close()
+    rebuild_aggregates(db_path, timeout)
+
+
+def migrate_db(db_path=DB_PATH, timeout=60.0):
+    """Moves a detections table of the original layout into the tables with integer keys.
+
+    Returns False when the database already has the new layout.
+    """
+    con = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+    try:
+        kind = con.execute("SELECT type FROM sqlite_master WHERE name = 'detections'").fetchone()
+        if kind is None or kind[0] != 'table':
+            return False
+        _executescript(con, f"""
+DROP TRIGGER IF EXISTS detections_aggregate_insert;
+DROP TRIGGER IF EXISTS detections_aggregate_delete;
+DROP TRIGGER IF EXISTS detections_aggregate_update;
+ALTER TABLE detections RENAME TO detections_old;
+{SCHEMA}
+{VIEW_TRIGGERS}
+INSERT INTO species (Sci_Name, Com_Name)
+  SELECT DISTINCT Sci_Name, Com_Name FROM detections_old;
+INSERT INTO run_settings (Lat, Lon, Cutoff, Sens, Overlap)
+  SELECT DISTINCT Lat, Lon, Cutoff, Sens, Overlap FROM detections_old;
+INSERT INTO detection_data (Date, Time, Species, Confidence, Settings, Week, File_Name)
+  SELECT o.Date, o.Time, s.id, o.Confidence, r.id, o.Week, o.File_Name
+  FROM detections_old o JOIN species s ON s.Sci_Name = o.Sci_Name AND s.Com_Name = o.Com_Name
+  JOIN run_settings r ON r.Lat IS o.Lat AND r.Lon IS o.Lon AND r.Cutoff IS o.Cutoff AND r.Sens IS o.Sens AND r.Overlap IS o.Overlap
+  ORDER BY o.rowid;
+DROP TABLE detections_old;
+""")
+    finally:
+        con.close()
+    # the aggregate triggers are created after the copy, instead of running for each row
+    rebuild_aggregates(db_path, timeout)
+    return True
+
+
+def _count_hourly(con):
+    con.execute("DROP TABLE IF EXISTS temp.hourly")
+    for _ in archive_batches(con):
+        con.execute(f"CREATE TEMP TABLE IF NOT EXISTS hourly AS {_HOURLY_FROM_DETECTIONS} LIMIT 0")
+        con.execute(f"INSERT INTO temp.hourly {_HOURLY_FROM_DETECTIONS}")
+
+
+def rebuild_aggregates(db_path=DB_PATH, timeout=60.0):
+    """Recreates the aggregate tables and their triggers from the detections and their archives, in one transaction"""
+    con = sqlite3.connect(f"file:{db_path}", uri=True, timeout=timeout, isolation_level=None)
+    try:
+        _count_hourly(con)
+        _executescript(con, f"""
+DROP TRIGGER IF EXISTS detection_data_aggregate_insert;
+DROP TRIGGER IF EXISTS detection_data_aggregate_delete;
+DROP TRIGGER IF EXISTS detection_data_aggregate_update;
+DROP TABLE IF EXISTS species_hourly;
+DROP TABLE IF EXISTS species_totals;
+{AGGREGATE_TABLES}
+{AGGREGATE_TRIGGERS}
+INSERT INTO species_hourly {_HOURLY};
+INSERT INTO species_totals
+  SELECT Sci_Name, Com_Name, SUM(Count), MAX(MaxConfidence), MIN(Date), MAX(Date) FROM species_hourly GROUP BY Sci_Name;
+""")
+    finally:
+        con.close()
+
+
+def check_aggregates(db_path=DB_PATH):
+    """Compares the aggregate tables with the detections: {table: (missing rows, unexpected rows)} for the ones that differ"""
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, isolation_level=None)
+    differences = {}
+    try:
+        _count_hourly(con)
+        for table, (stored, expected) in AGGREGATE_CHECKS.items():
+            missing = con.execute(f"{expected} EXCEPT {stored}").fetchall()
+            unexpected = con.execute(f"{stored} EXCEPT {expected}").fetchall()
+            if missing or unexpected:
+                differences[table] = (missing, unexpected)
+    finally:
+        con.close()
+    return differences
+
+
+# Detections older than ARCHIVE_AFTER_DAYS are moved to one database per year, next to birds.db.
+# The aggregate tables keep counting them, so the dashboards do not need the archives.
+def archive_dir(db_path=DB_PATH):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'archive')
+
+
+def archive_files(db_path=DB_PATH):
+    """{year: path} of the archives of the database"""
+    archives = {}
+    for path in glob.glob(os.path.join(archive_dir(db_path), 'birds-*.db')):
+        match = re.fullmatch(r'birds-(\d{4})\.db', os.path.basename(path))
+        if match:
+            archives[int(match.group(1))] = path
+    return dict(sorted(archives.items()))
+
+
+def is_sealed(path):
+    # sealed archives are read-only files, they never change again
+    return not os.stat(path).st_mode & 0o222
+
+
+# SQLite attaches at most 10 databases by default
+ATTACH_BATCH = 10
+
+
+def _main_file(con):
+    return next(file for _, name, file in con.execute("PRAGMA database_list") if name == 'main')
+
+
+def create_detections_all(con, main=True):
+    """(Re)creates the temporary view detections_all: the detections followed by those of the attached archives.
+
+    Without main, only those of the archives.
+    """
+    archives = [name for _, name, _ in con.execute("PRAGMA database_list") if name.startswith('archive_')]
+    selects = (["SELECT * FROM main.detections"] if main else []) + [_DETECTIONS_SELECT.format(schema=f'{name}.') for name in sorted(archives)]
+    con.execute("DROP VIEW IF EXISTS temp.detections_all")
+    con.execute("CREATE TEMP VIEW detections_all AS " + " UNION ALL ".join(selects))
+
+
+def _archive_years(con, start=None, end=None):
+    # {year: path} of the archives that hold detections from start to end
+    if start is not None:
+        oldest = con.execute("SELECT MIN(Date) FROM detection_data").fetchone()[0]
+        if oldest is not None and start >= oldest:
+            return {}
+    return {year: path for year, path in archive_files(_main_file(con)).items()
+            if (start is None or year >= int(start[:4])) and (end is None or year <= int(end[:4]))}
+
+
+def _detach_archives(con):
+    for _, name, _ in con.execute("PRAGMA database_list").fetchall():
+        if name.startswith('archive_'):
+            con.execute(f"DETACH DATABASE {name}")
+
+
+def _attach(con, year, path):
+    # immutable skips the locking, sealed archives can be on a read-only or compressed file system
+    mode = 'immutable=1' if is_sealed(path) else 'mode=ro'
+    con.execute(f"ATTACH DATABASE ? AS archive_{year}", (f"file:{path}?{mode}",))
+
+
+def archive_batches(con, start=None, end=None):
+    """Attaches the archives that hold detections from start to end (dates as YYYY-MM-DD, None for no bound), a batch at a time.
+
+    Yields the years attached, at most ATTACH_BATCH as SQLite attaches at most 10 databases. In the first
+    batch, with the newest archives, detections_all holds the detections of the database and of the archives;
+    in the next ones those of the archives alone, so that each detection is read once. Nothing is attached
+    when start is after the oldest detection left in the database, so the queries of recent days do not open
+    the archives. The archives are detached at the end.
+
+    The connection must be opened with uri=True, and the reads of a batch finished before the next one,
+    outside of a transaction.
+    """
+    years = sorted(_archive_years(con, start, end).items(), reverse=True)
+    try:
+        for i in range(0, max(len(years), 1), ATTACH_BATCH):
+            batch = dict(years[i:i + ATTACH_BATCH])
+            _detach_archives(con)
+            for year, path in sorted(batch.items()):
+                _attach(con, year, path)
+            create_detections_all(con, main=i == 0)
+            yield sorted(batch)
+    finally:
+        if not con.in_transaction:
+            _detach_archives(con)
+            create_detections_all(con)
+
+
+def archive_detections(before, db_path=DB_PATH, timeout=60.0):
+    """Moves the detections dated before the given date (YYYY-MM-DD) to the archive of their year.
+
+    Returns {year: number of detections moved}. Years with a sealed archive are left in the database.
+    """
+    before = date.fromisoformat(before).isoformat()
+    os.makedirs(archive_dir(db_path), exist_ok=True)
+    con = sqlite3.connect(f"file:{db_path}", uri=True, timeout=timeout, isolation_level=None)
+    moved = {}
+    try:
+        years = [row[0] for row in con.execute("SELECT DISTINCT substr(Date, 1, 4) FROM detection_data WHERE Date < ?", (before,))]
+        for year in sorted(years):
+            path = os.path.join(archive_dir(db_path), f'birds-{year}.db')
+            if os.path.exists(path) and is_sealed(path):
+                continue
+            end = min(before, f'{int(year) + 1}-01-01')
+            count = con.execute("SELECT COUNT(*) FROM detection_data WHERE Date >= ? AND Date < ?", (f'{year}-01-01', end)).fetchone()[0]
+            con.execute("ATTACH DATABASE ? AS archive", (f"file:{path}",))
+            try:
+                _executescript(con, TABLES.format(schema='archive'))
+                # The commit is atomic in each database but not across both, with birds.db in WAL mode.
+                # The detections already in the archive were copied by an interrupted run and are not copied again.
+                _executescript(con, f"""
+INSERT INTO archive.species (Sci_Name, Com_Name) SELECT Sci_Name, Com_Name FROM main.species WHERE true
+  ON CONFLICT (Sci_Name, Com_Name) DO NOTHING;
+INSERT INTO archive.run_settings (Lat, Lon, Cutoff, Sens, Overlap)
+  SELECT Lat, Lon, Cutoff, Sens, Overlap FROM main.run_settings m WHERE NOT EXISTS (
+    SELECT 1 FROM archive.run_settings a
+    WHERE a.Lat IS m.Lat AND a.Lon IS m.Lon AND a.Cutoff IS m.Cutoff AND a.Sens IS m.Sens AND a.Overlap IS m.Overlap);
+INSERT INTO archive.detection_data (Date, Time, Species, Confidence, Settings, Week, File_Name)
+  SELECT d.Date, d.Time, s.id, d.Confidence, r.id, d.Week, d.File_Name FROM main.detections d
+  JOIN archive.species s ON s.Sci_Name = d.Sci_Name AND s.Com_Name = d.Com_Name
+  JOIN archive.run_settings r ON r.Lat IS d.Lat AND r.Lon IS d.Lon AND r.Cutoff IS d.Cutoff AND r.Sens IS d.Sens AND r.Overlap IS d.Overlap
+  WHERE d.Date >= '{year}-01-01' AND d.Date < '{end}' AND NOT EXISTS (
+    SELECT 1 FROM archive.detection_data a WHERE a.Date = d.Date AND a.Time = d.Time AND a.File_Name = d.File_Name)
+  ORDER BY d.Date, d.Time;
+DROP TRIGGER detection_data_aggregate_delete;
+DELETE FROM main.detection_data WHERE Date >= '{year}-01-01' AND Date < '{end}';
+{_AGGREGATE_DELETE_TRIGGER}
+""")
+                moved[int(year)] = count
+            finally:
+                con.execute("DETACH DATABASE archive")
+    finally:
+        con.close()
+    return moved
+
+
+def seal_archive(year, db_path=DB_PATH):
+    """Compacts the archive of a year and makes it read-only, no detections can be moved to it anymore"""
+    path = archive_files(db_path)[year]
+    con = sqlite3.connect(path, isolation_level=None)
+    try:
+        con.execute("VACUUM")
+    finally:
+        con.close()
+    os.chmod(path, 0o444)
+    return path
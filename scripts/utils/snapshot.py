@@ -0,0 +1,209 @@
+import json
+import os
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .helpers import DB_PATH
+from .schema import archive_batches, archive_files
+
+# A Parquet copy of the detections for the charts, with one directory per month (Month=YYYY-MM).
+# Each export appends the detections added since the last one, found by their rowid. A month whose
+# per-species counts in the files no longer match species_hourly (deleted or corrected detections, or
+# detections appended twice after an interrupted export) is written again.
+SCHEMA = pa.schema([
+    ('Date', pa.string()),
+    ('Time', pa.string()),
+    ('Sci_Name', pa.dictionary(pa.int32(), pa.string())),
+    ('Com_Name', pa.dictionary(pa.int32(), pa.string())),
+    ('Confidence', pa.float64()),
+    ('Lat', pa.float64()),
+    ('Lon', pa.float64()),
+    ('Cutoff', pa.float64()),
+    ('Week', pa.int64()),
+    ('Sens', pa.float64()),
+    ('Overlap', pa.float64()),
+    ('File_Name', pa.string()),
+])
+PARTITIONING = ds.partitioning(pa.schema([('Month', pa.string())]), flavor='hive')
+DATASET_SCHEMA = SCHEMA.append(pa.field('Month', pa.string()))
+# the appended files of a month are merged once there are more than this
+MAX_FILES_PER_MONTH = 8
+# a month can be written again while it is read, its files are then listed again
+READ_ATTEMPTS = 3
+
+_NEW_DETECTIONS = ("SELECT d.rowid, d.Date, d.Time, s.Sci_Name, s.Com_Name, d.Confidence, r.Lat, r.Lon, r.Cutoff, d.Week, r.Sens, r.Overlap, "
+                   "d.File_Name FROM detection_data d JOIN species s ON s.id = d.Species JOIN run_settings r ON r.id = d.Settings "
+                   "WHERE d.rowid > ? ORDER BY d.rowid")
+_MONTH_DETECTIONS = "SELECT * FROM detections_all WHERE Date >= ? AND Date < ? ORDER BY Date, Time"
+# in the batches after the first one, see archive_batches()
+_ARCHIVED_MONTH_DETECTIONS = ("SELECT * FROM (SELECT * FROM detections_all UNION ALL SELECT * FROM main.detections) "
+                              "WHERE Date >= ? AND Date < ? ORDER BY Date, Time")
+_MONTH_COUNTS = "SELECT substr(Date, 1, 7), Sci_Name, SUM(Count) FROM species_hourly GROUP BY 1, 2"
+
+
+def snapshot_dir(db_path=DB_PATH):
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), 'snapshot')
+
+
+def _to_table(rows):
+    columns = list(zip(*rows)) if rows else [[] for _ in SCHEMA]
+    return pa.table([pa.array(column, type=field.type) for column, field in zip(columns, SCHEMA)], schema=SCHEMA)
+
+
+def _dataset(path):
+    return ds.dataset(path, schema=DATASET_SCHEMA, format='parquet', partitioning=PARTITIONING, ignore_prefixes=['.', '_', 'state.json'])
+
+
+def _snapshot_counts(path):
+    # from the files rather than from the state, which is saved after them
+    counts = {}
+    if not os.path.isdir(path):
+        return counts
+    table = _dataset(path).to_table(columns=['Month', 'Sci_Name']).unify_dictionaries()
+    for row in table.group_by(['Month', 'Sci_Name']).aggregate([('Sci_Name', 'count')]).to_pylist():
+        counts.setdefault(row['Month'], {})[row['Sci_Name']] = row['Sci_Name_count']
+    return counts
+
+
+def _counts(table):
+    counts = {}
+    for row in table.group_by('Sci_Name').aggregate([('Sci_Name', 'count')]).to_pylist():
+        counts[row['Sci_Name']] = row['Sci_Name_count']
+    return counts
+
+
+def _month_files(path, month):
+    month_dir = os.path.join(path, f'Month={month}')
+    if not os.path.isdir(month_dir):
+        return []
+    return sorted(os.path.join(month_dir, name) for name in os.listdir(month_dir) if name.endswith('.parquet'))
+
+
+def _write_month(path, month, table, name, replace=False):
+    # a month that is written again replaces its files once the new one is complete
+    old_files = _month_files(path, month) if replace else []
+    month_dir = os.path.join(path, f'Month={month}')
+    os.makedirs(month_dir, exist_ok=True)
+    file_name = os.path.join(month_dir, name)
+    if len(table):
+        # the dataset skips the hidden file while it is written
+        tmp_file = os.path.join(month_dir, f'.{name}.tmp')
+        pq.write_table(table.unify_dictionaries().combine_chunks(), tmp_file, compression='zstd')
+        os.replace(tmp_file, file_name)
+    for old_file in old_files:
+        if old_file != file_name or not len(table):
+            os.remove(old_file)
+    if not os.listdir(month_dir):
+        os.rmdir(month_dir)
+
+
+def _next_month(month):
+    year, month = map(int, month.split('-'))
+    return f'{year + month // 12}-{month % 12 + 1:02d}'
+
+
+def _write_again(con, path, month, name, sql=_MONTH_DETECTIONS):
+    table = _to_table(con.execute(sql, (f'{month}-01', f'{_next_month(month)}-01')).fetchall())
+    _write_month(path, month, table, name, replace=True)
+
+
+def export_snapshot(db_path=DB_PATH, rebuild=False):
+    """Brings the Parquet snapshot of the detections up to date.
+
+    Returns (number of detections appended, months written again).
+    """
+    path = snapshot_dir(db_path)
+    state_file = os.path.join(path, 'state.json')
+    state = {'watermark': 0}
+    if not rebuild and os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, isolation_level=None)
+    # the months to write again can be in the archives, the database is read with the newest ones
+    batches = archive_batches(con)
+    try:
+        years = next(batches)
+        # one read transaction, the counts match the detections
+        con.execute("BEGIN")
+        max_rowid = con.execute("SELECT IFNULL(MAX(rowid), 0) FROM detection_data").fetchone()[0]
+        # the rowids above the largest one left are used again, by then the counts of the months differ
+        state['watermark'] = min(state['watermark'], max_rowid)
+        rows = con.execute(_NEW_DETECTIONS, (state['watermark'],)).fetchall()
+        expected = {}
+        for month, sci_name, count in con.execute(_MONTH_COUNTS):
+            expected.setdefault(month, {})[sci_name] = count
+
+        name = f'part-{max_rowid:012d}.parquet'
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row[1][:7], []).append(row[1:])
+        for month, month_rows in by_month.items():
+            table = _to_table(month_rows)
+            _write_month(path, month, table, name)
+
+        counts = _snapshot_counts(path)
+        stale = sorted(month for month in set(expected) | set(counts) if rebuild or expected.get(month, {}) != counts.get(month, {}))
+        # the months of the older archives are written again with their batch
+        archived = archive_files(db_path)
+        later = {month for month in stale if int(month[:4]) in archived and int(month[:4]) not in years}
+        for month in stale:
+            if month not in later:
+                _write_again(con, path, month, name)
+        con.execute("COMMIT")
+
+        for years in batches:
+            for month in sorted(later):
+                if int(month[:4]) in years:
+                    _write_again(con, path, month, name, _ARCHIVED_MONTH_DETECTIONS)
+    finally:
+        batches.close()
+        con.close()
+
+    for month in by_month:
+        files = _month_files(path, month)
+        if len(files) > MAX_FILES_PER_MONTH:
+            _write_month(path, month, ds.dataset(files, schema=SCHEMA).to_table(), name, replace=True)
+
+    # without it the detections are appended again by the next export, which then writes their months again
+    state = {'watermark': max_rowid}
+    with open(f'{state_file}.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(f'{state_file}.tmp', state_file)
+    return len(rows), stale
+
+
+def read_snapshot(columns=None, start=None, end=None, db_path=DB_PATH, categories=False):
+    """The detections from start to end (dates as YYYY-MM-DD, None for no bound) as a DataFrame sorted by date and time.
+
+    Only the given columns and the months of the range are read. The species names are pandas
+    categoricals with categories=True, and strings otherwise. Returns None when there is no snapshot,
+    or when its files keep being replaced while they are read.
+    """
+    path = snapshot_dir(db_path)
+    if not os.path.exists(os.path.join(path, 'state.json')):
+        return None
+    columns = list(columns or SCHEMA.names)
+    # Month prunes the directories, Date the row groups
+    condition = ds.scalar(True)
+    if start is not None:
+        condition &= (ds.field('Month') >= start[:7]) & (ds.field('Date') >= start)
+    if end is not None:
+        condition &= (ds.field('Month') <= end[:7]) & (ds.field('Date') <= end)
+    sort_keys = [('Date', 'ascending'), ('Time', 'ascending')]
+    for _ in range(READ_ATTEMPTS):
+        try:
+            table = _dataset(path).to_table(columns=list(dict.fromkeys(columns + ['Date', 'Time'])), filter=condition)
+            break
+        except FileNotFoundError:
+            # listed before the export removed it
+            pass
+    else:
+        return None
+    table = table.sort_by(sort_keys).select(columns)
+    if not categories:
+        table = table.cast(pa.schema([pa.field(f.name, f.type.value_type) if pa.types.is_dictionary(f.type) else f for f in table.schema]))
+    return table.to_pandas()
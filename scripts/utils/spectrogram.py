@@ -0,0 +1,136 @@
+import os
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Close to `sox ... remix 1 rate 24k spectrogram`: 800 columns from 0 to 12 kHz, a Hann window and 120 dB
+# of dynamic range. 513 rows is a DFT of 1024 points at 24 kHz. The raw images are the spectrogram alone.
+X_SIZE = 800
+Y_SIZE = 513
+LEFT, RIGHT, ABOVE, BELOW = 58, 76, 34, 48
+MAX_FREQUENCY = 12000
+DYNAMIC_RANGE = 120
+# palette images like those of sox, a quarter of the time to compress. The last entries are for the text.
+LEVELS = 252
+GREY, WHITE = 252, 253
+
+
+def _palette():
+    # the default colours of sox: black, purple, red, yellow to white
+    x = np.linspace(0, 1, LEVELS)
+    r = np.select([x < .13, x < .73], [0, np.sin((x - .13) / .60 * np.pi / 2)], 1)
+    g = np.select([x < .60, x < .91], [0, np.sin((x - .60) / .31 * np.pi / 2)], 1)
+    b = np.select([x < .60, x < .78], [.5 * np.sin(x / .60 * np.pi), 0], (x - .78) / .22)
+    colours = np.round(np.stack([r, g, b], axis=1) * 255)
+    colours = np.concatenate([colours, [[160, 160, 160], [255, 255, 255], [0, 0, 0], [0, 0, 0]]])
+    return colours.astype(np.uint8)
+
+
+PALETTE = _palette()
+
+
+def _image(index):
+    img = Image.fromarray(np.ascontiguousarray(index))
+    img.putpalette(PALETTE.tobytes())
+    return img
+
+
+@lru_cache(maxsize=8)
+def _window(n_fft):
+    window = np.hanning(n_fft + 1)[:-1].astype(np.float32)
+    # a full scale sine is 0 dB
+    return window, (window.sum() / 2) ** 2
+
+
+@lru_cache(maxsize=8)
+def font(path, size):
+    return ImageFont.truetype(path, size)
+
+
+def levels(samples, rate, columns=X_SIZE, rows=Y_SIZE):
+    """The spectrogram as (rows, columns) palette indices, the highest frequency first"""
+    sig = np.asarray(samples)
+    if sig.dtype == np.int16:
+        sig = sig.astype(np.float32) / 32768
+    # the bins are those of the DFT of 2 * (rows - 1) points at 24 kHz, cut at 12 kHz instead of resampling
+    n_fft = round(2 * (rows - 1) * rate / (2 * MAX_FREQUENCY))
+    window, scale = _window(n_fft)
+    padded = np.pad(sig.astype(np.float32, copy=False), (n_fft // 2, n_fft - n_fft // 2))
+    centres = ((np.arange(columns) + 0.5) * len(sig) / columns).astype(int)
+    frames = np.lib.stride_tricks.sliding_window_view(padded, n_fft)[centres] * window
+    power = np.abs(np.fft.rfft(frames, axis=1)[:, :rows]) ** 2 / scale
+    db = 10 * np.log10(np.maximum(power, 1e-30))
+    index = np.clip((db + DYNAMIC_RANGE) * ((LEVELS - 1) / DYNAMIC_RANGE), 0, LEVELS - 1).astype(np.uint8)
+    if index.shape[1] < rows:
+        # below 24 kHz, there is nothing above the Nyquist frequency
+        index = np.pad(index, ((0, 0), (0, rows - index.shape[1])))
+    return index.T[::-1]
+
+
+def render(samples, rate, raw=False, font_path=None):
+    """The spectrogram image of the samples (the first channel of a 2D array)"""
+    samples = np.asarray(samples)
+    if samples.ndim == 2:
+        samples = samples[:, 0]
+    if raw:
+        return _image(levels(samples, rate))
+
+    rows = Y_SIZE
+    index = np.zeros((Y_SIZE + ABOVE + BELOW, X_SIZE + LEFT + RIGHT), dtype=np.uint8)
+    index[ABOVE:ABOVE + rows, LEFT:LEFT + X_SIZE] = levels(samples, rate, rows=rows)
+    # the colour scale, in dBFS
+    bar_left = LEFT + X_SIZE + 16
+    index[ABOVE:ABOVE + rows, bar_left:bar_left + 12] = np.linspace(LEVELS - 1, 0, rows).astype(np.uint8)[:, np.newaxis]
+    img = _image(index)
+    draw = ImageDraw.Draw(img)
+    label_font = font(font_path, 10) if font_path else ImageFont.load_default()
+    draw.rectangle((LEFT - 1, ABOVE - 1, LEFT + X_SIZE, ABOVE + rows), outline=GREY)
+
+    for khz in range(0, MAX_FREQUENCY // 1000 + 1, 2):
+        y = ABOVE + rows - 1 - round(khz * 1000 / MAX_FREQUENCY * (rows - 1))
+        draw.line((LEFT - 5, y, LEFT - 2, y), fill=GREY)
+        draw.text((LEFT - 8, y), f'{khz}', fill=GREY, font=label_font, anchor='rm')
+    draw.text((14, ABOVE + rows // 2), 'kHz', fill=GREY, font=label_font, anchor='mm')
+
+    duration = len(samples) / rate
+    step = next(step for step in [0.5, 1, 2, 5, 10, 30, 60] if duration / step <= 12)
+    for i in range(int(duration / step) + 1):
+        x = LEFT + round(i * step / duration * (X_SIZE - 1))
+        draw.line((x, ABOVE + rows + 1, x, ABOVE + rows + 4), fill=GREY)
+        draw.text((x, ABOVE + rows + 7), f'{i * step:g}', fill=GREY, font=label_font, anchor='mt')
+
+    for db in range(0, -DYNAMIC_RANGE - 1, -20):
+        y = ABOVE + round(-db / DYNAMIC_RANGE * (rows - 1))
+        draw.text((bar_left + 16, y), f'{db}', fill=GREY, font=label_font, anchor='lm')
+    draw.text((bar_left + 6, ABOVE + rows + 7), 'dBFS', fill=GREY, font=label_font, anchor='mt')
+    return img
+
+
+def annotate(img, title, comment, font_path):
+    # the title centred at the top and the comment (the file) at the bottom left, like the sox -t and -c options
+    draw = ImageDraw.Draw(img)
+    width, height = img.size
+    title_font = font(font_path, 13)
+    _, _, w, _ = draw.textbbox((0, 0), title, font=title_font)
+    draw.text(((width - w) / 2, 6), title, fill=WHITE, font=title_font)
+
+    comment_font = font(font_path, 11)
+    _, _, _, h = draw.textbbox((0, 0), comment, font=comment_font)
+    draw.text((1, height - (h + 1)), comment, fill=WHITE, font=comment_font)
+    return img
+
+
+def save_png(img, out_file):
+    # written aside and moved in place, the web pages never load half a file
+    out_file = os.path.realpath(out_file)
+    fd, tmp_file = tempfile.mkstemp(suffix='.png', dir=os.path.dirname(out_file) or '.')
+    os.close(fd)
+    try:
+        img.save(tmp_file, format='PNG')
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
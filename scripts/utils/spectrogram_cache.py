@@ -0,0 +1,210 @@
+import http.server
+import logging
+import os
+import posixpath
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote, urlsplit
+
+from .db import QUERIES
+from .helpers import DB_PATH, SPECTROGRAM_RENDERER_PORT
+from .reporting import spectrogram
+
+log = logging.getLogger(__name__)
+
+
+class SpectrogramCache:
+    """The spectrograms rendered when they are first requested, in a directory of at most max_bytes.
+
+    The least recently requested are removed first. The order is kept in the modification times of the
+    files, so that it survives a restart.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # one render at a time, the others wait for it and then find it in the cache
+        self._render_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+            if not entry.name.endswith('.png'):
+                # left by an interrupted save_png
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+        with self._lock:
+            self._evict()
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        # the one just added is kept even when it alone is over the limit
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            log.debug('Evicted %s', name)
+
+    def _forget(self, name):
+        with self._lock:
+            size = self._entries.pop(name, None)
+            if size is not None:
+                self._size -= size
+
+    def _lookup(self, clip_file, name):
+        png_file = os.path.join(self.cache_dir, name)
+        try:
+            png_mtime = os.stat(png_file).st_mtime
+        except FileNotFoundError:
+            self._forget(name)
+            return None
+        if png_mtime < os.stat(clip_file).st_mtime:
+            # the clip was written again
+            return None
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        os.utime(png_file)
+        return png_file
+
+    def get(self, clip_file, render, suffix='.png'):
+        """The path of the spectrogram of clip_file, render(clip_file, png_file) when it is not in the cache.
+
+        The suffix tells the renderings of the same clip apart. None when there is no clip.
+        """
+        name = f'{os.path.basename(clip_file)}{suffix}'
+        if not os.path.isfile(clip_file):
+            # deleted or moved to another species
+            self._forget(name)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            return None
+        png_file = self._lookup(clip_file, name)
+        if png_file is not None:
+            return png_file
+
+        with self._render_lock:
+            png_file = self._lookup(clip_file, name)
+            if png_file is not None:
+                return png_file
+            png_file = os.path.join(self.cache_dir, name)
+            render(clip_file, png_file)
+        size = os.stat(png_file).st_size
+        with self._lock:
+            self._size -= self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._size += size
+            self._evict()
+        return png_file
+
+
+def com_name_for(clip_file, db_path=DB_PATH):
+    # the title of the spectrogram, the species of the directory of the clip. A connection of its own,
+    # the requests are served from several threads.
+    dir_name = os.path.basename(os.path.dirname(clip_file))
+    try:
+        con = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        try:
+            row = con.execute(QUERIES['com_name_for_dir'], {'dir_name': dir_name}).fetchone()
+        finally:
+            con.close()
+    except sqlite3.Error as e:
+        log.warning('Cannot read the species: %s', e)
+        row = None
+    return row[0] if row else dir_name.replace('_', ' ')
+
+
+class RendererServer(http.server.ThreadingHTTPServer):
+    """Serves the spectrograms of the clips under extracted_dir/By_Date, at the same paths as their PNG files.
+
+    The web server sends it the requests for the PNG files that do not exist.
+    """
+    daemon_threads = True
+
+    def __init__(self, extracted_dir, cache, raw=0, db_path=DB_PATH, address=('localhost', SPECTROGRAM_RENDERER_PORT)):
+        self.extracted_dir = os.path.realpath(extracted_dir)
+        self.cache = cache
+        self.raw = raw
+        self.db_path = db_path
+        super().__init__(address, RendererRequestHandler)
+
+    @property
+    def suffix(self):
+        # the spectrograms of the other mode are not served, they are evicted in time
+        return '.raw.png' if int(self.raw) else '.png'
+
+    def render(self, clip_file, png_file):
+        # like extract_detection does it
+        spectrogram(clip_file, com_name_for(clip_file, self.db_path), clip_file.replace(os.path.expanduser('~/'), ''), self.raw,
+                    out_file=png_file)
+
+    def clip_file(self, url_path):
+        # /By_Date/<date>/<species>/<clip>.png, nothing outside of By_Date
+        path = posixpath.normpath(unquote(urlsplit(url_path).path))
+        parts = path.split('/')
+        if len(parts) != 5 or parts[1] != 'By_Date' or not path.endswith('.png') or '..' in parts:
+            return None
+        return os.path.join(self.extracted_dir, *parts[1:])[:-len('.png')]
+
+
+class RendererRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self.send_spectrogram(body=False)
+
+    def do_GET(self):
+        self.send_spectrogram()
+
+    def send_spectrogram(self, body=True):
+        clip_file = self.server.clip_file(self.path)
+        if clip_file is None:
+            self.send_error(404)
+            return
+        try:
+            png_file = self.server.cache.get(clip_file, self.server.render, self.server.suffix)
+            if png_file is not None:
+                # read at once, it can be evicted by the next request
+                with open(png_file, 'rb') as f:
+                    data = f.read()
+        except (OSError, RuntimeError) as e:
+            log.warning('Cannot render %s: %s', clip_file, e)
+            self.send_error(500)
+            return
+        if png_file is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        # the clip can be written again under the same name
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
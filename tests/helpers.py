@@ -3,12 +3,18 @@ import os
 TESTDATA = os.path.join(os.path.dirname(__file__), 'testdata')
 
 
+def detection_row(time_, sci_name='Pica pica', com_name='Eurasian Magpie', confidence=0.9, date='2024-02-24'):
+    # a row of the detections view, as the analysis writes it
+    return (date, time_, sci_name, com_name, confidence, 50, 5, 0.7, '8', 1.25, 0.0,
+            f'{com_name}-{int(confidence * 100)}-2024-02-24-birdnet-{time_}.mp3')
+
+
 class Settings(dict):
-    def getint(self, key):
-        return int(self.get(key))
+    def getint(self, key, fallback=None):
+        return int(self.get(key, fallback))
 
-    def getfloat(self, key):
-        return float(self.get(key))
+    def getfloat(self, key, fallback=None):
+        return float(self.get(key, fallback))
 
     @classmethod
     def with_defaults(cls):
@@ -22,6 +28,9 @@ class Settings(dict):
             "EXTRACTION_LENGTH": 6,
             "MODEL": "BirdNET_GLOBAL_6K_V2.4_Model_FP16",
             "DATA_MODEL_VERSION": 1,
+            "MAX_BATCH_SIZE": 8,
+            "RESAMPLER": "polyphase",
+            "ACTIVITY_THRESHOLD": "",
             "SENSITIVITY": 1.25,
             "SF_THRESH": 0.003,
             "APPRISE_NOTIFICATION_TITLE": "New backyard bird!",
@@ -1,11 +1,18 @@
 import os
+import tempfile
 import unittest
 from unittest.mock import patch
 
+import librosa
+import numpy as np
+import pytest
+import soundfile
+
 from scripts.utils.analysis import run_analysis
 from scripts.utils.classes import ParseFileName
+from scripts.utils.models import human_label_indices, top_k
 from tests.helpers import TESTDATA, Settings
-from scripts.utils.analysis import filter_humans
+from scripts.utils.analysis import SpeciesFilter, chunkActivity, decodeAudio, filter_humans, loadCustomSpeciesList, resample, splitSignal
 
 
 class TestRunAnalysis(unittest.TestCase):
@@ -48,6 +55,163 @@ class TestRunAnalysis(unittest.TestCase):
             self.assertEqual(det.scientific_name, expected['sci_name'])
 
 
+def split_signal_reference(sig, rate, overlap, seconds=3.0, minlen=1.5):
+    # the original list based implementation
+    sig_splits = []
+    for i in range(0, len(sig), int((seconds - overlap) * rate)):
+        split = sig[i:i + int(seconds * rate)]
+        if len(split) < int(minlen * rate):
+            break
+        if len(split) < int(rate * seconds):
+            temp = np.zeros((int(rate * seconds)))
+            temp[:len(split)] = split
+            split = temp
+        sig_splits.append(split)
+    return sig_splits
+
+
+class TestSplitSignal(unittest.TestCase):
+
+    def test_split_signal_matches_reference(self):
+        rate = 100
+        rng = np.random.default_rng(1)
+        for length in [0, 100, 149, 150, 299, 300, 301, 449, 450, 1500, 1549, 1550]:
+            for overlap in [0.0, 0.5, 1.5, 2.9]:
+                sig = rng.normal(size=length).astype('float32')
+                chunks = splitSignal(sig, rate, overlap)
+                expected = split_signal_reference(sig, rate, overlap)
+
+                self.assertEqual(chunks.dtype, np.float32)
+                self.assertTrue(chunks.flags['C_CONTIGUOUS'])
+                self.assertEqual(chunks.shape, (len(expected), 300))
+                for chunk, split in zip(chunks, expected):
+                    np.testing.assert_array_equal(chunk, split)
+
+
+class TestDecodeAudio(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.source = os.path.join(TESTDATA, 'Pica pica_30s.wav')
+        self.stereo_file = os.path.join(self.tmp_dir.name, 'stereo.wav')
+        sig, rate = soundfile.read(self.source, dtype='int16')
+        soundfile.write(self.stereo_file, np.stack([sig, sig // 2], axis=1), rate, subtype='PCM_16')
+
+    def test_decode_matches_librosa(self):
+        for path in [self.source, self.stereo_file]:
+            sig, rate = decodeAudio(path, 48000)
+            expected, _ = librosa.load(path, sr=48000, mono=True)
+
+            self.assertEqual(rate, 48000)
+            self.assertEqual(sig.dtype, np.float32)
+            np.testing.assert_allclose(sig, expected, atol=1e-7)
+
+    def test_decode_resamples_in_process(self):
+        sig, rate = decodeAudio(self.stereo_file, 32000)
+
+        self.assertEqual(rate, 32000)
+        self.assertEqual(sig.dtype, np.float32)
+        self.assertEqual(len(sig), 30 * 32000)
+
+
+class TestResample(unittest.TestCase):
+
+    def test_resample_matches_librosa(self):
+        # within 1e-3 of librosa's high quality resampler, with a signal to difference ratio above 50 dB
+        sig, _ = soundfile.read(os.path.join(TESTDATA, 'Pica pica_30s.wav'), dtype='float32')
+        resampled = resample(sig, 48000, 32000)
+        expected = librosa.resample(sig, orig_sr=48000, target_sr=32000, res_type='soxr_hq')
+
+        self.assertEqual(resampled.shape, expected.shape)
+        np.testing.assert_allclose(resampled, expected, atol=1e-3)
+        snr = 10 * np.log10(np.sum(expected ** 2) / np.sum((resampled - expected) ** 2))
+        self.assertGreater(snr, 50)
+
+
+def as_score_matrix(predictions):
+    # labels not in a prediction rank below 100 low-scoring filler labels, like they would in a real model
+    labels = sorted({label for prediction in predictions for label, _ in prediction})
+    labels += [f'Filler_{i}' for i in range(100)]
+    scores = np.zeros((len(predictions), len(labels)), dtype='float32')
+    scores[:, -100:] = 0.001
+    for i, prediction in enumerate(predictions):
+        for label, score in prediction:
+            scores[i, labels.index(label)] = score
+    return scores, labels
+
+
+def as_predictions(scores, labels, keep):
+    # None for the chunks that are dropped
+    indices, scores = top_k(scores, 10)
+    return [[(labels[i], pytest.approx(s)) for i, s in zip(row_indices, row_scores) if s > 0.01] if kept else None
+            for row_indices, row_scores, kept in zip(indices, scores, keep)]
+
+
+class TestChunkActivity(unittest.TestCase):
+
+    def test_gate(self):
+        rate = 48000
+        t = np.arange(3 * rate) / rate
+        rng = np.random.default_rng(0)
+        chunks = np.stack([
+            np.zeros_like(t),  # digital silence
+            1e-5 * rng.normal(size=len(t)),  # noise floor, -100 dBFS
+            0.1 * np.sin(2 * np.pi * 100 * t),  # loud, but below the bird band
+            0.01 * np.sin(2 * np.pi * 3000 * t),  # song in the bird band, -43 dBFS
+        ]).astype('float32')
+
+        np.testing.assert_array_equal(chunkActivity(chunks, rate, -70), [False, False, False, True])
+        np.testing.assert_array_equal(chunkActivity(chunks, rate, -30), [False, False, False, False])
+
+
+class TestSpeciesFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        patcher = patch.dict(os.environ, {'HOME': self.tmp_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_list(self, name, species, mtime):
+        path = os.path.join(self.tmp_dir.name, 'BirdNET-Pi', f'{name}_species_list.txt')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(''.join(f'{sci_name}_Common name\n' for sci_name in species))
+        os.utime(path, ns=(mtime, mtime))
+
+    def test_exclusions(self):
+        species_filter = SpeciesFilter(['Bird a', 'Bird b', 'Bird c', 'Bird d'])
+        predicted = np.array([True, True, False, False])
+
+        # no lists, no location filter
+        np.testing.assert_array_equal(species_filter.exclusions(), [0, 0, 0, 0])
+
+        self.write_list('exclude', ['Bird b'], 1)
+        self.write_list('whitelist', ['Bird d', 'Unknown bird'], 1)
+        np.testing.assert_array_equal(species_filter.exclusions(predicted),
+                                      [0, SpeciesFilter.EXCLUDE, SpeciesFilter.OCCURRENCE, 0])
+
+        # the include list takes precedence
+        self.write_list('include', ['Bird a', 'Bird b'], 1)
+        np.testing.assert_array_equal(species_filter.exclusions(predicted),
+                                      [0, SpeciesFilter.EXCLUDE, SpeciesFilter.INCLUDE, SpeciesFilter.INCLUDE])
+
+    def test_reload_on_change(self):
+        species_filter = SpeciesFilter(['Bird a', 'Bird b'])
+
+        self.write_list('exclude', ['Bird a'], 1)
+        with patch('scripts.utils.analysis.loadCustomSpeciesList', wraps=loadCustomSpeciesList) as mock_load:
+            np.testing.assert_array_equal(species_filter.exclusions(), [SpeciesFilter.EXCLUDE, 0])
+            np.testing.assert_array_equal(species_filter.exclusions(), [SpeciesFilter.EXCLUDE, 0])
+            self.assertEqual(mock_load.call_count, 3)
+
+            self.write_list('exclude', ['Bird b'], 2)
+            np.testing.assert_array_equal(species_filter.exclusions(), [0, SpeciesFilter.EXCLUDE])
+            self.assertEqual(mock_load.call_count, 4)
+
+
 class TestFilterHumans(unittest.TestCase):
 
     @patch('scripts.utils.helpers._load_settings')
@@ -67,7 +231,8 @@ class TestFilterHumans(unittest.TestCase):
         ]
 
         # Run filter_humans
-        result = filter_humans(detections)
+        scores, labels = as_score_matrix(detections)
+        result = as_predictions(scores, labels, filter_humans(scores, human_label_indices(labels)))
 
         # Assertions
         self.assertEqual(result, expected)
@@ -77,16 +242,14 @@ class TestFilterHumans(unittest.TestCase):
         mock_load_settings.return_value = Settings.with_defaults()
 
         # Input detections without humans
-        detections = []
-
-        # Expected output
-        expected = []
+        scores = np.zeros((0, 2), dtype='float32')
+        labels = ['Bird_A', 'Human_Human']
 
         # Run filter_humans
-        result = filter_humans(detections)
+        result = filter_humans(scores, human_label_indices(labels))
 
         # Assertions
-        self.assertEqual(result, expected)
+        self.assertEqual(result.shape, (0,))
 
     @patch('scripts.utils.helpers._load_settings')
     def test_filter_humans_with_human(self, mock_load_settings):
@@ -101,15 +264,11 @@ class TestFilterHumans(unittest.TestCase):
         ]
 
         # Expected output
-        expected = [
-            [('Human_Human', 0.0)],
-            [('Human_Human', 0.0)],
-            [('Human_Human', 0.0)],
-            [('Human_Human', 0.0)]
-        ]
+        expected = [None, None, None, None]
 
         # Run filter_humans
-        result = filter_humans(detections)
+        scores, labels = as_score_matrix(detections)
+        result = as_predictions(scores, labels, filter_humans(scores, human_label_indices(labels)))
 
         # Assertions
         self.assertEqual(result, expected)
@@ -129,13 +288,14 @@ class TestFilterHumans(unittest.TestCase):
         # Expected output
         expected = [
             [('Bird_A', 0.9), ('Bird_B', 0.8)],
-            [('Human_Human', 0.0)],
-            [('Human_Human', 0.0)],
-            [('Human_Human', 0.0)]
+            None,
+            None,
+            None
         ]
 
         # Run filter_humans
-        result = filter_humans(detections)
+        scores, labels = as_score_matrix(detections)
+        result = as_predictions(scores, labels, filter_humans(scores, human_label_indices(labels)))
 
         # Assertions
         self.assertEqual(result, expected)
@@ -144,11 +304,12 @@ class TestFilterHumans(unittest.TestCase):
     def test_filter_humans_with_deep_human(self, mock_load_settings):
         mock_load_settings.return_value = Settings.with_defaults()
 
-        # Input detections with human neighbours
+        # Input detections with a human ranked 11th
+        deep = [(f'Bird_C{i}', 0.7 - i / 100) for i in range(10)]
         detections = [
             [('Bird_A', 0.9), ('Bird_B', 0.8)],
             [('Bird_D', 0.9), ('Bird_E', 0.8)],
-            [('Bird_C', 0.7)] * 10 + [('Human_Human', 0.95)],
+            deep + [('Human_Human', 0.5)],
             [('Bird_F', 0.6), ('Bird_G', 0.5)]
         ]
 
@@ -156,12 +317,44 @@ class TestFilterHumans(unittest.TestCase):
         expected = [
             [('Bird_A', 0.9), ('Bird_B', 0.8)],
             [('Bird_D', 0.9), ('Bird_E', 0.8)],
-            [('Bird_C', 0.7)] * 10,
+            deep,
             [('Bird_F', 0.6), ('Bird_G', 0.5)]
         ]
 
         # Run filter_humans
-        result = filter_humans(detections)
+        scores, labels = as_score_matrix(detections)
+        result = as_predictions(scores, labels, filter_humans(scores, human_label_indices(labels)))
+
+        # Assertions
+        self.assertEqual(result, expected)
+
+    @patch('scripts.utils.helpers._load_settings')
+    def test_filter_humans_skipped_chunks(self, mock_load_settings):
+        mock_load_settings.return_value = Settings.with_defaults()
+
+        # Input detections with chunks skipped by the activity gate (all-zero scores)
+        detections = [
+            [('Bird_A', 0.9), ('Bird_B', 0.8)],
+            [],
+            [('Bird_C', 0.9), ('Bird_D', 0.8)],
+            [('Human_Human', 0.95), ('Bird_E', 0.7)],
+            []
+        ]
+
+        # Expected output
+        expected = [
+            [('Bird_A', 0.9), ('Bird_B', 0.8)],
+            [],
+            None,
+            None,
+            None
+        ]
+
+        # Run filter_humans
+        scores, labels = as_score_matrix(detections)
+        scores[[1, 4]] = 0.0
+        active = np.array([True, False, True, True, False])
+        result = as_predictions(scores, labels, filter_humans(scores, human_label_indices(labels), active))
 
         # Assertions
         self.assertEqual(result, expected)
@@ -172,24 +365,26 @@ class TestFilterHumans(unittest.TestCase):
         settings['PRIVACY_THRESHOLD'] = 1
         mock_load_settings.return_value = settings
 
-        # Input detections with human neighbours
+        # Input detections with a human ranked 11th
+        deep = [(f'Bird_C{i}', 0.7 - i / 100) for i in range(10)]
         detections = [
             [('Bird_A', 0.9), ('Bird_B', 0.8)],
             [('Bird_D', 0.9), ('Bird_E', 0.8)],
-            [('Bird_C', 0.7)] * 10 + [('Human_Human', 0.95)],
+            deep + [('Human_Human', 0.5)],
             [('Bird_F', 0.6), ('Bird_G', 0.5)]
         ]
 
         # Expected output
         expected = [
             [('Bird_A', 0.9), ('Bird_B', 0.8)],
-            [('Human_Human', 0.0)],
-            [('Human_Human', 0.0)],
-            [('Human_Human', 0.0)]
+            None,
+            None,
+            None
         ]
 
         # Run filter_humans
-        result = filter_humans(detections)
+        scores, labels = as_score_matrix(detections)
+        result = as_predictions(scores, labels, filter_humans(scores, human_label_indices(labels)))
 
         # Assertions
         self.assertEqual(result, expected)
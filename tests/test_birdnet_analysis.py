@@ -0,0 +1,341 @@
+import datetime
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from unittest.mock import patch
+
+# the service imports its modules as a script does
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+import birdnet_analysis  # noqa: E402
+from birdnet_analysis import BacklogDrain, Prefetcher, StreamScheduler, analyze_file  # noqa: E402
+from utils.classes import ParseFileName  # noqa: E402
+
+
+def recording(stream='', seconds_ago=30, index=0):
+    date = datetime.datetime.now() - datetime.timedelta(seconds=seconds_ago) + datetime.timedelta(seconds=index)
+    return f'/tmp/StreamData/{date:%Y-%m-%d}-birdnet-{stream}{date:%H:%M:%S}.wav'
+
+
+class TestStreamScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = StreamScheduler(15)
+
+    def get_all(self):
+        self.scheduler.close()
+        return list(iter(self.scheduler.get, None))
+
+    def test_round_robin(self):
+        files = {stream: [recording(stream, index=i) for i in range(3)] for stream in ['RTSP_1-', 'RTSP_2-']}
+        local = recording()
+        for file_name in files['RTSP_1-'] + files['RTSP_2-'][:1] + [local]:
+            self.scheduler.put(file_name)
+        # a busy stream does not hold up the others
+        self.assertEqual([file.file_name for file in [self.scheduler.get() for _ in range(3)]], [files['RTSP_1-'][0], files['RTSP_2-'][0], local])
+
+        for file_name in files['RTSP_2-'][1:]:
+            self.scheduler.put(file_name)
+        self.assertEqual([file.file_name for file in self.get_all()],
+                         [files['RTSP_1-'][1], files['RTSP_2-'][1], files['RTSP_1-'][2], files['RTSP_2-'][2]])
+
+    def test_live_before_backlog(self):
+        backlog = [recording(seconds_ago=3600, index=i) for i in range(2)]
+        for file_name in backlog:
+            self.scheduler.put(file_name, backlog=True)
+        live = recording('RTSP_1-')
+        self.scheduler.put(live)
+        # not a recording, it is left out
+        with self.assertLogs('birdnet_analysis', 'ERROR'):
+            self.scheduler.put('/tmp/StreamData/notes.wav')
+        self.assertEqual([file.file_name for file in self.get_all()], [live] + backlog)
+
+    def test_lag(self):
+        self.scheduler.put(recording('RTSP_1-', seconds_ago=20))
+        self.scheduler.put(recording('RTSP_1-', seconds_ago=10))
+        self.scheduler.done(self.scheduler.get())
+        with self.assertLogs('birdnet_analysis', 'INFO') as cm:
+            self.scheduler.log_lag(interval=0)
+        self.assertEqual(len(cm.output), 1)
+        self.assertRegex(cm.output[0], r'RTSP_1: [56]\.\ds lag, 1 recordings waiting')
+
+        # more than three recordings behind
+        self.scheduler.put(recording('RTSP_1-', seconds_ago=300))
+        self.scheduler.get()
+        with self.assertLogs('birdnet_analysis', 'WARNING') as cm:
+            self.scheduler.done(self.scheduler.get())
+        self.assertRegex(cm.output[0], 'RTSP_1 is falling behind: 28[56]s lag, 0 recordings waiting')
+
+    def test_backlog_done(self):
+        backlog = [recording(seconds_ago=3600, index=i) for i in range(2)]
+        for file_name in backlog:
+            self.scheduler.put(file_name, backlog=True)
+        first, second = self.scheduler.get(), self.scheduler.get()
+        with self.assertNoLogs('birdnet_analysis', 'INFO'):
+            self.scheduler.done(first)
+        with self.assertLogs('birdnet_analysis', 'INFO') as cm:
+            self.scheduler.done(second)
+        self.assertEqual(cm.output, ['INFO:birdnet_analysis:backlog done'])
+        # the backlog is not in the lag of the streams
+        with self.assertNoLogs('birdnet_analysis', 'INFO'):
+            self.scheduler.log_lag(interval=0)
+
+    def test_close_wakes_workers(self):
+        results = []
+        workers = [threading.Thread(target=lambda: results.append(self.scheduler.get())) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        file_name = recording()
+        self.scheduler.put(file_name)
+        self.scheduler.close()
+        for worker in workers:
+            worker.join(timeout=5)
+            self.assertFalse(worker.is_alive())
+        # the recording is still handed out, then None to every thread
+        self.assertEqual([file.file_name for file in results if file is not None], [file_name])
+        self.assertEqual(results.count(None), 2)
+
+
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.scheduler = StreamScheduler(15)
+        patcher = patch.object(birdnet_analysis, 'load_audio', side_effect=self.load_audio)
+        self.mock_load_audio = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.barrier = None
+
+    def load_audio(self, file_name, model):
+        if self.barrier is not None:
+            self.barrier.wait(5)
+        if 'broken' in model:
+            raise ValueError('cannot decode')
+        return f'{os.path.basename(file_name)} for {model}'
+
+    def put(self, stream='', seconds_ago=30, size=100, **kwargs):
+        file_name = os.path.join(self.tmp_dir.name, os.path.basename(recording(stream, seconds_ago)))
+        with open(file_name, 'wb') as f:
+            f.write(b'\0' * size)
+        self.scheduler.put(file_name, **kwargs)
+        return file_name
+
+    def prefetcher(self, model='model'):
+        prefetcher = Prefetcher(self.scheduler, model)
+        self.addCleanup(prefetcher.close)
+        self.addCleanup(self.scheduler.close)
+        return prefetcher
+
+    def test_decoded_ahead(self):
+        backlog = [self.put(seconds_ago=3600 - i, backlog=True) for i in range(3)]
+        prefetcher = self.prefetcher()
+        file, audio = prefetcher.get()
+        self.assertEqual((file.file_name, audio.result()), (backlog[0], f'{os.path.basename(backlog[0])} for model'))
+
+        # only the next recording is taken ahead, a live one is analysed right after it
+        while self.mock_load_audio.call_count < 2:
+            time.sleep(0.01)
+        live = self.put('RTSP_1-')
+        self.assertEqual([prefetcher.get()[0].file_name for _ in range(3)], [backlog[1], live, backlog[2]])
+        self.scheduler.close()
+        self.assertIsNone(prefetcher.get())
+
+    def test_depth(self):
+        backlog = [self.put(seconds_ago=3600 - i, backlog=True) for i in range(4)]
+        prefetcher = Prefetcher(self.scheduler, 'model', depth=2)
+        self.addCleanup(prefetcher.close)
+        self.addCleanup(self.scheduler.close)
+        self.assertEqual(prefetcher.get()[0].file_name, backlog[0])
+        # two recordings are decoded ahead of the one being analysed
+        while self.mock_load_audio.call_count < 3:
+            time.sleep(0.01)
+        live = self.put('RTSP_1-')
+        self.assertEqual([prefetcher.get()[0].file_name for _ in range(3)], [backlog[1], backlog[2], live])
+
+    def test_decoded_in_parallel(self):
+        # each decode waits for the other one
+        self.barrier = threading.Barrier(2)
+        prefetchers = [self.prefetcher(f'model {i}') for i in range(2)]
+        self.put('RTSP_1-')
+        self.put('RTSP_2-')
+        audio = [prefetcher.get()[1].result() for prefetcher in prefetchers]
+        self.assertEqual([name.split(' for ')[1] for name in audio], ['model 0', 'model 1'])
+
+    def test_errors(self):
+        empty = self.put(size=0)
+        self.put('RTSP_1-')
+        prefetcher = self.prefetcher('broken model')
+        # removed by process_file
+        file, audio = prefetcher.get()
+        self.assertEqual(file.file_name, empty)
+        self.assertIsNone(audio.result())
+        # raised in the analysis thread
+        file, audio = prefetcher.get()
+        with self.assertRaises(ValueError):
+            audio.result()
+
+    def test_close(self):
+        prefetcher = self.prefetcher()
+        getting = threading.Thread(target=prefetcher.get)
+        getting.start()
+        self.scheduler.close()
+        getting.join(timeout=5)
+        self.assertFalse(getting.is_alive())
+        prefetcher.close()
+        self.mock_load_audio.assert_not_called()
+
+
+class TestBacklogDrain(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        # the files are analysed on threads, once their event is set
+        patcher = patch.object(birdnet_analysis, 'ProcessPoolExecutor', lambda max_workers, **kwargs: ThreadPoolExecutor(max_workers))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(birdnet_analysis, 'analyze_file', side_effect=self.analyze_file)
+        self.mock_analyze = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.analyzed = {}
+        self.broken = set()
+        self.report_queue = Queue()
+
+    def analyze_file(self, file_name):
+        self.analyzed[file_name].wait(5)
+        if file_name in self.broken:
+            raise ValueError('cannot decode')
+        return ParseFileName(file_name), []
+
+    def backlog(self, times, size=100):
+        backlog = []
+        for time_ in times:
+            file_name = os.path.join(self.tmp_dir.name, f'2024-02-24-birdnet-{time_}.wav')
+            with open(file_name, 'wb') as f:
+                f.write(b'\0' * size)
+            self.analyzed[file_name] = threading.Event()
+            backlog.append(file_name)
+        return backlog
+
+    def reported(self, count):
+        files = []
+        for _ in range(count):
+            file, _ = self.report_queue.get(timeout=5)
+            files.append(file.file_name)
+        return files
+
+    def report_when_ready(self, drain, count):
+        for _ in range(100):
+            drain.report_ready(self.report_queue)
+            if self.report_queue.qsize() >= count:
+                break
+            time.sleep(0.05)
+        return self.reported(count)
+
+    def test_timestamp_order(self):
+        first, second, third = self.backlog(['16:19:07', '16:19:22', '16:19:37'])
+        drain = BacklogDrain([third, first, second], 3)
+        self.addCleanup(drain.close)
+
+        # the head of the queue holds back the files after it
+        self.analyzed[second].set()
+        self.analyzed[third].set()
+        time.sleep(0.1)
+        drain.report_ready(self.report_queue)
+        self.assertTrue(self.report_queue.empty())
+        self.assertFalse(drain.done())
+
+        self.analyzed[first].set()
+        self.assertEqual(self.report_when_ready(drain, 3), [first, second, third])
+        self.assertTrue(drain.done())
+
+    def test_report_queue_full(self):
+        files = self.backlog(['16:19:07', '16:19:22', '16:19:37'])
+        for event in self.analyzed.values():
+            event.set()
+        drain = BacklogDrain(files, 3)
+        self.addCleanup(drain.close)
+        while not all(future.done() for _, future in drain._pending):
+            time.sleep(0.01)
+
+        # one slot is left to the live recordings, the event loop is not held up
+        self.report_queue = Queue(maxsize=3)
+        drain.report_ready(self.report_queue)
+        self.assertEqual(self.reported(2), files[:2])
+        self.report_queue.put('live')
+        self.report_queue.put('live')
+        drain.report_ready(self.report_queue)
+        self.assertEqual(self.report_queue.qsize(), 2)
+        self.assertFalse(drain.done())
+
+        self.report_queue.get()
+        self.report_queue.get()
+        drain.report_ready(self.report_queue)
+        self.assertEqual(self.reported(1), files[2:])
+        self.assertTrue(drain.done())
+
+    def test_empty_and_broken_files(self):
+        files = self.backlog(['16:19:07', '16:19:22'])
+        empty = self.backlog(['16:19:37'], size=0)[0]
+        broken = self.backlog(['16:19:52'])[0]
+        self.broken.add(broken)
+        missing = os.path.join(self.tmp_dir.name, '2024-02-24-birdnet-16:20:07.wav')
+        for event in self.analyzed.values():
+            event.set()
+
+        with self.assertLogs('birdnet_analysis', 'WARNING'):
+            drain = BacklogDrain(files + [empty, broken, missing], 2)
+        self.assertFalse(os.path.exists(empty))
+        with self.assertLogs('birdnet_analysis', 'ERROR') as cm:
+            drain.finish(self.report_queue)
+        self.assertIn(f'Unexpected error analyzing {broken}', cm.output[0])
+        self.assertEqual(self.reported(2), files)
+        self.assertTrue(self.report_queue.empty())
+        self.assertEqual(sorted(call.args[0] for call in self.mock_analyze.call_args_list), files + [broken])
+
+    def test_close(self):
+        files = self.backlog(['16:19:07', '16:19:22', '16:19:37'])
+        drain = BacklogDrain(files, 1)
+        while not self.mock_analyze.called:
+            time.sleep(0.01)
+        # the file being analysed is finished, the others are left for the next start
+        closing = threading.Thread(target=drain.close)
+        closing.start()
+        self.analyzed[files[0]].set()
+        closing.join(timeout=5)
+        self.assertFalse(closing.is_alive())
+        self.assertEqual([call.args[0] for call in self.mock_analyze.call_args_list], files[:1])
+        self.assertTrue(all(os.path.exists(file_name) for file_name in files))
+
+    def test_lower_priority(self):
+        with patch.object(birdnet_analysis, 'signal'), patch.object(birdnet_analysis, 'setup_logging'), \
+                patch.object(birdnet_analysis, 'load_global_model') as mock_load, \
+                patch.object(birdnet_analysis.os, 'nice') as mock_nice:
+            birdnet_analysis.init_worker()
+            mock_nice.assert_called_once_with(10)
+            mock_load.assert_called_once()
+
+            # not allowed, the backlog is analysed anyway
+            mock_nice.side_effect = PermissionError('not permitted')
+            with self.assertLogs('birdnet_analysis', 'WARNING'):
+                birdnet_analysis.init_worker()
+            self.assertEqual(mock_load.call_count, 2)
+
+    def test_analyzing_now(self):
+        analyzing_now = os.path.join(self.tmp_dir.name, 'analyzing_now.txt')
+        file_name = self.backlog(['16:19:07'])[0]
+        with patch.object(birdnet_analysis, 'ANALYZING_NOW', analyzing_now), \
+                patch.object(birdnet_analysis, 'run_analysis', return_value=[]) as mock_run_analysis:
+            file, detections = analyze_file(file_name)
+        mock_run_analysis.assert_called_once_with(file)
+        with open(analyzing_now) as f:
+            self.assertEqual(f.read(), file_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import http.server
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import soundfile
+
+from scripts.utils import birdweather
+from scripts.utils.birdweather import BirdWeatherUploader, Outbox
+from scripts.utils.classes import Detection, ParseFileName
+from scripts.utils.reporting import Recording, bird_weather
+
+from tests.helpers import TESTDATA, Settings
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # keep-alive, like the BirdWeather API
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, self.client_address, body))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        if self.path.startswith('/stations/abc/soundscapes') and status == 200:
+            data = {'success': True, 'soundscape': {'id': len(self.server.requests)}}
+        else:
+            data = {'success': status == 200, 'message': 'stub'}
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.outbox = Outbox(os.path.join(self.tmp_dir.name, 'outbox'))
+
+        self.server = http.server.ThreadingHTTPServer(('localhost', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        # the statuses of the next responses, 200 after them
+        self.server.statuses = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+        self.uploader = BirdWeatherUploader(self.outbox, 'abc', base_url=f'http://localhost:{self.server.server_address[1]}',
+                                            timeout=5, max_attempts=3, backoff=0.05)
+        self.addCleanup(self.uploader.close)
+
+    def put(self, timestamp, count=2):
+        detections = [{'timestamp': timestamp, 'commonName': 'Eurasian Magpie', 'confidence': 0.9 - i / 10} for i in range(count)]
+        return self.outbox.put(timestamp, b'fLaC' + timestamp.encode(), detections)
+
+    def paths(self):
+        return [path.split('?')[0].rsplit('/', 1)[1] for path, _, _ in self.server.requests]
+
+    def test_send(self):
+        self.put('2024-02-24T16:19:37+01:00')
+        self.put('2024-02-24T16:19:52+01:00', count=1)
+        self.assertIsNone(self.uploader.send_pending())
+
+        self.assertEqual(self.paths(), ['soundscapes', 'detections', 'detections', 'soundscapes', 'detections'])
+        path, _, body = self.server.requests[0]
+        self.assertEqual((path, body), ('/stations/abc/soundscapes?timestamp=2024-02-24T16:19:37+01:00', b'fLaC2024-02-24T16:19:37+01:00'))
+        detections = [json.loads(body) for path, _, body in self.server.requests if 'detections' in path]
+        self.assertEqual([(d['soundscapeId'], d['confidence']) for d in detections], [(1, 0.9), (1, 0.8), (4, 0.9)])
+        # one connection for all of them
+        self.assertEqual(len({client for _, client, _ in self.server.requests}), 1)
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_retry(self):
+        name = self.put('2024-02-24T16:19:37+01:00')
+        # the server is busy, then a detection fails
+        self.server.statuses = [503, 200, 200, 502]
+        self.assertEqual(self.uploader.send_pending(), 0.05)
+        self.assertEqual(self.outbox.load(name)['attempts'], 1)
+        self.assertEqual(self.uploader.send_pending(), 0.1)
+        upload = self.outbox.load(name)
+        self.assertEqual((upload['soundscape_id'], upload['attempts']), (2, 2))
+        self.assertIsNone(self.uploader.send_pending())
+
+        # the soundscape is not sent again and the first detection is sent once
+        self.assertEqual(self.paths(), ['soundscapes', 'soundscapes', 'detections', 'detections', 'detections'])
+        self.assertEqual(len(self.outbox), 0)
+
+        # dropped after max_attempts
+        self.put('2024-02-24T16:19:52+01:00')
+        self.server.statuses = [500] * 3
+        for delay in [0.05, 0.1, 0.2]:
+            self.assertEqual(self.uploader.send_pending(), delay)
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_refused(self):
+        self.put('2024-02-24T16:19:37+01:00')
+        self.put('2024-02-24T16:19:52+01:00', count=1)
+        # an unknown station, the next upload is sent
+        self.server.statuses = [404]
+        self.assertIsNone(self.uploader.send_pending())
+        self.assertEqual(self.paths(), ['soundscapes', 'soundscapes', 'detections'])
+
+        # a refused detection, the next one of the recording is sent
+        self.put('2024-02-24T16:20:07+01:00')
+        self.server.statuses = [200, 400]
+        with self.assertLogs('scripts.utils.birdweather', 'ERROR'):
+            self.assertIsNone(self.uploader.send_pending())
+        self.assertEqual(self.paths()[3:], ['soundscapes', 'detections', 'detections'])
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_unreachable(self):
+        self.put('2024-02-24T16:19:37+01:00')
+        uploader = BirdWeatherUploader(self.outbox, 'abc', base_url='http://localhost:1', timeout=5, backoff=0.05)
+        self.addCleanup(uploader.close)
+        self.assertEqual(uploader.send_pending(), 0.05)
+        self.assertEqual(len(self.outbox), 1)
+
+    def test_thread_and_restart(self):
+        self.put('2024-02-24T16:19:37+01:00')
+        self.uploader.start()
+        self.put('2024-02-24T16:19:52+01:00')
+        for _ in range(100):
+            if len(self.outbox) == 0:
+                break
+            threading.Event().wait(0.05)
+        self.assertEqual(self.paths(), ['soundscapes', 'detections', 'detections'] * 2)
+
+        # an interrupted put leaves a FLAC file alone, removed on the next start
+        open(os.path.join(self.outbox.outbox_dir, '00000000000000000001.flac'), 'w').close()
+        name = self.put('2024-02-24T16:20:07+01:00')
+        self.uploader.close()
+        outbox = Outbox(self.outbox.outbox_dir)
+        self.assertEqual(outbox.names(), [name])
+        self.assertEqual(sorted(os.listdir(outbox.outbox_dir)), [f'{name}.flac', f'{name}.json'])
+
+    def test_outbox_full(self):
+        names = [self.put(f'2024-02-24T16:19:{second}+01:00') for second in [37, 52]]
+        self.outbox.max_bytes = sum(self.outbox.size(name) for name in names) + 10
+        names.append(self.put('2024-02-24T16:20:07+01:00'))
+        self.assertEqual(self.outbox.names(), names[1:])
+
+        # the newest alone is kept
+        self.outbox.max_bytes = 10
+        names.append(self.put('2024-02-24T16:20:22+01:00'))
+        self.assertEqual(self.outbox.names(), names[3:])
+
+
+class TestBirdWeather(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.settings = Settings.with_defaults()
+        self.settings.update({'BIRDWEATHER_ID': 'abc', 'RECS_DIR': self.tmp_dir.name})
+        patcher = patch('scripts.utils.helpers._load_settings', return_value=self.settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(birdweather, '_OUTBOX', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flac_from_recording(self):
+        source = os.path.join(TESTDATA, 'Pica pica_30s.wav')
+        file = ParseFileName(os.path.join(self.tmp_dir.name, '2024-02-24-birdnet-16:19:37.wav'))
+        detections = [Detection(file.file_date, 9.0, 12.0, 'Pica pica', 'Eurasian Magpie', 0.9)]
+        recording = Recording(source)
+        recording.clip(7.5, 13.5)
+
+        with patch('scripts.utils.reporting.soundfile.read') as mock_read:
+            bird_weather(file, detections, recording)
+        mock_read.assert_not_called()
+
+        outbox = birdweather.get_outbox()
+        self.assertEqual((outbox.outbox_dir, outbox.max_bytes), (os.path.join(self.tmp_dir.name, 'BirdWeather'), 200 * 1024 * 1024))
+        [name] = outbox.names()
+        upload = outbox.load(name)
+        self.assertEqual(upload['timestamp'], file.iso8601)
+        self.assertEqual([(d['scientificName'], d['soundscapeStartTime'], d['algorithm']) for d in upload['detections']],
+                         [('Pica pica', 9.0, '2p4')])
+        samples, rate = soundfile.read(io.BytesIO(outbox.flac(name)), dtype='int16', always_2d=True)
+        expected, _ = soundfile.read(source, dtype='int16', always_2d=True)
+        self.assertEqual(rate, 48000)
+        np.testing.assert_array_equal(samples, expected)
+
+    def test_not_configured(self):
+        self.settings['BIRDWEATHER_ID'] = ''
+        file = ParseFileName(os.path.join(self.tmp_dir.name, '2024-02-24-birdnet-16:19:37.wav'))
+        bird_weather(file, [Detection(file.file_date, 9.0, 12.0, 'Pica pica', 'Eurasian Magpie', 0.9)])
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
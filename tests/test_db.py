@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from datetime import date
+from unittest.mock import patch
+
+from scripts.utils import db
+from scripts.utils.db import QUERIES, DetectionWriter, WriterClient, WriterServer
+from scripts.utils.schema import create_db
+
+from tests.helpers import detection_row
+
+
+class TestDetectionWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db_path = os.path.join(self.tmp_dir.name, 'birds.db')
+        create_db(self.db_path)
+        self.writer = DetectionWriter(self.db_path, timeout=0.2)
+        self.addCleanup(self.writer.close)
+
+    def count(self):
+        with sqlite3.connect(self.db_path) as con:
+            return con.execute('SELECT COUNT(*) FROM detections').fetchone()[0]
+
+    def test_insert_file(self):
+        self.writer.insert([detection_row('16:19:37'), detection_row('16:19:40')])
+        self.writer.insert([detection_row('16:19:43')])
+
+        self.assertEqual(self.count(), 3)
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(con.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    def test_busy_is_bounded(self):
+        self.writer.insert([detection_row('16:19:37')])
+        blocker = sqlite3.connect(self.db_path, isolation_level=None)
+        blocker.execute('BEGIN IMMEDIATE')
+
+        start = time.monotonic()
+        with self.assertRaises(sqlite3.OperationalError):
+            self.writer.insert([detection_row('16:19:40'), detection_row('16:19:43')])
+        self.assertLess(time.monotonic() - start, 2)
+
+        # nothing of the failed recording was written, and the writer recovers
+        blocker.execute('ROLLBACK')
+        blocker.close()
+        self.assertEqual(self.count(), 1)
+        self.writer.insert([detection_row('16:19:40'), detection_row('16:19:43')])
+        self.assertEqual(self.count(), 3)
+
+
+class TestWriterServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db_path = os.path.join(self.tmp_dir.name, 'birds.db')
+        self.socket_path = os.path.join(self.tmp_dir.name, 'db_writer.sock')
+        create_db(self.db_path)
+
+    def start_server(self):
+        server = WriterServer(self.socket_path, self.db_path, timeout=0.2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            if thread.is_alive():
+                server.shutdown()
+                thread.join()
+                server.server_close()
+        self.addCleanup(stop)
+        return stop
+
+    def client(self):
+        client = WriterClient(self.socket_path, self.db_path)
+        self.addCleanup(client.close)
+        return client
+
+    def rows(self):
+        with sqlite3.connect(self.db_path) as con:
+            return con.execute('SELECT Time, Sci_Name FROM detections ORDER BY Time').fetchall()
+
+    def test_concurrent_clients(self):
+        self.start_server()
+
+        def insert(i):
+            client = self.client()
+            for j in range(5):
+                client.insert([detection_row(f'16:{i:02d}:{j:02d}'), detection_row(f'17:{i:02d}:{j:02d}')])
+        threads = [threading.Thread(target=insert, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.rows()), 40)
+
+    def test_update_and_errors(self):
+        self.start_server()
+        client = self.client()
+        client.insert([detection_row('16:19:37'), detection_row('16:19:40')])
+
+        # the changes made through the detections view are not counted
+        rowcount = client.execute('UPDATE detection_data SET Confidence = ? WHERE Time = ?', [(0.5, '16:19:40')])
+        self.assertEqual(rowcount, 1)
+        client.execute('UPDATE detections SET Sci_Name = ? WHERE Time = ?', [('Corvus corone', '16:19:40')])
+        with self.assertRaises(sqlite3.OperationalError):
+            client.execute('UPDATE no_such_table SET x = 1')
+        # the connection is still usable after an error
+        client.insert([detection_row('16:19:43')])
+
+        self.assertEqual(self.rows(), [('16:19:37', 'Pica pica'), ('16:19:40', 'Corvus corone'), ('16:19:43', 'Pica pica')])
+
+    def test_server_restarted(self):
+        stop = self.start_server()
+        client = self.client()
+        client.insert([detection_row('16:19:37')])
+
+        # the connection to the first server is closed, the write is sent again to the next one
+        stop()
+        stop = self.start_server()
+        with self.assertLogs('scripts.utils.db', 'WARNING'):
+            client.insert([detection_row('16:19:40')])
+
+        # the server is gone, the client writes itself
+        stop()
+        with self.assertLogs('scripts.utils.db', 'WARNING'):
+            client.insert([detection_row('16:19:43')])
+        self.assertEqual([time for time, _ in self.rows()], ['16:19:37', '16:19:40', '16:19:43'])
+
+    def test_direct_without_server(self):
+        client = self.client()
+        client.insert([detection_row('16:19:37')])
+
+        self.assertEqual(self.rows(), [('16:19:37', 'Pica pica')])
+
+
+class TestQueries(unittest.TestCase):
+    # SCAN CONSTANT ROW is a SELECT of subqueries, species_totals and species have one row per species
+    full_scans = {'CONSTANT', 'species_totals', 'species'}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db_path = os.path.join(self.tmp_dir.name, 'birds.db')
+        create_db(self.db_path)
+        for patcher in [patch.object(db, 'DB_PATH', self.db_path), patch.object(db, '_DB', None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        db.get_db().close()
+
+    def test_queries_use_indexes(self):
+        params = {'today': '2024-02-24', 'date': '2024-02-24', 'sci_name': 'Pica pica', 'start': '2024-02-01', 'end': '2024-02-24',
+                  'dir_name': 'Eurasian_Magpie'}
+        for name, sql in QUERIES.items():
+            with self.subTest(name):
+                plan = [row['detail'] for row in db.get_db().execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+                scans = [step for step in plan if step.startswith('SCAN ') and ' USING ' not in step and step.split()[1] not in self.full_scans]
+                self.assertEqual(scans, [], plan)
+
+    def test_bound_parameters(self):
+        today = date.today().isoformat()
+        writer = DetectionWriter(self.db_path)
+        writer.insert([detection_row('06:10:00', "Anser d'Arnaudi", date=today),
+                       detection_row('06:20:00', "Anser d'Arnaudi", date=today),
+                       detection_row('06:30:00', date=today)])
+        writer.close()
+
+        self.assertEqual(db.get_todays_count_for("Anser d'Arnaudi"), 2)
+        self.assertEqual(db.get_this_weeks_count_for("Anser d'Arnaudi"), 2)
+        self.assertEqual(db.get_todays_count_for('Corvus corone'), 0)
+        self.assertEqual([row.Sci_Name for row in db.get_species_by('occurrences', today)], ["Anser d'Arnaudi", 'Pica pica'])
+        self.assertEqual(db.get_species_by('date', '2024-02-23'), [])
+        self.assertEqual(db.get_latest().Time, '06:30:00')
+
+
+if __name__ == '__main__':
+    unittest.main()
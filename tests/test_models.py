@@ -0,0 +1,256 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from scripts.utils.models import MAX_OCCURRENCE_TABLES, BirdNetV1, BirdNetV2_4, MDataModel2, Perch, SpeciesGrid, top_k
+
+
+class FakeInterpreter:
+    """Stands in for tflite.Interpreter: the logits of a chunk are its first n_labels samples"""
+    n_labels = 4
+
+    def __init__(self, model_path):
+        self.shape = [1, 16]
+        self.invocations = []
+        self.tensor = None
+
+    def allocate_tensors(self):
+        pass
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self.shape)}]
+
+    def get_output_details(self):
+        return [{'index': 1}] * 4
+
+    def resize_tensor_input(self, index, shape):
+        self.shape = list(shape)
+
+    def set_tensor(self, index, value):
+        assert list(value.shape) == self.shape
+        self.tensor = value
+
+    def invoke(self):
+        self.invocations.append(len(self.tensor))
+
+    def get_tensor(self, index):
+        return self.tensor[:, :self.n_labels].copy()
+
+
+class FakeV1Interpreter(FakeInterpreter):
+    """With the second input of BirdNET V1, the metadata"""
+    mdata_index = 2
+
+    def __init__(self, model_path):
+        super().__init__(model_path)
+        self.mdata_shape = [1, 6]
+
+    def get_input_details(self):
+        return super().get_input_details() + [{'index': self.mdata_index, 'shape': np.array(self.mdata_shape)}]
+
+    def resize_tensor_input(self, index, shape):
+        if index == self.mdata_index:
+            self.mdata_shape = list(shape)
+        else:
+            super().resize_tensor_input(index, shape)
+
+    def set_tensor(self, index, value):
+        if index == self.mdata_index:
+            assert list(value.shape) == self.mdata_shape
+        else:
+            super().set_tensor(index, value)
+
+
+def static_batch(index, shape):
+    # like a model with a fixed batch size, which can be resized to the size it has
+    if shape[0] != 1:
+        raise ValueError('static shape')
+
+
+def allocation_fails(interpreter):
+    # the resize is accepted, the allocation is not
+    def allocate_tensors():
+        if interpreter.shape[0] != 1:
+            raise RuntimeError('cannot allocate')
+    return allocate_tensors
+
+
+@patch('scripts.utils.models.get_model_labels', return_value=['A_a', 'B_b', 'C_c', 'D_d'])
+@patch('scripts.utils.models.tflite.Interpreter', FakeInterpreter)
+class TestPredictBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.chunks = np.random.default_rng(42).normal(size=(5, 16)).astype('float32')
+
+    @patch('scripts.utils.models.get_meta_model')
+    def test_birdnet_batch_matches_single(self, mock_get_meta_model, mock_labels):
+        model = BirdNetV2_4(1.0, max_batch_size=2)
+        batched = model.predict_batch(self.chunks)
+
+        self.assertEqual(model.interpreter.invocations, [2, 2, 1])
+        self.assertEqual(batched.shape, (len(self.chunks), 4))
+        for chunk, prediction in zip(self.chunks, batched):
+            np.testing.assert_array_equal(model.predict(chunk), prediction)
+
+    def test_perch_softmax_per_chunk(self, mock_labels):
+        model = Perch(max_batch_size=8)
+        batched = model.predict_batch(self.chunks)
+
+        self.assertEqual(model.interpreter.invocations, [5])
+        np.testing.assert_allclose(batched.sum(axis=1), 1.0, rtol=1e-5)
+
+    @patch('scripts.utils.models.get_meta_model')
+    def test_fallback_to_single_chunks(self, mock_get_meta_model, mock_labels):
+        model = BirdNetV2_4(1.0, max_batch_size=4)
+        with patch.object(model.interpreter, 'resize_tensor_input', side_effect=static_batch):
+            batched = model.predict_batch(self.chunks)
+
+        self.assertEqual(model.max_batch_size, 1)
+        self.assertEqual(model.interpreter.invocations, [1] * 5)
+        self.assertEqual(len(batched), len(self.chunks))
+
+    @patch('scripts.utils.models.get_meta_model')
+    def test_fallback_when_allocation_fails(self, mock_get_meta_model, mock_labels):
+        model = BirdNetV2_4(1.0, max_batch_size=4)
+        expected = [model.predict(chunk) for chunk in self.chunks]
+        model.interpreter.invocations = []
+        with patch.object(model.interpreter, 'allocate_tensors', side_effect=allocation_fails(model.interpreter)):
+            batched = model.predict_batch(self.chunks)
+
+        self.assertEqual(model.max_batch_size, 1)
+        self.assertEqual(model.interpreter.invocations, [1] * 5)
+        np.testing.assert_array_equal(batched, expected)
+
+    def test_fallback_restores_metadata_input(self, mock_labels):
+        with patch('scripts.utils.models.tflite.Interpreter', FakeV1Interpreter):
+            model = BirdNetV1(1.0, max_batch_size=4)
+        model.set_meta_data(50, 5, 10)
+        with patch.object(model.interpreter, 'allocate_tensors', side_effect=allocation_fails(model.interpreter)):
+            batched = model.predict_batch(self.chunks)
+
+        self.assertEqual((model.interpreter.shape, model.interpreter.mdata_shape), ([1, 16], [1, 6]))
+        self.assertEqual(model.interpreter.invocations, [1] * 5)
+        self.assertEqual(len(batched), len(self.chunks))
+
+
+class FakeMDataInterpreter:
+    """Stands in for the occurrence model: the score of label i is (lat + lon + week + i) / 1000"""
+
+    def __init__(self, model_path):
+        self.invocations = 0
+
+    def allocate_tensors(self):
+        pass
+
+    def get_input_details(self):
+        return [{'index': 0}]
+
+    def get_output_details(self):
+        return [{'index': 1}]
+
+    def set_tensor(self, index, value):
+        self.sample = value
+
+    def invoke(self):
+        self.invocations += 1
+
+    def get_tensor(self, index):
+        return (self.sample.sum() + np.arange(5, dtype='float32'))[np.newaxis] / 1000
+
+
+@patch('scripts.utils.models.tflite.Interpreter', FakeMDataInterpreter)
+class TestOccurrenceTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = patch('scripts.utils.models.OCCURRENCE_PATH', self.tmp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_table_matches_inference(self):
+        model = MDataModel2(0.03)
+        model.set_meta_data(10.0, 20.0, 5)
+        scores = model._get_scores()
+
+        self.assertEqual(model.interpreter.invocations, model.weeks)
+        np.testing.assert_allclose(scores, (35 + np.arange(5)) / 1000)
+        self.assertTrue(os.path.exists(model.occurrence_file(10.0, 20.0)))
+
+        # another week does not run the model again
+        model.set_meta_data(10.0, 20.0, 53)
+        np.testing.assert_allclose(model._get_scores(), (83 + np.arange(5)) / 1000)
+        self.assertEqual(model.interpreter.invocations, model.weeks)
+
+    def test_table_loaded_from_disk(self):
+        MDataModel2(0.03).get_occurrence_table(10.0, 20.0)
+
+        model = MDataModel2(0.0375)
+        model.set_meta_data(10.0, 20.0, 5)
+        self.assertEqual(model.get_species_list(['A', 'B', 'C', 'D', 'E']), ['E', 'D'])
+        self.assertIsNone(model.interpreter)
+
+    def test_old_tables_removed(self):
+        other = os.path.join(self.tmp_dir.name, 'BirdNET_GLOBAL_6K_V2.4_MData_Model_FP16_10.0000_20.0000.npy')
+        grid_file = os.path.join(self.tmp_dir.name, f'{MDataModel2.model_name}_grid.npy')
+        for file_name in [other, grid_file]:
+            np.save(file_name, np.zeros(1))
+        model = MDataModel2(0.03)
+        for i in range(MAX_OCCURRENCE_TABLES + 2):
+            model.get_occurrence_table(10.0 + i, 20.0)
+            # a few ms apart would do
+            os.utime(model.occurrence_file(10.0 + i, 20.0), (1000 + i, 1000 + i))
+        # the first is used again
+        model.get_occurrence_table(10.0, 20.0)
+        model.get_occurrence_table(10.0 + MAX_OCCURRENCE_TABLES + 2, 20.0)
+
+        kept = [model.occurrence_file(10.0 + i, 20.0) for i in [0] + list(range(4, MAX_OCCURRENCE_TABLES + 3))]
+        self.assertEqual(sorted(os.listdir(self.tmp_dir.name)), sorted(os.path.basename(f) for f in kept + [other, grid_file]))
+
+    def test_grid(self):
+        grid_file = os.path.join(self.tmp_dir.name, 'grid.npy')
+        MDataModel2(0.03).build_grid(grid_file, 10.0, 11.0, 20.0, 21.0, 0.5)
+        grid = SpeciesGrid(grid_file)
+
+        self.assertEqual(grid.scores.shape, (3, 3, MDataModel2.weeks, 5))
+        self.assertTrue(grid.covers(10.7, 20.0))
+        self.assertFalse(grid.covers(11.2, 20.0))
+        # the fake scores are linear in lat and lon, so the interpolation is exact
+        np.testing.assert_allclose(grid.lookup(10.7, 20.2, 5), (35.9 + np.arange(5)) / 1000, rtol=1e-3)
+        np.testing.assert_allclose(grid.lookup(10.7, 20.2, 5, interpolate=False), (35.5 + np.arange(5)) / 1000, rtol=1e-3)
+
+        # covered locations do not run the model, nor write a table
+        model = MDataModel2(0.03, grid_file)
+        model.set_meta_data(10.7, 20.2, 5)
+        np.testing.assert_allclose(model._get_scores(), (35.9 + np.arange(5)) / 1000, rtol=1e-3)
+        self.assertIsNone(model.interpreter)
+        self.assertFalse(os.path.exists(model.occurrence_file(10.7, 20.2)))
+
+    def test_empty_grid(self):
+        grid_file = os.path.join(self.tmp_dir.name, 'grid.npy')
+        for lat_max, lon_max, step in [(9.0, 21.0, 0.5), (11.0, 19.5, 0.5), (11.0, 21.0, 0.0)]:
+            with self.subTest(lat_max=lat_max, lon_max=lon_max, step=step), self.assertRaises(ValueError):
+                MDataModel2(0.03).build_grid(grid_file, 10.0, lat_max, 20.0, lon_max, step)
+        self.assertFalse(os.path.exists(grid_file))
+
+
+class TestTopK(unittest.TestCase):
+
+    def test_top_k_matches_full_sort(self):
+        scores = np.random.default_rng(0).random((6, 50)).astype('float32')
+        indices, top_scores = top_k(scores, 10)
+
+        np.testing.assert_array_equal(indices, np.argsort(-scores, axis=1)[:, :10])
+        np.testing.assert_array_equal(top_scores, -np.sort(-scores, axis=1)[:, :10])
+
+    def test_top_k_larger_than_labels(self):
+        indices, top_scores = top_k(np.array([[0.1, 0.3, 0.2]]), 10)
+
+        np.testing.assert_array_equal(indices, [[1, 2, 0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
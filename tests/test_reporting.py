@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+import soundfile
+
+from scripts.utils import reporting
+from scripts.utils.classes import Detection, ParseFileName
+from scripts.utils.reporting import Recording, extract_clip, extract_detection
+
+from tests.helpers import TESTDATA, Settings
+
+
+class TestExtraction(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.source = os.path.join(TESTDATA, 'Pica pica_30s.wav')
+        self.samples, self.rate = soundfile.read(self.source, dtype='int16', always_2d=True)
+        patcher = patch.object(reporting, '_sox_formats', set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def out_file(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def test_clip_formats(self):
+        recording = Recording(self.source)
+        for audio_fmt in ['wav', 'flac', 'ogg', 'mp3']:
+            with self.subTest(audio_fmt):
+                extract_clip(recording, self.out_file(f'clip.{audio_fmt}'), 1.5, 7.5)
+                samples, rate = soundfile.read(self.out_file(f'clip.{audio_fmt}'), dtype='int16', always_2d=True)
+                self.assertEqual(rate, self.rate)
+                # the lossy encoders pad the start and end
+                self.assertAlmostEqual(len(samples) / rate, 6.0, delta=0.1)
+        # the same samples as the recording
+        samples, _ = soundfile.read(self.out_file('clip.wav'), dtype='int16', always_2d=True)
+        np.testing.assert_array_equal(samples, self.samples[72000:360000])
+        flac, _ = soundfile.read(self.out_file('clip.flac'), dtype='int16', always_2d=True)
+        np.testing.assert_array_equal(flac, samples)
+        self.assertEqual(soundfile.info(self.out_file('clip.wav')).subtype, 'PCM_16')
+
+    @patch('scripts.utils.reporting.extract')
+    def test_sox_fallback(self, mock_extract):
+        recording = Recording(self.source)
+        extract_clip(recording, self.out_file('clip.gsm'), 1.5, 7.5)
+        mock_extract.assert_called_once_with(self.source, self.out_file('clip.gsm'), 1.5, 7.5)
+        self.assertIsNone(recording.samplerate)
+
+        # a format this soundfile cannot write is left to sox from then on
+        with patch('scripts.utils.reporting.soundfile.write', side_effect=TypeError('compression_level')):
+            extract_clip(recording, self.out_file('clip.mp3'), 1.5, 7.5)
+        extract_clip(recording, self.out_file('clip2.mp3'), 1.5, 7.5)
+        self.assertEqual(mock_extract.call_count, 3)
+
+    @patch('scripts.utils.reporting.spectrogram')
+    @patch('scripts.utils.helpers._load_settings')
+    def test_detections_decode_once(self, mock_load_settings, mock_spectrogram):
+        settings = Settings.with_defaults()
+        settings.update({'EXTRACTED': self.tmp_dir.name, 'AUDIOFMT': 'wav', 'RECORDING_LENGTH': 30, 'RAW_SPECTROGRAM': 0})
+        mock_load_settings.return_value = settings
+        file = ParseFileName(self.out_file('2024-02-24-birdnet-16:19:37.wav'))
+        file.file_name = self.source
+        detections = [Detection(file.file_date, start, start + 3, 'Pica pica', 'Eurasian Magpie', 0.9) for start in [0.0, 9.0, 27.0]]
+
+        recording = Recording(self.source)
+        with patch('scripts.utils.reporting.soundfile.read', wraps=soundfile.read) as mock_read:
+            clips = [extract_detection(file, detection, recording) for detection in detections]
+        self.assertEqual(mock_read.call_count, 1)
+
+        # the clips are padded to EXTRACTION_LENGTH within the recording
+        self.assertEqual([soundfile.info(clip).frames / self.rate for clip in clips], [4.5, 6.0, 4.5])
+        self.assertEqual(os.path.basename(clips[1]), 'Eurasian_Magpie-90-2024-02-24-birdnet-16:19:46.wav')
+        self.assertEqual(mock_spectrogram.call_count, 3)
+
+        # left to the spectrogram_renderer
+        settings['LAZY_SPECTROGRAMS'] = '1'
+        detection = Detection(file.file_date, 15.0, 18.0, 'Pica pica', 'Eurasian Magpie', 0.9)
+        self.assertTrue(os.path.isfile(extract_detection(file, detection, recording)))
+        self.assertEqual(mock_spectrogram.call_count, 3)
+
+    @patch('scripts.utils.helpers._load_settings')
+    def test_spectrogram_from_samples(self, mock_load_settings):
+        mock_load_settings.return_value = Settings.with_defaults()
+        clip_file = self.out_file('clip.mp3')
+
+        with patch('scripts.utils.reporting.soundfile.read') as mock_read:
+            reporting.spectrogram(clip_file, 'Eurasian Magpie', 'clip.mp3', '0', self.samples[:6 * self.rate], self.rate)
+        mock_read.assert_not_called()
+        self.assertTrue(os.path.isfile(f'{clip_file}.png'))
+
+
+class TestWriteToDb(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('scripts.utils.helpers._load_settings', return_value=Settings.with_defaults())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(reporting, 'DB_RETRY_DELAY', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.file = ParseFileName('/tmp/2024-02-24-birdnet-16:19:37.wav')
+        self.detections = [Detection(self.file.file_date, 9.0, 12.0, 'Pica pica', 'Eurasian Magpie', 0.9)]
+        self.detections[0].file_name_extr = 'Eurasian_Magpie-90-2024-02-24-birdnet-16:19:46.wav'
+
+    @patch('scripts.utils.reporting.get_writer')
+    def test_retry(self, mock_get_writer):
+        mock_insert = mock_get_writer.return_value.insert
+        mock_insert.side_effect = [sqlite3.OperationalError('database is locked'), None]
+        with self.assertLogs('scripts.utils.reporting', 'WARNING'):
+            reporting.write_to_db(self.file, self.detections)
+        self.assertEqual(mock_insert.call_count, 2)
+
+        # raised after the last attempt, so that the recording is not removed
+        mock_insert.reset_mock()
+        mock_insert.side_effect = sqlite3.OperationalError('database is locked')
+        with self.assertLogs('scripts.utils.reporting', 'ERROR'), self.assertRaises(sqlite3.OperationalError):
+            reporting.write_to_db(self.file, self.detections)
+        self.assertEqual(mock_insert.call_count, reporting.DB_WRITE_ATTEMPTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
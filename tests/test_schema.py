@@ -0,0 +1,287 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from scripts.utils import db
+from scripts.utils.db import DetectionWriter
+from scripts.utils.schema import (TABLES, archive_batches, archive_detections, archive_dir, archive_files, check_aggregates, create_db,
+                                  migrate_db, rebuild_aggregates, seal_archive)
+
+from tests.helpers import detection_row
+
+# the detections table before the species and run settings moved to their own tables
+OLD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS detections (
+  Date DATE,
+  Time TIME,
+  Sci_Name VARCHAR(100) NOT NULL,
+  Com_Name VARCHAR(100) NOT NULL,
+  Confidence FLOAT,
+  Lat FLOAT,
+  Lon FLOAT,
+  Cutoff FLOAT,
+  Week INT,
+  Sens FLOAT,
+  Overlap FLOAT,
+  File_Name VARCHAR(100) NOT NULL);
+CREATE INDEX "detections_Com_Name" ON "detections" ("Com_Name");
+CREATE INDEX "detections_Sci_Name" ON "detections" ("Sci_Name");
+CREATE INDEX "detections_Date_Time" ON "detections" ("Date" DESC, "Time" DESC);
+"""
+
+
+class TestMigration(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db_path = os.path.join(self.tmp_dir.name, 'birds.db')
+        self.rows = [detection_row('06:10:00', date='2024-02-23'),
+                     detection_row('06:10:00', date='2024-02-23'),
+                     detection_row('07:05:00', 'Corvus corone', 'Carrion Crow', 0.7),
+                     detection_row('07:06:00', 'Corvus corone', 'Corneille noire', 0.8),
+                     detection_row('08:00:00')[:5] + (None, None, 0.7, 8, 1.25, 0.0, 'no location.mp3')]
+        with sqlite3.connect(self.db_path) as con:
+            con.executescript(OLD_SCHEMA)
+            con.executemany(DetectionWriter.insert_sql, self.rows)
+
+    def detections(self, con):
+        return con.execute('SELECT * FROM detections ORDER BY Date, Time, Confidence').fetchall()
+
+    def test_migrate(self):
+        with sqlite3.connect(self.db_path) as con:
+            before = self.detections(con)
+
+        self.assertTrue(migrate_db(self.db_path))
+        self.assertFalse(migrate_db(self.db_path))
+
+        with sqlite3.connect(self.db_path) as con:
+            self.assertEqual(con.execute("SELECT type FROM sqlite_master WHERE name = 'detections'").fetchone(), ('view',))
+            # a species under two names
+            self.assertEqual(con.execute('SELECT COUNT(*) FROM species').fetchone(), (3,))
+            self.assertEqual(con.execute('SELECT COUNT(*) FROM run_settings').fetchone(), (2,))
+            after = self.detections(con)
+        # each detection keeps its own common name
+        self.assertEqual(after, before)
+        self.assertEqual(check_aggregates(self.db_path), {})
+
+    def test_view_writes(self):
+        migrate_db(self.db_path)
+
+        with sqlite3.connect(self.db_path) as con:
+            # each of the two identical rows deletes one
+            con.execute('DELETE FROM detections WHERE Time = ?', ('06:10:00',))
+            con.execute('UPDATE detections SET Lat = 51 WHERE Sci_Name = ?', ('Corvus corone',))
+            con.execute('INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', detection_row('09:00:00', 'Parus major', 'Great Tit'))
+            self.assertEqual(con.execute('SELECT Time, Sci_Name, Lat FROM detections ORDER BY Date, Time').fetchall(),
+                             [('07:05:00', 'Corvus corone', 51.0), ('07:06:00', 'Corvus corone', 51.0),
+                              ('08:00:00', 'Pica pica', None), ('09:00:00', 'Parus major', 50.0)])
+            self.assertEqual(con.execute('SELECT COUNT(*) FROM run_settings').fetchone(), (3,))
+        self.assertEqual(check_aggregates(self.db_path), {})
+
+
+class TestAggregates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db_path = os.path.join(self.tmp_dir.name, 'birds.db')
+        create_db(self.db_path)
+        self.con = sqlite3.connect(self.db_path)
+        self.addCleanup(self.con.close)
+        with self.con:
+            self.con.executemany(DetectionWriter.insert_sql, [
+                detection_row('06:10:00', confidence=0.8, date='2024-02-23'),
+                detection_row('06:40:00', confidence=0.95, date='2024-02-23'),
+                detection_row('07:05:00', 'Corvus corone', 'Carrion Crow', 0.7, date='2024-02-23'),
+            ])
+
+    def hourly(self):
+        return self.con.execute('SELECT Date, Hour, Sci_Name, Count, MaxConfidence, Time FROM species_hourly ORDER BY 1, 2, 3').fetchall()
+
+    def totals(self):
+        return self.con.execute('SELECT Sci_Name, Count, MaxConfidence, FirstDate, LastDate FROM species_totals ORDER BY 1').fetchall()
+
+    def test_rebuild(self):
+        rebuild_aggregates(self.db_path)
+
+        self.assertEqual(self.hourly(), [('2024-02-23', 6, 'Pica pica', 2, 0.95, '06:40:00'),
+                                         ('2024-02-23', 7, 'Corvus corone', 1, 0.7, '07:05:00')])
+        self.assertEqual(self.totals(), [('Corvus corone', 1, 0.7, '2024-02-23', '2024-02-23'),
+                                         ('Pica pica', 2, 0.95, '2024-02-23', '2024-02-23')])
+        self.assertEqual(check_aggregates(self.db_path), {})
+
+    def test_triggers(self):
+        writer = DetectionWriter(self.db_path)
+        self.addCleanup(writer.close)
+        writer.insert([detection_row('06:20:00', confidence=0.97, date='2024-02-23'), detection_row('16:19:37')])
+        self.assertEqual(self.totals()[1], ('Pica pica', 4, 0.97, '2024-02-23', '2024-02-24'))
+
+        # deleting the best detection of the hour looks up the next one
+        writer.execute([('DELETE FROM detections WHERE Time = ?', [('06:20:00',)])])
+        self.assertEqual(self.hourly()[0], ('2024-02-23', 6, 'Pica pica', 2, 0.95, '06:40:00'))
+        self.assertEqual(self.totals()[1], ('Pica pica', 3, 0.95, '2024-02-23', '2024-02-24'))
+
+        # a corrected identification moves the detection to another species
+        writer.execute([('UPDATE detections SET Sci_Name = ?, Com_Name = ? WHERE Time = ?', [('Corvus corone', 'Carrion Crow', '16:19:37')])])
+        self.assertEqual(self.totals(), [('Corvus corone', 2, 0.9, '2024-02-23', '2024-02-24'),
+                                         ('Pica pica', 2, 0.95, '2024-02-23', '2024-02-23')])
+
+        writer.execute([('DELETE FROM detections WHERE Sci_Name = ?', [('Corvus corone',)])])
+        self.assertEqual(self.totals(), [('Pica pica', 2, 0.95, '2024-02-23', '2024-02-23')])
+        self.assertEqual(check_aggregates(self.db_path), {})
+
+    def test_language_change(self):
+        writer = DetectionWriter(self.db_path)
+        self.addCleanup(writer.close)
+        writer.insert([detection_row('06:50:00', com_name='Pie bavarde', confidence=0.85, date='2024-02-23')])
+
+        # the past detections keep the name of their clips, the counts are per species
+        self.assertEqual(self.con.execute('SELECT Time, Com_Name FROM detections WHERE Sci_Name = "Pica pica" ORDER BY Time').fetchall(),
+                         [('06:10:00', 'Eurasian Magpie'), ('06:40:00', 'Eurasian Magpie'), ('06:50:00', 'Pie bavarde')])
+        self.assertEqual(self.con.execute('SELECT Com_Name, Count FROM species_totals WHERE Sci_Name = "Pica pica"').fetchone(), ('Pie bavarde', 3))
+
+        # the best detection of the hour is looked up under both names
+        writer.execute([('DELETE FROM detections WHERE Time = ?', [('06:40:00',)])])
+        self.assertEqual(self.hourly()[0], ('2024-02-23', 6, 'Pica pica', 2, 0.85, '06:50:00'))
+        self.assertEqual(check_aggregates(self.db_path), {})
+
+    def test_check_finds_differences(self):
+        self.con.execute('UPDATE species_totals SET Count = 5 WHERE Sci_Name = "Pica pica"')
+        self.con.commit()
+
+        differences = check_aggregates(self.db_path)
+        self.assertEqual(list(differences), ['species_totals'])
+        self.assertEqual(differences['species_totals'], ([('Pica pica', 2, 0.95, '2024-02-23', '2024-02-23')],
+                                                         [('Pica pica', 5, 0.95, '2024-02-23', '2024-02-23')]))
+
+        rebuild_aggregates(self.db_path)
+        self.assertEqual(check_aggregates(self.db_path), {})
+
+    def test_summary_and_species(self):
+        with patch.object(db, 'DB_PATH', self.db_path), patch.object(db, '_DB', None):
+            summary = db.get_summary()
+            species = db.get_species_by('occurrences')
+            db.get_db().close()
+
+        self.assertEqual((summary.total_count, summary.species_tally), (3, 2))
+        self.assertEqual([(row.Sci_Name, row.Count, row.MaxConfidence, row.Time) for row in species],
+                         [('Pica pica', 2, 0.95, '06:40:00'), ('Corvus corone', 1, 0.7, '07:05:00')])
+
+
+class TestArchives(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db_path = os.path.join(self.tmp_dir.name, 'birds.db')
+        create_db(self.db_path)
+        writer = DetectionWriter(self.db_path)
+        writer.insert([detection_row('06:10:00', date='2022-12-31'),
+                       detection_row('06:20:00', 'Corvus corone', 'Carrion Crow', date='2023-06-01'),
+                       detection_row('06:30:00', date='2023-06-01'),
+                       detection_row('06:40:00', date='2024-02-24')])
+        writer.close()
+
+    def connect(self):
+        con = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+        self.addCleanup(con.close)
+        return con
+
+    def batches(self, con, *args):
+        # the databases attached and the detections of each batch
+        return [([row[1] for row in con.execute('PRAGMA database_list')], con.execute('SELECT * FROM detections_all ORDER BY Date, Time').fetchall())
+                for _ in archive_batches(con, *args)]
+
+    def test_archive(self):
+        with self.connect() as con:
+            before = con.execute('SELECT * FROM detections ORDER BY Date, Time').fetchall()
+            summary = con.execute('SELECT * FROM species_hourly ORDER BY Date, Hour, Sci_Name').fetchall()
+
+        self.assertEqual(archive_detections('2024-01-01', self.db_path), {2022: 1, 2023: 2})
+        self.assertEqual(list(archive_files(self.db_path)), [2022, 2023])
+        self.assertEqual(archive_detections('2024-01-01', self.db_path), {})
+
+        con = self.connect()
+        self.assertEqual(con.execute('SELECT Date FROM detections').fetchall(), [('2024-02-24',)])
+        # the aggregates still count the archived detections
+        self.assertEqual(con.execute('SELECT * FROM species_hourly ORDER BY Date, Hour, Sci_Name').fetchall(), summary)
+        self.assertEqual(check_aggregates(self.db_path), {})
+
+        # the recent days do not need the archives
+        self.assertEqual(self.batches(con, '2024-02-20'), [(['main', 'temp'], before[3:])])
+        self.assertEqual([attached for attached, _ in self.batches(con, '2023-01-01', '2024-02-24')], [['main', 'temp', 'archive_2023']])
+        self.assertEqual(self.batches(con), [(['main', 'temp', 'archive_2022', 'archive_2023'], before)])
+        self.assertEqual([row[1] for row in con.execute('PRAGMA database_list')], ['main', 'temp'])
+
+        rebuild_aggregates(self.db_path)
+        self.assertEqual(con.execute('SELECT * FROM species_hourly ORDER BY Date, Hour, Sci_Name').fetchall(), summary)
+
+    def test_get_detections(self):
+        archive_detections('2024-01-01', self.db_path)
+
+        with patch.object(db, 'DB_PATH', self.db_path), patch.object(db, '_DB', None):
+            recent = db.get_detections('2024-02-01', '2024-02-29')
+            attached = [row[1] for row in db.get_db().execute('PRAGMA database_list')]
+            year = db.get_detections('2023-01-01', '2023-12-31')
+            db.get_db().close()
+
+        self.assertEqual([row.Time for row in recent], ['06:40:00'])
+        self.assertEqual(attached, ['main', 'temp'])
+        self.assertEqual([row.Time for row in year], ['06:20:00', '06:30:00'])
+
+    def test_interrupted_and_sealed(self):
+        # as if an archive run had committed the archive, and not the database
+        os.makedirs(archive_dir(self.db_path))
+        with sqlite3.connect(self.db_path) as con:
+            con.execute('ATTACH DATABASE ? AS archive', (os.path.join(archive_dir(self.db_path), 'birds-2022.db'),))
+            con.executescript(TABLES.format(schema='archive'))
+            con.execute('INSERT INTO archive.species SELECT * FROM main.species')
+            con.execute('INSERT INTO archive.run_settings SELECT * FROM main.run_settings')
+            con.execute("INSERT INTO archive.detection_data SELECT * FROM main.detection_data WHERE Date < '2023-01-01'")
+        writer = DetectionWriter(self.db_path)
+        writer.insert([detection_row('07:00:00', date='2022-12-31')])
+        writer.close()
+
+        self.assertEqual(archive_detections('2023-01-01', self.db_path), {2022: 2})
+        with sqlite3.connect(archive_files(self.db_path)[2022]) as con:
+            self.assertEqual(con.execute("SELECT Time FROM detection_data WHERE Date = '2022-12-31' ORDER BY Time").fetchall(),
+                             [('06:10:00',), ('07:00:00',)])
+
+        seal_archive(2022, self.db_path)
+        writer = DetectionWriter(self.db_path)
+        writer.insert([detection_row('08:00:00', date='2022-12-31')])
+        writer.close()
+        self.assertEqual(archive_detections('2024-01-01', self.db_path), {2023: 2})
+        con = self.connect()
+        self.assertEqual(con.execute('SELECT Date, Time FROM detections ORDER BY Date').fetchall(),
+                         [('2022-12-31', '08:00:00'), ('2024-02-24', '06:40:00')])
+        self.assertEqual([len(detections) for _, detections in self.batches(con)], [6])
+        self.assertEqual(check_aggregates(self.db_path), {})
+        # 2022 is in the database and in its archive, in two batches
+        with patch('scripts.utils.schema.ATTACH_BATCH', 1):
+            self.assertEqual(check_aggregates(self.db_path), {})
+
+    def test_more_archives_than_attached(self):
+        with self.connect() as con:
+            before = con.execute('SELECT * FROM detections ORDER BY Date, Time').fetchall()
+            summary = con.execute('SELECT * FROM species_hourly ORDER BY Date, Hour, Sci_Name').fetchall()
+        archive_detections('2024-01-01', self.db_path)
+
+        con = self.connect()
+        with patch('scripts.utils.schema.ATTACH_BATCH', 1):
+            # the newest archive with the database, then each detection once
+            self.assertEqual(self.batches(con), [(['main', 'temp', 'archive_2023'], before[1:]), (['main', 'temp', 'archive_2022'], before[:1])])
+            self.assertEqual(check_aggregates(self.db_path), {})
+            rebuild_aggregates(self.db_path)
+            with patch.object(db, 'DB_PATH', self.db_path), patch.object(db, '_DB', None):
+                detections = db.get_detections(None, '2024-02-29')
+                db.get_db().close()
+        self.assertEqual(con.execute('SELECT * FROM species_hourly ORDER BY Date, Hour, Sci_Name').fetchall(), summary)
+        self.assertEqual([(row.Date, row.Time) for row in detections], [row[:2] for row in before])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from scripts.utils import snapshot
+from scripts.utils.db import DetectionWriter
+from scripts.utils.schema import archive_detections, create_db
+from scripts.utils.snapshot import export_snapshot, read_snapshot, snapshot_dir
+
+from tests.helpers import detection_row
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db_path = os.path.join(self.tmp_dir.name, 'birds.db')
+        create_db(self.db_path)
+        self.writer = DetectionWriter(self.db_path)
+        self.addCleanup(self.writer.close)
+        self.writer.insert([detection_row('06:10:00', date='2023-12-31'),
+                            detection_row('06:20:00', 'Corvus corone', 'Carrion Crow', 0.7),
+                            detection_row('06:15:00')])
+
+    def read(self, *args, **kwargs):
+        df = read_snapshot(*args, db_path=self.db_path, **kwargs)
+        return list(df[['Date', 'Time', 'Sci_Name']].itertuples(index=False, name=None))
+
+    def files(self, month):
+        return os.listdir(os.path.join(snapshot_dir(self.db_path), f'Month={month}'))
+
+    def test_export_and_read(self):
+        self.assertIsNone(read_snapshot(db_path=self.db_path))
+        self.assertEqual(export_snapshot(self.db_path), (3, []))
+        self.writer.insert([detection_row('07:00:00')])
+        self.assertEqual(export_snapshot(self.db_path), (1, []))
+
+        self.assertEqual(self.read(), [('2023-12-31', '06:10:00', 'Pica pica'), ('2024-02-24', '06:15:00', 'Pica pica'),
+                                       ('2024-02-24', '06:20:00', 'Corvus corone'), ('2024-02-24', '07:00:00', 'Pica pica')])
+        self.assertEqual(len(self.files('2024-02')), 2)
+        self.assertEqual(self.read(start='2024-01-01'), self.read()[1:])
+        self.assertEqual(self.read(end='2024-02-23'), self.read()[:1])
+
+        df = read_snapshot(['Sci_Name', 'Confidence'], db_path=self.db_path, categories=True)
+        self.assertEqual(list(df.columns), ['Sci_Name', 'Confidence'])
+        self.assertEqual(list(df['Sci_Name'].cat.categories), ['Pica pica', 'Corvus corone'])
+
+    def test_changed_months_written_again(self):
+        export_snapshot(self.db_path)
+        self.writer.execute([('DELETE FROM detections WHERE Date = ?', [('2023-12-31',)]),
+                             ('UPDATE detections SET Sci_Name = ?, Com_Name = ? WHERE Time = ?', [('Corvus corone', 'Carrion Crow', '06:15:00')])])
+
+        self.assertEqual(export_snapshot(self.db_path), (0, ['2023-12', '2024-02']))
+        self.assertEqual(self.read(), [('2024-02-24', '06:15:00', 'Corvus corone'), ('2024-02-24', '06:20:00', 'Corvus corone')])
+        self.assertFalse(os.path.exists(os.path.join(snapshot_dir(self.db_path), 'Month=2023-12')))
+
+        # archived detections stay in the snapshot, and are read from the archive when their month changes
+        archive_detections('2024-03-01', self.db_path)
+        self.assertEqual(export_snapshot(self.db_path), (0, []))
+        self.assertEqual(export_snapshot(self.db_path, rebuild=True), (0, ['2024-02']))
+        self.assertEqual(len(self.read()), 2)
+
+    def test_archives_in_batches(self):
+        self.writer.insert([detection_row('06:00:00', date='2022-05-01')])
+        export_snapshot(self.db_path)
+        archive_detections('2024-01-01', self.db_path)
+        # one archive attached at a time, the older ones after the database
+        with patch('scripts.utils.schema.ATTACH_BATCH', 1):
+            self.assertEqual(export_snapshot(self.db_path, rebuild=True), (2, ['2022-05', '2023-12', '2024-02']))
+        self.assertEqual(self.files('2022-05'), ['part-000000000003.parquet'])
+        self.assertEqual([row[0] for row in self.read()], ['2022-05-01', '2023-12-31', '2024-02-24', '2024-02-24'])
+
+    def test_appended_files_merged(self):
+        with patch.object(snapshot, 'MAX_FILES_PER_MONTH', 2):
+            for i in range(3):
+                self.writer.insert([detection_row(f'08:0{i}:00')])
+                export_snapshot(self.db_path)
+
+        self.assertEqual(len(self.files('2024-02')), 1)
+        self.assertEqual(len(self.read(start='2024-02-01')), 5)
+
+    def test_interrupted_export(self):
+        export_snapshot(self.db_path)
+        self.writer.insert([detection_row('07:00:00')])
+        # the part is written, not the state
+        with patch('scripts.utils.snapshot.json.dump', side_effect=OSError('No space left on device')):
+            with self.assertRaises(OSError):
+                export_snapshot(self.db_path)
+        self.assertEqual(len(self.files('2024-02')), 2)
+
+        # appended again, then the month is written again without the duplicate
+        self.writer.insert([detection_row('07:10:00')])
+        self.assertEqual(export_snapshot(self.db_path), (2, ['2024-02']))
+        self.assertEqual(len(self.read()), 5)
+
+    def test_files_replaced_while_read(self):
+        export_snapshot(self.db_path)
+        # listed, then the month is written again by the chart viewer
+        listed = snapshot._dataset(snapshot_dir(self.db_path))
+        self.writer.insert([detection_row('07:00:00')])
+        self.writer.execute([('DELETE FROM detections WHERE Time = ?', [('06:20:00',)])])
+        export_snapshot(self.db_path)
+
+        with patch.object(snapshot, '_dataset', side_effect=[listed, snapshot._dataset(snapshot_dir(self.db_path))]):
+            self.assertEqual(self.read(), [('2023-12-31', '06:10:00', 'Pica pica'), ('2024-02-24', '06:15:00', 'Pica pica'),
+                                           ('2024-02-24', '07:00:00', 'Pica pica')])
+        # the charts read the database instead
+        with patch.object(snapshot, '_dataset', return_value=listed):
+            self.assertIsNone(read_snapshot(db_path=self.db_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
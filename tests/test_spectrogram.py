@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from scripts.utils.helpers import FONT_DIR
+from scripts.utils.spectrogram import ABOVE, BELOW, LEFT, LEVELS, RIGHT, X_SIZE, Y_SIZE, annotate, levels, render, save_png
+
+FONT = os.path.join(FONT_DIR, 'RobotoFlex-Regular.ttf')
+
+
+def sine(frequency, rate, seconds=6.0, amplitude=1.0):
+    t = np.arange(int(rate * seconds)) / rate
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+class TestSpectrogram(unittest.TestCase):
+
+    def test_sine_levels(self):
+        for rate in [48000, 32000]:
+            with self.subTest(rate):
+                index = levels(sine(3000, rate), rate)
+                self.assertEqual(index.shape, (Y_SIZE, X_SIZE))
+                # the highest frequency first, 3 kHz is a quarter of the way up; a full scale sine is 0 dB
+                row = Y_SIZE - 1 - round(3000 / 12000 * (Y_SIZE - 1))
+                self.assertTrue(np.all(np.abs(np.argmax(index, axis=0) - row) <= 1))
+                # the first and last columns are half padding
+                self.assertTrue(np.all(index[row, 1:-1] >= LEVELS - 3))
+
+        # -60 dBFS is half way
+        index = levels(sine(3000, 48000, amplitude=0.001), 48000)
+        self.assertAlmostEqual(index[row, 1:-1].mean(), (LEVELS - 1) / 2, delta=2)
+        # there is nothing above 8 kHz at 16 kHz
+        index = levels(sine(3000, 16000), 16000)
+        self.assertTrue(np.all(index[:Y_SIZE // 3 - 1] == 0))
+
+    def test_int16_samples(self):
+        samples = sine(1000, 48000, amplitude=0.5)
+        row = Y_SIZE - 1 - round(1000 / 12000 * (Y_SIZE - 1))
+        # the same but for the quantization noise
+        np.testing.assert_allclose(levels((samples * 32768).astype(np.int16), 48000)[row], levels(samples, 48000)[row], atol=1)
+
+    def test_png(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        samples = np.stack([sine(3000, 48000), np.zeros(6 * 48000, dtype=np.float32)], axis=1)
+
+        for raw, size in [(True, (X_SIZE, Y_SIZE)), (False, (X_SIZE + LEFT + RIGHT, Y_SIZE + ABOVE + BELOW))]:
+            with self.subTest(raw=raw):
+                out_file = os.path.join(tmp_dir.name, f'{raw}.png')
+                save_png(annotate(render(samples, 48000, raw, FONT), 'Eurasian Magpie', 'clip.mp3', FONT), out_file)
+                with Image.open(out_file) as img:
+                    self.assertEqual(img.size, size)
+                    self.assertEqual(img.mode, 'P')
+        self.assertEqual(sorted(os.listdir(tmp_dir.name)), ['False.png', 'True.png'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock, patch
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from PIL import Image
+
+from scripts.utils.db import DetectionWriter
+from scripts.utils.schema import create_db
+from scripts.utils.spectrogram_cache import RendererServer, SpectrogramCache, com_name_for
+
+from tests.helpers import TESTDATA, Settings, detection_row
+
+
+def fake_render(clip_file, png_file, size=100):
+    with open(png_file, 'wb') as f:
+        f.write(b'\0' * size)
+
+
+class TestSpectrogramCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        self.clips = []
+        for i in range(4):
+            clip = os.path.join(self.tmp_dir.name, f'clip{i}.mp3')
+            open(clip, 'w').close()
+            self.clips.append(clip)
+
+    def test_least_recently_used_removed(self):
+        cache = SpectrogramCache(self.cache_dir, 250)
+        for clip in self.clips[:2]:
+            self.assertEqual(cache.get(clip, fake_render), os.path.join(self.cache_dir, f'{os.path.basename(clip)}.png'))
+        # a hit does not render again and makes clip0 the most recent
+        mock_render = Mock()
+        cache.get(self.clips[0], mock_render)
+        mock_render.assert_not_called()
+
+        cache.get(self.clips[2], fake_render)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['clip0.mp3.png', 'clip2.mp3.png'])
+        self.assertEqual((len(cache), cache.size), (2, 200))
+
+        # the order survives a restart, it is in the modification times (a few ms apart would do)
+        os.utime(os.path.join(self.cache_dir, 'clip0.mp3.png'), (2000, 2000))
+        os.utime(os.path.join(self.cache_dir, 'clip2.mp3.png'), (1000, 1000))
+        cache = SpectrogramCache(self.cache_dir, 250)
+        cache.get(self.clips[3], fake_render)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['clip0.mp3.png', 'clip3.mp3.png'])
+        self.assertEqual(len(cache), 2)
+
+    def test_changed_and_deleted_clips(self):
+        cache = SpectrogramCache(self.cache_dir, 1000)
+        png_file = cache.get(self.clips[0], fake_render)
+        os.utime(self.clips[0], (os.stat(png_file).st_mtime + 10,) * 2)
+        cache.get(self.clips[0], lambda clip_file, png_file: fake_render(clip_file, png_file, 300))
+        self.assertEqual(cache.size, 300)
+
+        os.remove(self.clips[0])
+        self.assertIsNone(cache.get(self.clips[0], fake_render))
+        self.assertEqual((os.listdir(self.cache_dir), cache.size), ([], 0))
+
+
+class TestRendererServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        clip_dir = os.path.join(self.tmp_dir.name, 'Extracted', 'By_Date', '2024-02-24', 'Coopers_Hawk')
+        os.makedirs(clip_dir)
+        shutil.copy(os.path.join(TESTDATA, 'Pica pica_30s.wav'), os.path.join(clip_dir, 'clip 1.wav'))
+        self.db_path = os.path.join(self.tmp_dir.name, 'birds.db')
+        create_db(self.db_path)
+
+        patcher = patch('scripts.utils.helpers._load_settings', return_value=Settings.with_defaults())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        cache = SpectrogramCache(os.path.join(self.tmp_dir.name, 'cache'), 10 * 1024 * 1024)
+        self.server = RendererServer(os.path.join(self.tmp_dir.name, 'Extracted'), cache, db_path=self.db_path, address=('localhost', 0))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def get(self, path):
+        with urlopen(f'http://localhost:{self.server.server_address[1]}{path}', timeout=30) as response:
+            return response.status, response.headers['Content-Type'], response.read()
+
+    def test_render_on_request(self):
+        status, content_type, data = self.get('/By_Date/2024-02-24/Coopers_Hawk/clip%201.wav.png')
+        self.assertEqual((status, content_type), (200, 'image/png'))
+        png_file = os.path.join(self.tmp_dir.name, 'cache', 'clip 1.wav.png')
+        with Image.open(png_file) as img:
+            self.assertEqual(img.mode, 'P')
+        with open(png_file, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        # nothing is written next to the clip
+        self.assertEqual(os.listdir(os.path.dirname(self.server.clip_file('/By_Date/2024-02-24/Coopers_Hawk/clip%201.wav.png'))), ['clip 1.wav'])
+
+        for path in ['/By_Date/2024-02-24/Coopers_Hawk/clip%202.wav.png', '/By_Date/2024-02-24/../../birds.db.png',
+                     '/By_Date/2024-02-24/Coopers_Hawk/clip%201.wav', '/Charts/clip%201.wav.png']:
+            with self.subTest(path), self.assertRaises(HTTPError) as cm:
+                self.get(path)
+            self.assertEqual(cm.exception.code, 404)
+
+    def test_raw_mode(self):
+        self.get('/By_Date/2024-02-24/Coopers_Hawk/clip%201.wav.png')
+        # the setting changed, the renderer was restarted with the cache of the other mode
+        self.server.raw = '1'
+        with patch('scripts.utils.spectrogram_cache.spectrogram', side_effect=lambda *args, out_file: fake_render(None, out_file)) as mock_spectrogram:
+            _, _, data = self.get('/By_Date/2024-02-24/Coopers_Hawk/clip%201.wav.png')
+        self.assertEqual(mock_spectrogram.call_args[0][3], '1')
+        self.assertEqual(data, b'\0' * 100)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp_dir.name, 'cache'))), ['clip 1.wav.png', 'clip 1.wav.raw.png'])
+
+    def test_title(self):
+        self.assertEqual(com_name_for('By_Date/2024-02-24/Coopers_Hawk/clip.wav', self.db_path), 'Coopers Hawk')
+        writer = DetectionWriter(self.db_path)
+        writer.insert([detection_row('06:10:00', 'Accipiter cooperii', "Cooper's Hawk")])
+        writer.close()
+        self.assertEqual(com_name_for('By_Date/2024-02-24/Coopers_Hawk/clip.wav', self.db_path), "Cooper's Hawk")
+
+
+if __name__ == '__main__':
+    unittest.main()